@@ -0,0 +1,190 @@
+"""
+Web 请求准入控制：按路由分组限制并发，超出时有界排队，排不上或等待超时立即拒绝
+
+gthread worker 的线程是所有路由共享的：模型变慢时同步生成接口会占满线程，
+连 /health 和首页都无法响应。这里给每组路由设置并发上限和等待队列，
+各组（并发 + 队列）之和小于 worker 线程数，剩余线程留给不受限的健康检查和静态资源。
+
+- 队列已满：429，等待超时：503，均带 Retry-After（按该组最近的处理耗时估算）
+- 自适应模式：处理耗时超过目标值时按比例收紧并发上限，恢复后逐步放宽到配置值
+"""
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, g, jsonify, request
+
+from metrics import metrics
+
+# 路由（Flask endpoint）所属的分组；未列出的 /api 路由归入 api 组
+ROUTE_POOLS = {
+    'generate_soap': 'model',
+    'recommend_examinations': 'model',
+    'check_drug_conflicts': 'model',
+    'get_job': 'poll',
+    'job_events': 'stream',
+    'export_fhir': 'stream',
+    # WebSocket 在整个问诊期间占用额度，单独成组，避免挤占 SSE 和导出
+    'consultation_ws': 'live',
+}
+# 不受限的路由，始终使用保留的线程
+EXEMPT_ENDPOINTS = {'index', 'static', 'health', 'health_live', 'health_ready', 'metrics_snapshot'}
+DEFAULT_POOL = 'api'
+
+# 自适应调整的最小间隔（秒），以及超过目标耗时时的收缩比例
+ADAPT_INTERVAL = 5.0
+ADAPT_DECREASE = 0.75
+LATENCY_EWMA_ALPHA = 0.2
+MAX_RETRY_AFTER = 60
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Pool:
+    """一组路由共享的并发额度和等待队列"""
+
+    def __init__(self, name: str, limit: int, queue_size: int, max_wait: float,
+                 adaptive: bool = False, target_latency: float = 0.0, min_limit: int = 1):
+        self.name = name
+        self.max_limit = limit
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.adaptive = adaptive and target_latency > 0
+        self.target_latency = target_latency
+        self.min_limit = min(min_limit, limit)
+        self.active = 0
+        self.waiting = 0
+        self.latency: Optional[float] = None
+        self._saturated = False
+        self._last_adapt = time.monotonic()
+        self._cond = threading.Condition()
+
+        metrics.gauge('admission_active', lambda: self.active, pool=name)
+        metrics.gauge('admission_waiting', lambda: self.waiting, pool=name)
+        metrics.gauge('admission_limit', lambda: self.limit, pool=name)
+
+    def retry_after(self) -> int:
+        """按当前排队长度和最近的处理耗时估算多久后会有空位"""
+        if not self.latency:
+            return 1
+        estimate = self.latency * (self.waiting + 1) / max(self.limit, 1)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                return
+            self._saturated = True
+            if self.waiting >= self.queue_size:
+                metrics.inc('admission_rejected_total', pool=self.name, reason='queue_full')
+                raise Rejected(429, self.retry_after(), 'queue_full')
+
+            self.waiting += 1
+            start = time.monotonic()
+            deadline = start + self.max_wait
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc('admission_rejected_total', pool=self.name, reason='timeout')
+                        raise Rejected(503, self.retry_after(), 'timeout')
+                    self._cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+            metrics.observe('admission_wait_seconds', time.monotonic() - start, pool=self.name)
+
+    def release(self, elapsed: float):
+        with self._cond:
+            self.active -= 1
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += LATENCY_EWMA_ALPHA * (elapsed - self.latency)
+            if self.adaptive:
+                self._adapt()
+            self._cond.notify()
+
+    def _adapt(self):
+        now = time.monotonic()
+        if now - self._last_adapt < ADAPT_INTERVAL:
+            return
+        self._last_adapt = now
+        previous = self.limit
+        if self.latency > self.target_latency:
+            # 上游变慢：收紧并发，多出来的请求快速失败而不是占着线程等
+            self.limit = max(self.min_limit, int(self.limit * ADAPT_DECREASE))
+        elif self.latency < self.target_latency / 2 and self._saturated:
+            # 只有额度确实不够用时才放宽，每次加 1
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._saturated = False
+        if self.limit != previous:
+            metrics.inc('admission_limit_changes_total', pool=self.name,
+                        direction='down' if self.limit < previous else 'up')
+            # 放宽后唤醒排队的请求
+            self._cond.notify_all()
+
+
+def parse_pools(spec: str) -> Dict[str, Tuple[int, int]]:
+    """'model=6:4,poll=6:0' -> {'model': (6, 4), 'poll': (6, 0)}（并发上限:队列长度）"""
+    pools = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.partition('=')
+        limit, _, queue_size = value.partition(':')
+        pools[name.strip()] = (int(limit), int(queue_size or 0))
+    return pools
+
+
+class AdmissionControl:
+    def __init__(self, app: Optional[Flask] = None, pools: str = '', max_wait: float = 5.0,
+                 adaptive: bool = False, target_latency: float = 0.0, adaptive_pools=('model',)):
+        self.pools: Dict[str, Pool] = {}
+        for name, (limit, queue_size) in parse_pools(pools).items():
+            self.pools[name] = Pool(name, limit, queue_size, max_wait,
+                                    adaptive=adaptive and name in adaptive_pools,
+                                    target_latency=target_latency)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+        app.extensions['admission'] = self
+
+    def pool_for(self, endpoint: Optional[str]) -> Optional[Pool]:
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        return self.pools.get(ROUTE_POOLS.get(endpoint, DEFAULT_POOL))
+
+    def admit(self):
+        pool = self.pool_for(request.endpoint)
+        if pool is None:
+            return None
+        try:
+            pool.acquire()
+        except Rejected as e:
+            response = jsonify({'success': False, 'error': '服务繁忙，请稍后重试', 'reason': e.reason})
+            response.status_code = e.status
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        g.admission = (pool, time.monotonic())
+        return None
+
+    def release(self, exc=None):
+        # 流式响应（SSE、导出）在数据发送完毕、请求上下文结束时才释放
+        admitted = g.pop('admission', None)
+        if admitted is not None:
+            pool, start = admitted
+            pool.release(time.monotonic() - start)
@@ -1,11 +1,34 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
+from flask_sock import Sock
+import hmac
+import json
 import os
+import threading
 from datetime import datetime
-from config import GOOGLE_API_KEY, GEMINI_MODEL
+from config import (
+    GOOGLE_API_KEY, GEMINI_MODEL, GENERATION_MODE, COMPRESS_MIN_SIZE, LIVE_MAX_MESSAGE_BYTES,
+    JOBS_DB_PATH, JOB_WORKERS, JOB_MAX_QUEUE_DEPTH, JOB_RESULT_TTL, JOB_LEASE_SECONDS,
+    JOB_LONG_POLL_MAX, JOB_ABANDON_SECONDS, OUTPUT_DIR, EXAM_CACHE_WARM_TOP,
+    SESSION_MAX_BYTES, SESSION_TTL, SESSION_DB_PATH, ADMISSION_ENABLED, ADMISSION_POOLS,
+    ADMISSION_MAX_WAIT, ADMISSION_ADAPTIVE, ADMISSION_TARGET_LATENCY, FHIR_EXPORT_TOKEN
+)
 from soap_generator import SOAPGenerator
 from examination_recommender import ExaminationRecommender
 from drug_checker import DrugChecker
+from consolidated_generator import ConsolidatedGenerator, run_consultation
+from static_assets import StaticAssets
+from admission import AdmissionControl
+from drug_normalizer import split_drug_list
+from exam_cache import get_exam_cache, warm_from_reports
+from fhir_export import iter_ndjson, iter_records, parse_date_range, parse_resource_types, save_record
+from job_queue import FINAL_STATUSES, JobQueue, JobQueueFull
+from session_store import SESSION_FIELDS, SessionStore, StaleUpdate
+from metrics import metrics
+import prompts
+import audit_log
+import cancellation
+import model_scheduler
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -13,115 +36,420 @@ app = Flask(__name__,
             template_folder=os.path.join(BASE_DIR, 'templates'),
             static_folder=os.path.join(BASE_DIR, 'static'))
 CORS(app)
+StaticAssets(app, compress_min_size=COMPRESS_MIN_SIZE)
+# 过载时按路由分组快速拒绝，保证健康检查和页面仍能响应
+admission = AdmissionControl(app, ADMISSION_POOLS, ADMISSION_MAX_WAIT, ADMISSION_ADAPTIVE,
+                             ADMISSION_TARGET_LATENCY) if ADMISSION_ENABLED else None
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25, 'max_message_size': LIVE_MAX_MESSAGE_BYTES}
+sock = Sock(app)
 
 soap_generator = None
 exam_recommender = None
 drug_checker = None
+consolidated_generator = None
+speech_to_text = None
+components_lock = threading.Lock()
+draining = False
 
 def init_components():
-    global soap_generator, exam_recommender, drug_checker
+    global soap_generator, exam_recommender, drug_checker, consolidated_generator
+    if soap_generator is not None:
+        return
+    with components_lock:
+        if soap_generator is None:
+            try:
+                exam_recommender = ExaminationRecommender(GOOGLE_API_KEY, GEMINI_MODEL)
+                drug_checker = DrugChecker(GOOGLE_API_KEY, GEMINI_MODEL)
+                consolidated_generator = ConsolidatedGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
+                soap_generator = SOAPGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
+                prompts.use_token_counter(soap_generator.model.count_tokens)
+            except Exception as e:
+                print(f"AI 组件初始化失败: {e}")
+
+def preload_models():
+    """提前导入 SDK 并创建模型客户端（explicit 模式下同时创建缓存内容），避免第一个请求承担加载时间"""
+    init_components()
     if soap_generator is None:
-        try:
-            soap_generator = SOAPGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
-            exam_recommender = ExaminationRecommender(GOOGLE_API_KEY, GEMINI_MODEL)
-            drug_checker = DrugChecker(GOOGLE_API_KEY, GEMINI_MODEL)
-        except Exception as e:
-            print(f"AI 组件初始化失败: {e}")
+        return
+    # 首次判断共享指令是否足够长时会实测 token 数，放在启动时而不是第一个请求上
+    instruction = prompts.SHARED_INSTRUCTION if prompts.shared_prefix_enabled() else None
+    for component in (soap_generator, exam_recommender, drug_checker, consolidated_generator):
+        component.model.load(system_instruction=instruction)
+
+def components_ready():
+    """组件已创建即可接收请求；模型客户端在 preload_models 或第一次调用时创建"""
+    components = (soap_generator, exam_recommender, drug_checker, consolidated_generator)
+    return all(component is not None for component in components)
+
+def begin_drain():
+    """进入排空状态：就绪探针返回 503，负载均衡器停止分配新请求"""
+    global draining
+    draining = True
+
+def get_speech_to_text():
+    global speech_to_text
+    if speech_to_text is None:
+        # 音频依赖只在使用实时转录时加载
+        from speech_to_text import SpeechToText
+        speech_to_text = SpeechToText(google_api_key=GOOGLE_API_KEY)
+    return speech_to_text
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    response = make_response(render_template('index.html'))
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/health')
 def health():
     return jsonify({'status': 'ok'})
 
+@app.route('/health/live')
+def health_live():
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/health/ready')
+def health_ready():
+    if draining:
+        return jsonify({'status': 'draining'}), 503
+    if not components_ready():
+        return jsonify({'status': 'initializing'}), 503
+    return jsonify({'status': 'ready'})
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': '页面未找到'}), 404
 
-@app.route('/api/generate-soap', methods=['POST'])
-def generate_soap():
+@sock.route('/ws/consultation')
+def consultation_ws(ws):
+    from live_transcription import LiveTranscriptionSession
+    LiveTranscriptionSession(ws, get_speech_to_text()).run()
+
+class APIError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def run_api(handler, data):
+    # 客户端断开后停止仍在进行的模型调用，不再为没人接收的结果占用线程和配额
+    probe = cancellation.client_disconnect_probe(request.environ)
+    token = cancellation.CancelToken(probe) if probe else None
     try:
-        init_components()
-        if soap_generator is None:
-            return jsonify({'error': 'AI 组件未初始化'}), 500
-        
-        data = request.json
-        consultation_transcript = data.get('transcript', '')
-        patient_info = data.get('patient_info', {})
-        
-        if not consultation_transcript:
-            return jsonify({'error': '问诊记录不能为空'}), 400
-        
-        soap_data = soap_generator.generate_soap(consultation_transcript, patient_info)
-        return jsonify({'success': True, 'data': soap_data})
+        with model_scheduler.flow(request.remote_addr), \
+                audit_log.context(session_id=data.get('session_id'), client=request.remote_addr,
+                                  patient_id=(data.get('patient_info') or {}).get('patient_id')):
+            if token is None:
+                return jsonify(handler(data))
+            with cancellation.scope(token):
+                return jsonify(handler(data))
+    except cancellation.Cancelled as e:
+        metrics.inc('requests_cancelled_total', endpoint=request.endpoint, reason=e.reason)
+        return jsonify({'success': False, 'error': '请求已取消'}), 499
+    except APIError as e:
+        return jsonify({'error': e.message}), e.status
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# 问诊会话：客户端只需上传一次转录文本，之后各阶段的请求只带会话 ID
+session_store = SessionStore(SESSION_MAX_BYTES, SESSION_TTL, SESSION_DB_PATH or None)
+
+class SessionNotFound(APIError):
+    def __init__(self):
+        super().__init__('会话不存在或已过期', 404)
+
+def load_session(data):
+    session_id = data.get('session_id')
+    if not session_id:
+        return None
+    session = session_store.get(session_id)
+    if session is None:
+        raise SessionNotFound()
+    audit_log.annotate(patient_id=(session.get('patient_info') or {}).get('patient_id'))
+    return session
+
+def save_results(session, **fields):
+    """把模型结果写回读取时的会话；模型调用期间输入被修改（如转录文本更新）时丢弃这次结果"""
+    if session is None:
+        return
+    try:
+        session_store.update(session['id'], read=session, **fields)
+    except StaleUpdate:
+        pass
+
+def session_value(data, session, key, session_key=None, default=None):
+    """请求中显式给出的值优先，否则取会话中保存的值"""
+    value = data.get(key)
+    if not value and session is not None:
+        value = session.get(session_key or key)
+    return value if value else default
+
+def run_generate_soap(data):
+    init_components()
+    if soap_generator is None:
+        raise APIError('AI 组件未初始化', 500)
+    
+    session = load_session(data)
+    consultation_transcript = session_value(data, session, 'transcript', default='')
+    patient_info = session_value(data, session, 'patient_info', default={})
+    
+    if not consultation_transcript:
+        raise APIError('问诊记录不能为空')
+    
+    if generation_mode(data) == 'consolidated':
+        # 检查推荐和药物列表随 SOAP 一起生成，存入会话，后续两个阶段不再调用模型
+        combined = consolidated_generator.generate(consultation_transcript, patient_info)
+        soap_data = combined['soap']
+        if 'error' not in soap_data:
+            save_results(session, soap=soap_data, examinations=combined['examinations'],
+                         medications=combined['prescribed_drugs'])
+        return {'success': True, 'data': soap_data}
+    
+    soap_data = soap_generator.generate_soap(consultation_transcript, patient_info)
+    if 'error' not in soap_data:
+        save_results(session, soap=soap_data)
+    return {'success': True, 'data': soap_data}
+
+def generation_mode(data):
+    mode = data.get('mode') or GENERATION_MODE
+    if mode not in ('sequential', 'consolidated'):
+        raise APIError(f'不支持的生成模式: {mode}')
+    return mode
+
+def run_recommend_examinations(data):
+    init_components()
+    if exam_recommender is None:
+        raise APIError('AI 组件未初始化', 500)
+    
+    session = load_session(data)
+    soap_data = session_value(data, session, 'soap_data', 'soap', default={})
+    consultation_transcript = session_value(data, session, 'transcript', default='')
+    patient_info = session_value(data, session, 'patient_info', default={})
+    
+    if not soap_data:
+        raise APIError('SOAP 数据不能为空')
+    
+    # 合并模式下已随 SOAP 生成
+    if session is not None and session.get('examinations') is not None and not data.get('soap_data'):
+        return {'success': True, 'data': session['examinations']}
+    
+    examinations = exam_recommender.recommend_examinations(soap_data, consultation_transcript, patient_info)
+    save_results(session, examinations=examinations)
+    return {'success': True, 'data': examinations}
+
+def run_check_drug_conflicts(data):
+    init_components()
+    if drug_checker is None:
+        raise APIError('AI 组件未初始化', 500)
+    
+    session = load_session(data)
+    plan_text = data.get('plan_text') or ((session or {}).get('soap') or {}).get('plan', '')
+    patient_info = session_value(data, session, 'patient_info', default={})
+    
+    if not plan_text:
+        raise APIError('治疗计划不能为空')
+    
+    if session is not None and session.get('medications') is not None and not data.get('plan_text'):
+        prescribed_drugs = session['medications']
+    else:
+        prescribed_drugs = drug_checker.extract_drugs_from_plan(plan_text)
+    
+    if not prescribed_drugs:
+        result = {'has_conflicts': False, 'message': '未在治疗计划中发现药物'}
+        save_results(session, drug_check={'prescribed_drugs': [], 'results': result})
+        return {
+            'success': True,
+            'data': result
+        }
+    
+    allergies = split_drug_list(patient_info.get('allergies'))
+    current_meds = split_drug_list(patient_info.get('current_medications'))
+    
+    check_results = drug_checker.check_drug_conflicts(
+        prescribed_drugs=prescribed_drugs,
+        patient_allergies=allergies if allergies else None,
+        current_medications=current_meds if current_meds else None,
+        medical_history=patient_info.get('medical_history')
+    )
+    save_results(session, medications=prescribed_drugs, drug_check={
+        'prescribed_drugs': prescribed_drugs,
+        'results': check_results
+    })
+    
+    return {
+        'success': True,
+        'data': check_results,
+        'prescribed_drugs': prescribed_drugs
+    }
+
+@app.route('/api/generate-soap', methods=['POST'])
+def generate_soap():
+    return run_api(run_generate_soap, request.json)
+
 @app.route('/api/recommend-examinations', methods=['POST'])
 def recommend_examinations():
-    try:
-        init_components()
-        if exam_recommender is None:
-            return jsonify({'error': 'AI 组件未初始化'}), 500
-        
-        data = request.json
-        soap_data = data.get('soap_data', {})
-        consultation_transcript = data.get('transcript', '')
-        
-        if not soap_data:
-            return jsonify({'error': 'SOAP 数据不能为空'}), 400
-        
-        examinations = exam_recommender.recommend_examinations(soap_data, consultation_transcript)
-        return jsonify({'success': True, 'data': examinations})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+    return run_api(run_recommend_examinations, request.json)
 
 @app.route('/api/check-drug-conflicts', methods=['POST'])
 def check_drug_conflicts():
+    return run_api(run_check_drug_conflicts, request.json)
+
+def run_full_consultation(data):
+    """一次请求完成全部阶段，返回 SOAP、检查推荐、处方药物和冲突检查结果"""
+    init_components()
+    if soap_generator is None:
+        raise APIError('AI 组件未初始化', 500)
+    
+    session = load_session(data)
+    consultation_transcript = session_value(data, session, 'transcript', default='')
+    patient_info = session_value(data, session, 'patient_info', default={})
+    if not consultation_transcript:
+        raise APIError('问诊记录不能为空')
+    
+    consolidated = consolidated_generator if generation_mode(data) == 'consolidated' else None
+    result = run_consultation(consultation_transcript, patient_info, soap_generator,
+                              exam_recommender, drug_checker, consolidated)
+    if 'error' not in result['soap']:
+        save_results(session, soap=result['soap'], examinations=result['examinations'],
+                     medications=result['prescribed_drugs'],
+                     drug_check={'prescribed_drugs': result['prescribed_drugs'],
+                                 'results': result['drug_check']} if result['drug_check'] else None)
+    return {'success': True, 'data': result}
+
+def run_warm_exam_cache(data):
+    # 报告目录固定为 OUTPUT_DIR，不接受客户端指定的路径
+    summary = warm_from_reports(get_exam_cache(), OUTPUT_DIR, int(data.get('top', EXAM_CACHE_WARM_TOP)))
+    return {'success': True, 'data': summary}
+
+def job_handler(handler):
+    # 任务在后台线程执行，按提交任务的客户端参与模型调度的公平队列
+    def run(payload):
+        client = payload.pop('_flow', 'default')
+        with model_scheduler.flow(client), audit_log.context(session_id=payload.get('session_id'), client=client):
+            try:
+                return handler(payload)
+            except SessionNotFound as e:
+                # 作为正常结果返回，客户端据此重新建立会话后重试
+                return {'success': False, 'error': e.message, 'session_expired': True}
+    return run
+
+# 后台任务：提交后立即返回任务 ID，客户端轮询或订阅结果，避免长连接被代理超时中断
+job_queue = JobQueue(
+    JOBS_DB_PATH,
+    handlers={
+        'generate-soap': job_handler(run_generate_soap),
+        'recommend-examinations': job_handler(run_recommend_examinations),
+        'check-drug-conflicts': job_handler(run_check_drug_conflicts),
+        'consultation': job_handler(run_full_consultation),
+        'warm-exam-cache': run_warm_exam_cache,
+    },
+    workers=JOB_WORKERS,
+    max_depth=JOB_MAX_QUEUE_DEPTH,
+    result_ttl=JOB_RESULT_TTL,
+    lease_seconds=JOB_LEASE_SECONDS,
+    abandon_seconds=JOB_ABANDON_SECONDS,
+)
+
+@app.before_request
+def start_background_workers():
+    job_queue.start()
+
+SESSION_INPUTS = ('patient_info', 'transcript')
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    data = request.json or {}
+    # 创建时允许带上客户端已有的 SOAP 病历，用于会话过期后恢复
+    session = session_store.create(**{key: data.get(key) for key in SESSION_INPUTS + ('soap',)})
+    return jsonify({'success': True, 'session_id': session['id'], 'version': session['version']}), 201
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    session = session_store.get(session_id)
+    if session is None:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    return jsonify(session)
+
+@app.route('/api/sessions/<session_id>', methods=['PATCH'])
+def update_session(session_id):
+    data = request.json or {}
+    session = session_store.update(session_id, **{key: data[key] for key in SESSION_INPUTS if key in data})
+    if session is None:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    return jsonify({'success': True, 'session_id': session_id, 'version': session['version']})
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not session_store.delete(session_id):
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    return jsonify({'success': True})
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    data = request.json or {}
+    payload = dict(data.get('payload') or {}, _flow=request.remote_addr)
     try:
-        init_components()
-        if drug_checker is None:
-            return jsonify({'error': 'AI 组件未初始化'}), 500
-        
-        data = request.json
-        plan_text = data.get('plan_text', '')
-        patient_info = data.get('patient_info', {})
-        
-        if not plan_text:
-            return jsonify({'error': '治疗计划不能为空'}), 400
-        
-        prescribed_drugs = drug_checker.extract_drugs_from_plan(plan_text)
-        
-        if not prescribed_drugs:
-            return jsonify({
-                'success': True,
-                'data': {'has_conflicts': False, 'message': '未在治疗计划中发现药物'}
-            })
-        
-        allergies = []
-        if patient_info.get('allergies') and patient_info['allergies'] != '无':
-            allergies = [a.strip() for a in patient_info['allergies'].split(',')]
-        
-        current_meds = []
-        if patient_info.get('current_medications') and patient_info['current_medications'] != '无':
-            current_meds = [m.strip() for m in patient_info['current_medications'].split(',')]
-        
-        check_results = drug_checker.check_drug_conflicts(
-            prescribed_drugs=prescribed_drugs,
-            patient_allergies=allergies if allergies else None,
-            current_medications=current_meds if current_meds else None,
-            medical_history=patient_info.get('medical_history')
-        )
-        
-        return jsonify({
-            'success': True,
-            'data': check_results,
-            'prescribed_drugs': prescribed_drugs
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        # watch: 客户端会持续轮询，停止轮询后任务自动取消
+        job = job_queue.submit(data.get('type', ''), payload, watch=bool(data.get('watch')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except JobQueueFull as e:
+        response = jsonify({'success': False, 'error': str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    return jsonify({'success': True, **job}), 202
+
+@app.route('/api/jobs/stats')
+def job_stats():
+    return jsonify(job_queue.stats())
+
+def touch_watched(job):
+    """只有以 watch 方式提交的任务会因客户端离开而被放弃，其他任务的轮询不写数据库"""
+    if job is not None and job['watched'] and job['status'] not in FINAL_STATUSES:
+        job_queue.touch(job['job_id'])
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    wait = min(request.args.get('wait', 0, type=float), JOB_LONG_POLL_MAX)
+    job = job_queue.get(job_id)
+    touch_watched(job)
+    if job is not None and wait > 0 and job['status'] not in FINAL_STATUSES:
+        job = job_queue.wait(job_id, wait)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # 使用 POST 以便页面关闭时通过 navigator.sendBeacon 发送
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify({'success': True, **job})
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    def stream():
+        touch_watched(job_queue.get(job_id))
+        while True:
+            job = job_queue.wait(job_id, 10)
+            if job is None:
+                yield 'event: error\ndata: {"error": "任务不存在或已过期"}\n\n'
+                return
+            if job['status'] in FINAL_STATUSES:
+                yield f"event: {job['status']}\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                return
+            touch_watched(job)
+            # 心跳，防止代理因空闲断开
+            yield f": {job['status']}\n\n"
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics_snapshot():
+    return jsonify(metrics.snapshot())
 
 @app.route('/api/save-report', methods=['POST'])
 def save_report():
@@ -140,10 +468,45 @@ def save_report():
         with open(filepath, 'w', encoding='utf-8') as f:
             f.write(report_content)
         
+        record = data.get('record')
+        if data.get('session_id'):
+            session = session_store.get(data['session_id'])
+            if session is not None:
+                record = {field: session.get(field) for field in SESSION_FIELDS}
+        if record:
+            save_record(filepath, record)
+        audit_log.record('report_saved', filename=filename, session_id=data.get('session_id'),
+                         patient_id=((record or {}).get('patient_info') or {}).get('patient_id'),
+                         client=request.remote_addr, content=report_content)
+        
         return jsonify({'success': True, 'filename': filename, 'filepath': filepath})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/export/fhir', methods=['GET'])
+def export_fhir():
+    # 批量导出全部患者记录：未配置令牌时关闭，只能在服务器上用 fhir_export.py 导出
+    if not FHIR_EXPORT_TOKEN:
+        return jsonify({'error': 'FHIR 导出接口未启用'}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                               f'Bearer {FHIR_EXPORT_TOKEN}'.encode('utf-8')):
+        audit_log.record('fhir_export_denied', client=request.remote_addr)
+        return jsonify({'error': '未授权'}), 401
+    
+    try:
+        since, until = parse_date_range(request.args.get('since'), request.args.get('until'))
+        resource_types = parse_resource_types(request.args.get('types'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    records = iter_records(OUTPUT_DIR, since, until)
+    audit_log.record('fhir_export', since=request.args.get('since'), until=request.args.get('until'),
+                     types=','.join(resource_types), client=request.remote_addr)
+    response = Response(stream_with_context(iter_ndjson(records, resource_types)),
+                        mimetype='application/fhir+ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename="export.ndjson"'
+    return response
+
 if __name__ == '__main__':
     if not GOOGLE_API_KEY or GOOGLE_API_KEY == "your_google_api_key_here":
         print("警告: 未设置有效的 GOOGLE_API_KEY")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+录音压缩存储：FLAC（无损）或 Opus（语音），读取时透明解码
+
+压缩已有的 WAV 录音: python audio_codec.py recompress [--dir recordings] [--format flac]
+"""
+import argparse
+import glob
+import os
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from pydub import AudioSegment
+
+from config import RECORDINGS_DIR, RECORDING_FORMAT, RECORDING_OPUS_BITRATE, SAMPLE_RATE
+
+# speech_recognition.AudioFile 可以直接读取的格式，其余格式先经 pydub 解码
+NATIVE_FORMATS = ('.wav', '.aif', '.aiff', '.flac')
+FORMATS = {
+    'wav': ('.wav', {}),
+    'flac': ('.flac', {}),
+    # Ogg 封装的 Opus；16 kHz 单声道语音 24 kbps 已足够识别
+    'opus': ('.ogg', {'codec': 'libopus', 'parameters': ['-application', 'voip']}),
+}
+
+
+def target_path(filepath: str, fmt: str = RECORDING_FORMAT) -> str:
+    return os.path.splitext(filepath)[0] + FORMATS[fmt][0]
+
+
+def encode_segment(segment: AudioSegment, filepath: str, fmt: str = RECORDING_FORMAT,
+                   fallback: bool = True) -> str:
+    """编码写入，返回实际路径；编码器（ffmpeg）不可用时退回 WAV"""
+    path = target_path(filepath, fmt)
+    if fmt == 'wav':
+        segment.export(path, format='wav')
+        return path
+    _, options = FORMATS[fmt]
+    kwargs = dict(options)
+    if fmt == 'opus':
+        kwargs['bitrate'] = RECORDING_OPUS_BITRATE
+    tmp_path = f"{path}.tmp"
+    try:
+        segment.export(tmp_path, format='ogg' if fmt == 'opus' else fmt, **kwargs)
+        os.replace(tmp_path, path)
+        return path
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if not fallback:
+            raise
+        print(f"录音压缩失败（{fmt}），改存为 WAV: {e}")
+        return encode_segment(segment, filepath, 'wav')
+
+
+def encode_pcm(pcm: bytes, filepath: str, sample_rate: int = SAMPLE_RATE, sample_width: int = 2,
+               channels: int = 1, fmt: str = RECORDING_FORMAT) -> str:
+    segment = AudioSegment(data=pcm, sample_width=sample_width, frame_rate=sample_rate, channels=channels)
+    return encode_segment(segment, filepath, fmt)
+
+
+def decode_to_pcm(filepath: str, sample_rate: int = SAMPLE_RATE) -> Tuple[bytes, int, int]:
+    """解码任意格式的录音为单声道 16-bit PCM，返回 (PCM, 采样率, 采样宽度)"""
+    segment = AudioSegment.from_file(filepath)
+    segment = segment.set_channels(1).set_sample_width(2).set_frame_rate(sample_rate)
+    return segment.raw_data, sample_rate, 2
+
+
+def recompress_file(wav_path: str, fmt: str, keep_original: bool = False) -> Tuple[int, int]:
+    """把一个 WAV 文件压缩为目标格式，校验时长后删除原文件；返回 (原大小, 压缩后大小)"""
+    with wave.open(wav_path, 'rb') as wf:
+        frames = wf.getnframes()
+        rate = wf.getframerate()
+    segment = AudioSegment.from_wav(wav_path)
+    path = encode_segment(segment, wav_path, fmt, fallback=False)
+
+    decoded = AudioSegment.from_file(path)
+    # Opus 有编码器延迟，允许 100 毫秒误差；FLAC 应当逐样本一致
+    if abs(len(decoded) - frames * 1000 / rate) > 100 or (fmt == 'flac' and decoded.raw_data != segment.raw_data):
+        os.remove(path)
+        raise ValueError(f"校验失败: {path}")
+
+    original_size = os.path.getsize(wav_path)
+    if not keep_original:
+        os.remove(wav_path)
+    return original_size, os.path.getsize(path)
+
+
+def recompress_archive(directory: str = RECORDINGS_DIR, fmt: str = 'flac', workers: int = 2,
+                       keep_original: bool = False):
+    paths = [p for p in sorted(glob.glob(os.path.join(directory, '**', '*.wav'), recursive=True))
+             if not os.path.exists(target_path(p, fmt))]
+    totals = [0, 0]
+    lock = threading.Lock()
+
+    def run(path):
+        try:
+            sizes = recompress_file(path, fmt, keep_original)
+        except Exception as e:
+            print(f"跳过 {path}: {e}")
+            return
+        with lock:
+            totals[0] += sizes[0]
+            totals[1] += sizes[1]
+            print(f"{path}: {sizes[0] / 1024:.0f} KB -> {sizes[1] / 1024:.0f} KB")
+
+    # 编码在 ffmpeg 子进程中进行，线程只负责等待
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run, paths))
+    return len(paths), totals[0], totals[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="录音压缩")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    recompress = subparsers.add_parser('recompress', help='把已有的 WAV 录音压缩为 FLAC/Opus')
+    recompress.add_argument('--dir', default=RECORDINGS_DIR)
+    recompress.add_argument('--format', choices=('flac', 'opus'), default='flac')
+    recompress.add_argument('--workers', type=int, default=2)
+    recompress.add_argument('--keep-wav', action='store_true', help='保留原 WAV 文件')
+    args = parser.parse_args()
+
+    if args.command == 'recompress':
+        # 后台批处理，降低优先级避免影响在线服务
+        if hasattr(os, 'nice'):
+            os.nice(10)
+        count, before, after = recompress_archive(args.dir, args.format, args.workers, args.keep_wav)
+        ratio = f"，压缩比 {before / after:.1f}x" if after else ''
+        print(f"处理 {count} 个文件，{before / 1048576:.1f} MB -> {after / 1048576:.1f} MB{ratio}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+识别前的音频预处理：帧能量 + 过零率 VAD、去除静音、增益归一化、重采样
+
+全部为 NumPy 向量化运算，一小时 16 kHz 音频的处理在一秒以内。
+去掉静音后的音频与原始音频之间的时间对应关系保存在 TimeMap 中。
+"""
+from bisect import bisect_right
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from config import (
+    SAMPLE_RATE, VAD_FRAME_MS, VAD_ENERGY_MARGIN_DB, VAD_HANGOVER_MS,
+    VAD_MIN_SILENCE_MS, ASR_TARGET_DBFS
+)
+
+# 清辅音（s、sh、f 等）能量低但过零率高，能量略高于噪声底即可算作语音
+FRICATIVE_ZCR = (0.25, 0.7)
+FRICATIVE_MARGIN_DB = 3.0
+SPEECH_DYNAMIC_RANGE_DB = 25.0
+SILENCE_DBFS = -60.0
+MAX_GAIN_DB = 20.0
+PEAK_LIMIT = 0.95
+
+
+class TimeMap:
+    """去除静音后的时间到原始录音时间的映射
+
+    spans 为 (输出起点, 原始起点, 长度) 的列表，单位为秒，按输出起点排序。
+    """
+
+    def __init__(self, spans: List[Tuple[float, float, float]]):
+        self.spans = spans
+        self._starts = [span[0] for span in spans]
+
+    def to_original(self, t: float) -> float:
+        if not self.spans:
+            return t
+        i = max(0, bisect_right(self._starts, t) - 1)
+        out_start, orig_start, length = self.spans[i]
+        return orig_start + min(max(t - out_start, 0.0), length)
+
+    @property
+    def kept_seconds(self) -> float:
+        return sum(span[2] for span in self.spans)
+
+
+class PreprocessResult(NamedTuple):
+    pcm: bytes
+    sample_rate: int
+    time_map: TimeMap
+    original_seconds: float
+    kept_seconds: float
+
+
+def pcm_to_float(pcm: bytes, sample_width: int = 2, channels: int = 1) -> np.ndarray:
+    if sample_width == 3:
+        # 24 位样本放到 int32 的高 3 字节，按 32 位缩放
+        raw = np.frombuffer(pcm, dtype=np.uint8)
+        padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = raw[:len(raw) // 3 * 3].reshape(-1, 3)
+        pcm, sample_width = padded.tobytes(), 4
+    if sample_width not in (1, 2, 4):
+        raise ValueError(f"不支持的采样位宽: {sample_width} 字节")
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[sample_width]
+    samples = np.frombuffer(pcm, dtype=dtype).astype(np.float32)
+    if sample_width == 1:
+        samples -= 128.0
+        scale = 128.0
+    else:
+        scale = float(2 ** (8 * sample_width - 1))
+    samples *= np.float32(1.0 / scale)
+    if channels > 1:
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def float_to_pcm16(samples: np.ndarray) -> bytes:
+    scaled = np.clip(samples, -1.0, 1.0)
+    scaled *= 32767
+    return scaled.astype(np.int16).tobytes()
+
+
+def resample(samples: np.ndarray, src_rate: int, dst_rate: int) -> np.ndarray:
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    if dst_rate < src_rate:
+        # 降采样前做滑动平均低通，抑制混叠
+        width = int(round(src_rate / dst_rate))
+        if width > 1:
+            cumsum = np.cumsum(np.concatenate(([0.0], samples)), dtype=np.float64)
+            smoothed = (cumsum[width:] - cumsum[:-width]) / width
+            samples = np.concatenate((smoothed, np.full(width - 1, smoothed[-1] if len(smoothed) else 0.0)))
+    n_out = int(len(samples) * dst_rate / src_rate)
+    positions = np.arange(n_out, dtype=np.float64) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def frame_features(samples: np.ndarray, frame_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """每帧的能量（dBFS）和过零率"""
+    n_frames = len(samples) // frame_len
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    energy = np.einsum('ij,ij->i', frames, frames) / frame_len
+    energy_db = 10 * np.log10(energy + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_len - 1)
+    return energy_db, zcr
+
+
+def _dilate(mask: np.ndarray, radius: int) -> np.ndarray:
+    if radius <= 0:
+        return mask
+    return np.convolve(mask.astype(np.int32), np.ones(2 * radius + 1, np.int32), mode='same') > 0
+
+
+def _runs(mask: np.ndarray) -> List[Tuple[int, int]]:
+    """mask 中连续为 True 的区间 [start, end)"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_speech(samples: np.ndarray, sample_rate: int, frame_ms: int = VAD_FRAME_MS,
+                  margin_db: float = VAD_ENERGY_MARGIN_DB, hangover_ms: int = VAD_HANGOVER_MS,
+                  min_silence_ms: int = VAD_MIN_SILENCE_MS) -> List[Tuple[int, int]]:
+    """返回语音区间（采样点下标 [start, end)）"""
+    frame_len = max(1, sample_rate * frame_ms // 1000)
+    energy_db, zcr = frame_features(samples, frame_len)
+    if len(energy_db) == 0:
+        return []
+
+    # 噪声底取能量的低分位数，阈值随录音环境自适应；
+    # 整段几乎都是语音时低分位数本身就是语音，阈值不能高于响亮部分减去 SPEECH_DYNAMIC_RANGE_DB
+    noise_floor, loud = np.percentile(energy_db, [10, 90])
+    threshold = max(min(noise_floor + margin_db, loud - SPEECH_DYNAMIC_RANGE_DB), SILENCE_DBFS)
+    speech = energy_db > threshold
+    speech |= ((energy_db > min(noise_floor + FRICATIVE_MARGIN_DB, threshold))
+               & (zcr > FRICATIVE_ZCR[0]) & (zcr < FRICATIVE_ZCR[1]))
+    # 前后各延长 hangover，避免截掉字头字尾
+    speech = _dilate(speech, hangover_ms // frame_ms)
+
+    # 短于 min_silence 的停顿保留（句中停顿对识别断句有用）
+    runs = _runs(speech)
+    min_gap = min_silence_ms // frame_ms
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] < min_gap:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    total = len(samples)
+    return [(int(start) * frame_len, min(int(end) * frame_len, total)) for start, end in merged]
+
+
+def normalize_gain(samples: np.ndarray, target_dbfs: float = ASR_TARGET_DBFS,
+                   max_gain_db: float = MAX_GAIN_DB) -> np.ndarray:
+    if len(samples) == 0:
+        return samples
+    rms = float(np.sqrt(np.dot(samples, samples) / len(samples)))
+    if rms < 1e-6:
+        return samples
+    gain_db = min(target_dbfs - 20 * np.log10(rms), max_gain_db)
+    gain = 10 ** (gain_db / 20)
+    peak = float(np.max(np.abs(samples)))
+    # 峰值不超过 PEAK_LIMIT，避免削波
+    if peak * gain > PEAK_LIMIT:
+        gain = PEAK_LIMIT / peak
+    samples *= np.float32(gain)
+    return samples
+
+
+def preprocess_pcm(pcm: bytes, sample_rate: int, sample_width: int = 2, channels: int = 1,
+                   target_rate: int = SAMPLE_RATE) -> PreprocessResult:
+    """PCM -> 单声道、target_rate、去静音、增益归一化的 16-bit PCM"""
+    samples = resample(pcm_to_float(pcm, sample_width, channels), sample_rate, target_rate)
+    original_seconds = len(samples) / target_rate
+
+    regions = detect_speech(samples, target_rate)
+    spans = []
+    offset = 0
+    for start, end in regions:
+        spans.append((offset / target_rate, start / target_rate, (end - start) / target_rate))
+        offset += end - start
+    kept = np.concatenate([samples[start:end] for start, end in regions]) if regions else samples[:0]
+
+    kept = normalize_gain(kept)
+    return PreprocessResult(float_to_pcm16(kept), target_rate, TimeMap(spans),
+                            original_seconds, len(kept) / target_rate)
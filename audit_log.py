@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+审计日志：记录每次模型调用、报告保存和数据导出
+
+请求路径上只把记录放入内存队列（微秒级），由后台线程批量写入分段文件：
+- 每批压缩为一个独立的 gzip 成员追加到当前分段，分段文件始终是可读的 gzip（多成员）
+- 每 AUDIT_FSYNC_INTERVAL 秒 fsync 一次；分段超过大小或时长后轮换
+- 提示词、模型输出、报告内容只保存 SHA-256，哈希在后台线程中计算
+- 队列有上限，写满时按 AUDIT_OVERFLOW 处理：block（限时等待，超时丢弃）、drop_new、drop_oldest，
+  丢弃数量记入 audit_dropped_total
+
+查询: python audit_log.py query [--since 2024-05-01] [--event model_call] [--stage soap] [--session ID]
+统计: python audit_log.py stats [--since ...]
+"""
+import argparse
+import atexit
+import contextvars
+import glob
+import gzip
+import hashlib
+import json
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+from config import (
+    AUDIT_ENABLED, AUDIT_DIR, AUDIT_BUFFER_SIZE, AUDIT_OVERFLOW, AUDIT_BLOCK_TIMEOUT,
+    AUDIT_FLUSH_INTERVAL, AUDIT_FSYNC_INTERVAL, AUDIT_SEGMENT_BYTES, AUDIT_SEGMENT_SECONDS
+)
+from metrics import metrics
+
+OVERFLOW_POLICIES = ('block', 'drop_new', 'drop_oldest')
+# 这些字段写入前替换为 <字段>_sha256
+HASHED_FIELDS = ('prompt', 'result', 'content')
+SEGMENT_PREFIX = 'audit-'
+SEGMENT_SUFFIX = '.jsonl.gz'
+BATCH_SIZE = 500
+
+# 当前请求 / 任务关联的会话、患者等标识，自动附加到审计记录
+_context = contextvars.ContextVar('audit_context', default=None)
+
+
+@contextmanager
+def context(**fields):
+    merged = dict(_context.get() or {}, **{k: v for k, v in fields.items() if v})
+    token = _context.set(merged)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def annotate(**fields):
+    """在当前 context() 范围内补充标识（例如读取会话后才知道的患者 ID）
+
+    直接补进该范围的字典，随范围结束一起失效；不在任何 context() 范围内时不生效。
+    """
+    current = _context.get()
+    if current is not None:
+        current.update({k: v for k, v in fields.items() if v})
+
+
+def sha256(value) -> Optional[str]:
+    if value is None:
+        return None
+    if not isinstance(value, (str, bytes)):
+        value = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return hashlib.sha256(value).hexdigest()
+
+
+class AuditLog:
+    def __init__(self, directory: str = AUDIT_DIR, buffer_size: int = AUDIT_BUFFER_SIZE,
+                 overflow: str = AUDIT_OVERFLOW, block_timeout: float = AUDIT_BLOCK_TIMEOUT,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL, fsync_interval: float = AUDIT_FSYNC_INTERVAL,
+                 segment_bytes: int = AUDIT_SEGMENT_BYTES, segment_seconds: float = AUDIT_SEGMENT_SECONDS):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"不支持的审计日志溢出策略: {overflow}")
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+
+        self._buffer: deque = deque()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._file = None
+        self._segment_started = 0.0
+        self._segment_seq = 0
+        self._last_fsync = 0.0
+        self._dirty = False
+
+        metrics.gauge('audit_buffer_depth', lambda: len(self._buffer))
+
+    def _ensure_writer(self):
+        # gunicorn 在 fork 前预加载应用，写线程不能在 master 中启动后被子进程继承
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._buffer.clear()
+            self._file = None
+            self._thread = threading.Thread(target=self._writer_loop, name='audit-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def record(self, event: str, **fields) -> bool:
+        """放入写入队列；被溢出策略丢弃时返回 False"""
+        self._ensure_writer()
+        entry = (time.time(), event, dict(_context.get() or {}), fields)
+        with self._cond:
+            if len(self._buffer) >= self.buffer_size:
+                if self.overflow == 'drop_oldest':
+                    self._buffer.popleft()
+                    metrics.inc('audit_dropped_total', policy=self.overflow)
+                elif self.overflow == 'drop_new' or not self._wait_for_space():
+                    metrics.inc('audit_dropped_total', policy=self.overflow)
+                    return False
+            self._buffer.append(entry)
+            if len(self._buffer) == BATCH_SIZE:
+                self._cond.notify_all()
+        return True
+
+    def _wait_for_space(self) -> bool:
+        deadline = time.monotonic() + self.block_timeout
+        self._cond.notify_all()
+        while len(self._buffer) >= self.buffer_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        return True
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                if len(self._buffer) < BATCH_SIZE and not self._closed:
+                    self._cond.wait(self.flush_interval)
+                batch = list(self._buffer)
+                self._buffer.clear()
+                # 唤醒因队列满而等待的请求
+                self._cond.notify_all()
+                closed = self._closed
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    metrics.inc('audit_write_errors_total')
+                    metrics.inc('audit_dropped_total', len(batch), policy='write_error')
+                    print(f"审计日志写入失败: {e}")
+            self._maybe_fsync(force=closed)
+            if closed:
+                return
+
+    @staticmethod
+    def _serialize(entry) -> str:
+        ts, event, ctx, fields = entry
+        record = {'ts': datetime.fromtimestamp(ts).isoformat(timespec='milliseconds'), 'event': event}
+        record.update(ctx)
+        for key, value in fields.items():
+            if key in HASHED_FIELDS:
+                record[f"{key}_sha256"] = sha256(value)
+            elif value is not None:
+                record[key] = value
+        return json.dumps(record, ensure_ascii=False, default=str)
+
+    def _write(self, batch: List):
+        start = time.monotonic()
+        data = gzip.compress(('\n'.join(self._serialize(e) for e in batch) + '\n').encode('utf-8'),
+                             compresslevel=6, mtime=0)
+        self._rotate_if_needed(len(data))
+        self._file.write(data)
+        self._file.flush()
+        self._dirty = True
+        metrics.inc('audit_records_total', len(batch))
+        metrics.observe('audit_write_seconds', time.monotonic() - start)
+
+    def _rotate_if_needed(self, incoming: int):
+        now = time.time()
+        if self._file is not None:
+            too_big = self._file.tell() + incoming > self.segment_bytes
+            too_old = now - self._segment_started > self.segment_seconds
+            if not (too_big or too_old):
+                return
+            self._maybe_fsync(force=True)
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        # 文件名按时间排序；同一秒内多次轮换时靠序号区分
+        self._segment_seq += 1
+        stamp = datetime.fromtimestamp(now).strftime('%Y%m%d_%H%M%S')
+        name = f"{SEGMENT_PREFIX}{stamp}-{os.getpid()}-{self._segment_seq:04d}{SEGMENT_SUFFIX}"
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._segment_started = now
+
+    def _maybe_fsync(self, force: bool = False):
+        if self._file is None or not self._dirty:
+            return
+        now = time.monotonic()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+            self._dirty = False
+
+    def close(self):
+        """写完队列中剩余的记录并 fsync（进程退出时自动调用）"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=10)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _NullAuditLog:
+    def record(self, event: str, **fields) -> bool:
+        return True
+
+
+_audit_log = None
+_audit_lock = threading.Lock()
+
+
+def get_audit_log():
+    global _audit_log
+    if _audit_log is None:
+        with _audit_lock:
+            if _audit_log is None:
+                _audit_log = AuditLog() if AUDIT_ENABLED else _NullAuditLog()
+    return _audit_log
+
+
+def record(event: str, **fields) -> bool:
+    return get_audit_log().record(event, **fields)
+
+
+def iter_segments(directory: str = AUDIT_DIR) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}")))
+
+
+def iter_entries(directory: str = AUDIT_DIR, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, **filters) -> Iterator[Dict]:
+    """按时间范围和字段值（event、stage、session_id ...）筛选记录
+
+    写入中的分段最后一批可能不完整（进程崩溃），读到截断处即停止。
+    """
+    since_text = since.isoformat(timespec='milliseconds') if since else None
+    until_text = until.isoformat(timespec='milliseconds') if until else None
+    filters = {k: v for k, v in filters.items() if v is not None}
+    for path in iter_segments(directory):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if since_text and entry['ts'] < since_text:
+                        continue
+                    if until_text and entry['ts'] > until_text:
+                        continue
+                    if all(str(entry.get(k)) == str(v) for k, v in filters.items()):
+                        yield entry
+        except (EOFError, OSError, gzip.BadGzipFile):
+            continue
+
+
+def summarize(entries) -> Dict[str, Dict]:
+    """按事件和阶段汇总次数、token 用量与耗时"""
+    groups: Dict[str, Dict] = {}
+    for entry in entries:
+        key = entry['event'] + (f"/{entry['stage']}" if entry.get('stage') else '')
+        group = groups.setdefault(key, {'count': 0, 'tokens': 0, 'errors': 0, 'latency': []})
+        group['count'] += 1
+        group['tokens'] += entry.get('total_tokens') or 0
+        if entry.get('status') not in (None, 'ok'):
+            group['errors'] += 1
+        if entry.get('latency') is not None:
+            group['latency'].append(entry['latency'])
+    for group in groups.values():
+        latency = sorted(group.pop('latency'))
+        group['latency_p50'] = round(statistics.median(latency), 3) if latency else None
+        group['latency_p95'] = round(latency[int(0.95 * (len(latency) - 1))], 3) if latency else None
+    return groups
+
+
+def main():
+    from fhir_export import parse_date_range
+
+    parser = argparse.ArgumentParser(description="审计日志查询")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('query', '输出匹配的记录（JSON Lines）'), ('stats', '按事件和阶段汇总')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('--dir', default=AUDIT_DIR)
+        sub.add_argument('--since', help='起始日期或时间，如 2024-05-01')
+        sub.add_argument('--until', help='结束日期（含）或时间')
+        sub.add_argument('--event', help='model_call、report_saved、fhir_export ...')
+        sub.add_argument('--stage')
+        sub.add_argument('--model')
+        sub.add_argument('--session', dest='session_id')
+        sub.add_argument('--patient', dest='patient_id')
+    args = parser.parse_args()
+
+    try:
+        since, until = parse_date_range(args.since, args.until)
+    except ValueError as e:
+        parser.error(str(e))
+    entries = iter_entries(args.dir, since, until, event=args.event, stage=args.stage, model=args.model,
+                           session_id=args.session_id, patient_id=args.patient_id)
+
+    if args.command == 'query':
+        for entry in entries:
+            print(json.dumps(entry, ensure_ascii=False))
+    else:
+        print(f"{'事件/阶段':<28}{'次数':>8}{'失败':>6}{'token':>10}{'p50(s)':>9}{'p95(s)':>9}")
+        for key, group in sorted(summarize(entries).items()):
+            p50 = f"{group['latency_p50']:.3f}" if group['latency_p50'] is not None else '-'
+            p95 = f"{group['latency_p95']:.3f}" if group['latency_p95'] is not None else '-'
+            print(f"{key:<28}{group['count']:>8}{group['errors']:>6}{group['tokens']:>10}{p50:>9}{p95:>9}")
+
+
+if __name__ == '__main__':
+    main()
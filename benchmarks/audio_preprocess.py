@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+识别前音频预处理的性能基准
+
+合成一段语音与停顿交替的录音（或读取给定的 WAV 文件），报告预处理耗时与送去识别的时长缩减比例；
+超过耗时预算时退出码为 1。
+
+用法: python benchmarks/audio_preprocess.py [--minutes 60] [--max-seconds 1.0] [--file recording.wav]
+"""
+import argparse
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_preprocess import float_to_pcm16, preprocess_pcm  # noqa: E402
+
+
+def synthesize(minutes: float, sample_rate: int = 16000, seed: int = 0) -> bytes:
+    """2-6 秒的调幅谐波“语音”与 1-4 秒的低电平噪声交替"""
+    rng = np.random.default_rng(seed)
+    total = int(minutes * 60 * sample_rate)
+    parts = []
+    length = 0
+    while length < total:
+        n = int(rng.uniform(2, 6) * sample_rate)
+        t = np.arange(n) / sample_rate
+        envelope = 0.15 * (1 + 0.5 * np.sin(2 * np.pi * 3 * t))
+        voice = envelope * (np.sin(2 * np.pi * 180 * t) + 0.5 * np.sin(2 * np.pi * 360 * t))
+        parts.append(voice + 0.01 * rng.standard_normal(n))
+        n = int(rng.uniform(1, 4) * sample_rate)
+        parts.append(0.003 * rng.standard_normal(n))
+        length += sum(len(p) for p in parts[-2:])
+    return float_to_pcm16(np.concatenate(parts)[:total].astype(np.float32))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音频预处理基准")
+    parser.add_argument('--minutes', type=float, default=60)
+    parser.add_argument('--file', help='使用真实录音（WAV）代替合成音频')
+    parser.add_argument('--max-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.file:
+        with wave.open(args.file, 'rb') as wf:
+            pcm = wf.readframes(wf.getnframes())
+            params = (wf.getframerate(), wf.getsampwidth(), wf.getnchannels())
+    else:
+        pcm = synthesize(args.minutes)
+        params = (16000, 2, 1)
+
+    start = time.perf_counter()
+    result = preprocess_pcm(pcm, *params)
+    elapsed = time.perf_counter() - start
+
+    reduction = 1 - result.kept_seconds / result.original_seconds if result.original_seconds else 0
+    print(f"音频时长:   {result.original_seconds / 60:.1f} 分钟")
+    print(f"送去识别:   {result.kept_seconds / 60:.1f} 分钟（减少 {reduction:.0%}，{len(result.time_map.spans)} 段）")
+    print(f"处理耗时:   {elapsed:.2f} 秒（预算 {args.max_seconds:.2f} 秒）")
+    if elapsed > args.max_seconds:
+        print("\n❌ 预处理耗时超出预算")
+        sys.exit(1)
+    print("\n✅ 预处理耗时检查通过")
+
+
+if __name__ == '__main__':
+    main()
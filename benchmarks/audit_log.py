@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+审计日志写入开销基准
+
+多个线程并发调用 record()（模拟请求线程），报告单次调用的 p50 / p99 耗时和后台写入吞吐；
+p99 超过预算时退出码为 1。记录写入临时目录，结束后删除。
+
+用法: python benchmarks/audit_log.py [--threads 8] [--records 20000] [--max-p99-us 200]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audit_log import AuditLog, iter_entries  # noqa: E402
+
+PROMPT = "你是一位经验丰富的临床医生。请根据以下问诊记录生成SOAP格式的病历。" * 40
+
+
+def main():
+    parser = argparse.ArgumentParser(description="审计日志写入开销基准")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--records', type=int, default=20000, help='每个线程写入的记录数')
+    parser.add_argument('--max-p99-us', type=float, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='audit-bench-')
+    log = AuditLog(directory=directory, buffer_size=100000)
+    samples = [[] for _ in range(args.threads)]
+
+    def worker(index):
+        timings = samples[index]
+        for i in range(args.records):
+            start = time.perf_counter()
+            log.record('model_call', stage='soap', model='bench', status='ok', latency=1.234,
+                       prompt=PROMPT + str(i), result=f'{{"plan": "{i}"}}', total_tokens=1500)
+            timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.close()
+    elapsed = time.perf_counter() - start
+
+    timings = sorted(t for thread_samples in samples for t in thread_samples)
+    written = sum(1 for _ in iter_entries(directory))
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    shutil.rmtree(directory)
+
+    p50 = timings[len(timings) // 2] * 1e6
+    p99 = timings[int(len(timings) * 0.99)] * 1e6
+    print(f"record() 耗时: p50 {p50:.1f} µs, p99 {p99:.1f} µs（预算 {args.max_p99_us:.0f} µs）")
+    print(f"写入记录:     {written}/{len(timings)}，{written / elapsed:.0f} 条/秒，压缩后 {size / max(written, 1):.0f} 字节/条")
+    if p99 > args.max_p99_us or written != len(timings):
+        print("\n❌ 审计日志开销检查未通过")
+        sys.exit(1)
+    print("\n✅ 审计日志开销检查通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+配置评估：用本地语料回放完整流程，比较多组配置（模型、温度、生成模式、路由、提示词措辞）
+
+语料（--corpus，JSONL）每行一例，reference 中的各项都可省略，省略的项不参与对应指标：
+{"id": "...", "transcript": "...", "patient_info": {...},
+ "reference": {"soap": {...}, "diagnosis": [...], "drugs": [...], "examinations": [...], "has_conflicts": false}}
+
+配置（--configs，JSON 数组）每项的字段都可省略，省略时使用 config.py 的当前设置：
+{"name": "...", "model": "gemini-2.5-flash", "mode": "sequential", "routing": true, "fast_model": "...",
+ "cache_mode": "system", "temperature": {"soap": 0.3, "examinations": 0.3, "drug_extraction": 0.1,
+ "drug_check": 0.2, "consolidated": 0.3}, "instructions": {"soap": "prompts/soap_v2.txt"}}
+
+后端（--backend）：gemini 直接调用；record 调用并录制响应；replay 只用录制的响应，不联网，
+按录制耗时等待（--latency-scale）；local 使用本地替身，只用于检查流程。
+先用 record 跑一遍候选配置，之后的比较用 replay 离线进行；没有录制过的调用计为 missing，
+该配置不参与选择。
+
+报告每组配置的端到端与各阶段 p50 / p95 延迟、每例 token、JSON 合格率和与参考的一致率，
+在满足质量门槛的配置中选出端到端 p95 最低的一组；没有配置满足门槛时退出码为 1。
+
+用法: python benchmarks/evaluate.py --corpus eval.jsonl [--configs configs.json] [--backend replay]
+"""
+import argparse
+import contextvars
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 评估调用不是真实问诊，不写审计日志
+os.environ.setdefault('AUDIT_ENABLED', '0')
+
+import prompts  # noqa: E402
+from config import (GEMINI_MODEL, GENERATION_MODE, GOOGLE_API_KEY, MODEL_REPLAY_LATENCY_SCALE,  # noqa: E402
+                    PROMPT_CACHE_MODE)
+from consolidated_generator import ConsolidatedGenerator, run_consultation  # noqa: E402
+from drug_checker import DrugChecker  # noqa: E402
+from drug_normalizer import get_normalizer  # noqa: E402
+from examination_recommender import ExaminationRecommender  # noqa: E402
+from local_backend import RecordingMissing  # noqa: E402
+from metrics import metrics  # noqa: E402
+from model_router import get_router  # noqa: E402
+from model_scheduler import RateLimiter, get_scheduler  # noqa: E402
+from soap_generator import SOAP_FIELDS, SOAPGenerator  # noqa: E402
+from transcript_cache import minhash, normalize_transcript, similarity  # noqa: E402
+
+DEFAULT_CONFIGS = [
+    {'name': 'baseline'},
+    {'name': 'consolidated', 'mode': 'consolidated'},
+    {'name': 'no-routing', 'routing': False},
+    {'name': 'low-temperature', 'temperature': {'soap': 0.1, 'examinations': 0.1, 'consolidated': 0.1}},
+]
+
+# 指标名 -> (命令行参数, 默认门槛)
+QUALITY_BAR = {
+    'json_valid': ('--min-json-valid', 0.98),
+    'drug_f1': ('--min-drug-f1', 0.9),
+    'conflict_accuracy': ('--min-conflict-accuracy', 0.95),
+    'diagnosis_hit': ('--min-diagnosis-hit', 0.8),
+    'exam_f1': ('--min-exam-f1', 0.5),
+    'soap_similarity': ('--min-soap-similarity', 0.0),
+}
+
+_case_calls = contextvars.ContextVar('case_calls')
+
+
+def load_jsonl(path: str) -> List[Dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def quantile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def mean(values: List[float]) -> Optional[float]:
+    return sum(values) / len(values) if values else None
+
+
+def f1(predicted: set, reference: set, match) -> float:
+    if not predicted and not reference:
+        return 1.0
+    if not predicted or not reference:
+        return 0.0
+    precision = sum(1 for p in predicted if any(match(p, r) for r in reference)) / len(predicted)
+    recall = sum(1 for r in reference if any(match(p, r) for p in predicted)) / len(reference)
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def _plain(text) -> str:
+    return re.sub(r'[\s（）()，,、。.：:\-]', '', str(text)).lower()
+
+
+def fuzzy_match(a: str, b: str) -> bool:
+    # 检查和诊断的写法差异较大（“血常规” / “血常规检查”），互相包含即视为一致
+    a, b = _plain(a), _plain(b)
+    return bool(a and b) and (a in b or b in a)
+
+
+def soap_text(soap: Dict) -> str:
+    return json.dumps([soap.get(field) for field in SOAP_FIELDS], ensure_ascii=False)
+
+
+def instrument(model):
+    """记录每次 generate_content 的阶段、耗时、响应与异常（升级重试包含在同一次记录里）"""
+    original = model.generate_content
+
+    def generate_content(prompt, *args, stage='default', **kwargs):
+        start = time.perf_counter()
+        response, error = None, None
+        try:
+            response = original(prompt, *args, stage=stage, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _case_calls.get().append({'stage': stage, 'latency': time.perf_counter() - start,
+                                      'response': response, 'error': error})
+
+    model.generate_content = generate_content
+
+
+def valid_json(response) -> bool:
+    try:
+        return isinstance(json.loads(response.text), dict)
+    except Exception:
+        return False
+
+
+def usage_counters() -> Dict[str, float]:
+    snapshot = metrics.snapshot()
+    totals = {'input_uncached': 0, 'input_cached': 0, 'total': 0, 'calls': 0, 'escalations': 0}
+    for key, value in snapshot['counters'].items():
+        if key.startswith('model_input_tokens_total'):
+            totals['input_cached' if 'cached=true' in key else 'input_uncached'] += value
+        elif key.startswith('model_tokens_total'):
+            totals['total'] += value
+        elif key.startswith('model_escalations_total'):
+            totals['escalations'] += value
+    totals['calls'] = sum(h['count'] for key, h in snapshot['histograms'].items()
+                          if key.startswith('model_latency_seconds'))
+    return totals
+
+
+class Evaluation:
+    def __init__(self, config: Dict, backend: str, recordings: Optional[str], latency_scale: float):
+        self.config = config
+        self.mode = config.get('mode', GENERATION_MODE)
+        model = config.get('model', GEMINI_MODEL)
+        temperature = config.get('temperature', {})
+
+        def temperatures(**stages):
+            # 配置中没有指定的阶段沿用各类的默认温度
+            return {arg: temperature[stage] for arg, stage in stages.items() if stage in temperature}
+
+        self.soap_generator = SOAPGenerator(GOOGLE_API_KEY, model, use_similar_cache=False,
+                                            **temperatures(temperature='soap'))
+        self.exam_recommender = ExaminationRecommender(GOOGLE_API_KEY, model, use_cache=False,
+                                                       **temperatures(temperature='examinations'))
+        self.drug_checker = DrugChecker(GOOGLE_API_KEY, model, **temperatures(
+            temperature='drug_check', extraction_temperature='drug_extraction'))
+        self.consolidated = ConsolidatedGenerator(GOOGLE_API_KEY, model, **temperatures(temperature='consolidated'))
+        for component in (self.soap_generator, self.exam_recommender, self.drug_checker, self.consolidated):
+            component.model.backend = backend
+            component.model.cache_mode = config.get('cache_mode', PROMPT_CACHE_MODE)
+            if recordings:
+                component.model.recordings_path = recordings
+            component.model.replay_latency_scale = latency_scale
+            instrument(component.model)
+        # 共享指令是否足够长按本次后端实测（回放时读取录制的统计结果）
+        prompts.use_token_counter(self.soap_generator.model.count_tokens)
+
+    def run_case(self, case: Dict) -> Dict:
+        calls = []
+        _case_calls.set(calls)
+        start = time.perf_counter()
+        result = run_consultation(case['transcript'], case.get('patient_info'),
+                                  self.soap_generator, self.exam_recommender, self.drug_checker,
+                                  self.consolidated if self.mode == 'consolidated' else None)
+        return {'latency': time.perf_counter() - start, 'calls': calls, 'result': result}
+
+    def run(self, cases: List[Dict], concurrency: int) -> List[Dict]:
+        router = get_router()
+        saved_routing = (router.enabled, router.fast_model)
+        saved_instructions = {name: t.instruction for name, t in prompts.TEMPLATES.items()}
+        try:
+            router.enabled = self.config.get('routing', router.enabled)
+            router.fast_model = self.config.get('fast_model', router.fast_model)
+            for name, path in self.config.get('instructions', {}).items():
+                with open(path, encoding='utf-8') as f:
+                    prompts.set_instruction(name, f.read().strip())
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                # 每个用例在独立的上下文副本中运行，调用记录互不混淆
+                futures = [executor.submit(contextvars.copy_context().run, self.run_case, case) for case in cases]
+                return [future.result() for future in futures]
+        finally:
+            router.enabled, router.fast_model = saved_routing
+            for name, instruction in saved_instructions.items():
+                prompts.set_instruction(name, instruction)
+
+
+def score(cases: List[Dict], outcomes: List[Dict]) -> Dict:
+    normalizer = get_normalizer()
+    scores = {name: [] for name in QUALITY_BAR}
+    stage_latency: Dict[str, List[float]] = {}
+    missing = 0
+    for case, outcome in zip(cases, outcomes):
+        for call in outcome['calls']:
+            if isinstance(call['error'], RecordingMissing):
+                missing += 1
+                continue
+            stage_latency.setdefault(call['stage'], []).append(call['latency'])
+            scores['json_valid'].append(1.0 if call['response'] is not None and valid_json(call['response']) else 0.0)
+
+        result = outcome['result']
+        reference = case.get('reference') or {}
+        soap = result['soap']
+        if 'drugs' in reference:
+            # 处方药物按药名的通用名比较，不看剂量
+            predicted_drugs = normalizer.canonical_list([drug['name'] for drug in result['prescribed_drugs']])
+            scores['drug_f1'].append(f1(set(predicted_drugs), set(normalizer.canonical_list(reference['drugs'])),
+                                        str.__eq__))
+        if 'has_conflicts' in reference:
+            predicted = bool((result['drug_check'] or {}).get('has_conflicts'))
+            scores['conflict_accuracy'].append(1.0 if predicted == reference['has_conflicts'] else 0.0)
+        diagnosis = reference.get('diagnosis') or (reference.get('soap') or {}).get('preliminary_diagnosis')
+        if diagnosis:
+            predicted = soap.get('preliminary_diagnosis') or []
+            hit = any(fuzzy_match(p, r) for p in predicted for r in diagnosis)
+            scores['diagnosis_hit'].append(1.0 if hit else 0.0)
+        if 'examinations' in reference:
+            predicted = {e.get('name', '') for e in result['examinations'] if isinstance(e, dict)}
+            scores['exam_f1'].append(f1(predicted, set(reference['examinations']), fuzzy_match))
+        if reference.get('soap'):
+            scores['soap_similarity'].append(similarity(minhash(normalize_transcript(soap_text(soap))),
+                                                        minhash(normalize_transcript(soap_text(reference['soap'])))))
+
+    latencies = [outcome['latency'] for outcome in outcomes]
+    return {
+        'p50': quantile(latencies, 0.5),
+        'p95': quantile(latencies, 0.95),
+        'stages': {stage: {'p50': quantile(values, 0.5), 'p95': quantile(values, 0.95)}
+                   for stage, values in sorted(stage_latency.items())},
+        'missing': missing,
+        **{name: mean(values) for name, values in scores.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="配置评估")
+    parser.add_argument('--corpus', required=True, help='带参考答案的问诊语料 JSONL')
+    parser.add_argument('--configs', help='配置 JSON 数组文件，默认比较内置的几组配置')
+    parser.add_argument('--backend', choices=('gemini', 'record', 'replay', 'local'), default='replay')
+    parser.add_argument('--recordings', help='录制文件，默认 MODEL_RECORDINGS_PATH')
+    parser.add_argument('--latency-scale', type=float, default=MODEL_REPLAY_LATENCY_SCALE,
+                        help='回放时等待录制耗时的倍数，0 表示不等待')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时评估的用例数')
+    parser.add_argument('--output', help='把完整结果写入 JSON 文件')
+    for name, (flag, default) in QUALITY_BAR.items():
+        parser.add_argument(flag, dest=name, type=float, default=default)
+    args = parser.parse_args()
+
+    if args.backend in ('gemini', 'record') and (not GOOGLE_API_KEY or GOOGLE_API_KEY == "your_google_api_key_here"):
+        print("需要有效的 GOOGLE_API_KEY（离线评估请使用 --backend replay）")
+        sys.exit(2)
+    if args.backend in ('replay', 'local'):
+        # 离线后端不占用上游配额
+        get_scheduler().limiter = RateLimiter(10 ** 6, 10 ** 9)
+
+    cases = load_jsonl(args.corpus)
+    configs = json.load(open(args.configs, encoding='utf-8')) if args.configs else DEFAULT_CONFIGS
+
+    summaries = {}
+    for config in configs:
+        before = usage_counters()
+        evaluation = Evaluation(config, args.backend, args.recordings, args.latency_scale)
+        summary = score(cases, evaluation.run(cases, args.concurrency))
+        after = usage_counters()
+        usage = {key: (after[key] - before[key]) / len(cases) for key in after}
+        summary['tokens'] = {
+            'input_uncached': usage['input_uncached'],
+            'input_cached': usage['input_cached'],
+            'output': usage['total'] - usage['input_uncached'] - usage['input_cached'],
+        }
+        summary['calls'] = usage['calls']
+        summary['escalations'] = usage['escalations']
+        summary['failed'] = [name for name in QUALITY_BAR
+                             if summary[name] is not None and summary[name] < getattr(args, name)]
+        summaries[config['name']] = summary
+
+    print(f"{'配置':<18}{'p50(s)':>8}{'p95(s)':>8}{'调用/例':>8}{'输入/例':>9}{'缓存/例':>9}{'输出/例':>9}"
+          f"{'JSON':>7}{'药物F1':>8}{'冲突':>7}{'诊断':>7}{'检查F1':>8}{'病历':>7}")
+    for name, s in summaries.items():
+        metrics_text = ''.join(f"{'-' if s[key] is None else format(s[key], '.0%'):>{width}}"
+                               for key, width in (('json_valid', 7), ('drug_f1', 8), ('conflict_accuracy', 7),
+                                                  ('diagnosis_hit', 7), ('exam_f1', 8), ('soap_similarity', 7)))
+        print(f"{name:<18}{s['p50']:>8.2f}{s['p95']:>8.2f}{s['calls']:>8.1f}{s['tokens']['input_uncached']:>9.0f}"
+              f"{s['tokens']['input_cached']:>9.0f}{s['tokens']['output']:>9.0f}{metrics_text}")
+    print()
+    for name, s in summaries.items():
+        stages = ', '.join(f"{stage} {v['p50']:.2f}/{v['p95']:.2f}s" for stage, v in s['stages'].items())
+        notes = []
+        if s['missing']:
+            notes.append(f"{s['missing']} 次调用没有录制")
+        if s['failed']:
+            notes.append('未达标: ' + ', '.join(s['failed']))
+        print(f"{name:<18}{stages}" + (f"  [{'；'.join(notes)}]" if notes else ''))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'configs': configs, 'results': summaries}, f, ensure_ascii=False, indent=2)
+
+    eligible = [name for name, s in summaries.items() if not s['failed'] and not s['missing']]
+    if not eligible:
+        print("\n❌ 没有配置满足质量门槛")
+        sys.exit(1)
+    best = min(eligible, key=lambda name: summaries[name]['p95'])
+    print(f"\n✅ 满足质量门槛且 p95 最低的配置: {best}（p95 {summaries[best]['p95']:.2f}s）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+顺序模式与合并模式的对比基准（需要有效的 GOOGLE_API_KEY）
+
+对每条问诊记录分别用两种模式跑完整流程（SOAP、检查推荐、药物列表、冲突检查），报告：
+- 端到端耗时（p50 / 最大值）
+- 模型调用次数与 token 用量
+- 两种模式结果的一致程度（处方药物、检查项目的重合比例）
+
+用法: python benchmarks/generation_modes.py [--corpus cases.jsonl] [--runs 1]
+corpus 每行一个 JSON：{"transcript": "...", "patient_info": {...}}
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import GOOGLE_API_KEY, GEMINI_MODEL  # noqa: E402
+from consolidated_generator import ConsolidatedGenerator, run_consultation  # noqa: E402
+from drug_checker import DrugChecker  # noqa: E402
+from drug_normalizer import get_normalizer  # noqa: E402
+from examination_recommender import ExaminationRecommender  # noqa: E402
+from metrics import metrics  # noqa: E402
+from soap_generator import SOAPGenerator  # noqa: E402
+
+SAMPLE_CASES = [
+    {
+        'transcript': (
+            "医生：您好，哪里不舒服？患者：咳嗽三天了，有黄痰，昨天开始发烧，最高38.6度，喉咙痛。"
+            "医生：有没有胸闷气短？患者：没有。医生：平时有什么病吗？患者：有高血压，一直吃氨氯地平。"
+            "医生：听诊右下肺有少量湿啰音。先查个血常规和胸片，给您开阿莫西林克拉维酸钾，一次一片，一天两次，"
+            "再加氨溴索化痰，发烧超过38.5度吃布洛芬。"
+        ),
+        'patient_info': {'name': '测试', 'age': '45', 'gender': '男', 'medical_history': '高血压',
+                         'allergies': '无', 'current_medications': '氨氯地平'},
+    },
+    {
+        'transcript': (
+            "医生：今天怎么了？患者：上腹痛一周，饭后加重，有反酸烧心。医生：大便颜色正常吗？患者：正常。"
+            "医生：吃过什么药吗？患者：前段时间腰痛一直吃布洛芬。医生：先停布洛芬，查幽门螺杆菌呼气试验，"
+            "必要时做胃镜。开奥美拉唑20毫克每天一次，铝碳酸镁嚼服。"
+        ),
+        'patient_info': {'name': '测试', 'age': '52', 'gender': '女', 'medical_history': '腰椎间盘突出',
+                         'allergies': '青霉素', 'current_medications': '布洛芬'},
+    },
+]
+
+
+def load_cases(path):
+    if not path:
+        return SAMPLE_CASES
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def model_usage():
+    snapshot = metrics.snapshot()
+    calls = sum(h['count'] for key, h in snapshot['histograms'].items() if key.startswith('model_latency_seconds'))
+    tokens = sum(v for key, v in snapshot['counters'].items() if key.startswith('model_tokens_total'))
+    return calls, tokens
+
+
+def overlap(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成模式对比基准")
+    parser.add_argument('--corpus', help='问诊记录 JSONL 文件，默认使用内置样例')
+    parser.add_argument('--runs', type=int, default=1)
+    args = parser.parse_args()
+
+    if not GOOGLE_API_KEY or GOOGLE_API_KEY == "your_google_api_key_here":
+        print("需要有效的 GOOGLE_API_KEY")
+        sys.exit(2)
+
+    # 关闭缓存，两种模式都真实调用模型
+    soap_generator = SOAPGenerator(GOOGLE_API_KEY, GEMINI_MODEL, use_similar_cache=False)
+    exam_recommender = ExaminationRecommender(GOOGLE_API_KEY, GEMINI_MODEL, use_cache=False)
+    drug_checker = DrugChecker(GOOGLE_API_KEY, GEMINI_MODEL)
+    consolidated = ConsolidatedGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
+
+    cases = load_cases(args.corpus)
+    stats = {mode: {'latency': [], 'calls': 0, 'tokens': 0} for mode in ('sequential', 'consolidated')}
+    drug_agreement, exam_agreement = [], []
+
+    for _ in range(args.runs):
+        for case in cases:
+            results = {}
+            for mode in ('sequential', 'consolidated'):
+                calls_before, tokens_before = model_usage()
+                start = time.perf_counter()
+                results[mode] = run_consultation(case['transcript'], case.get('patient_info'),
+                                                 soap_generator, exam_recommender, drug_checker,
+                                                 consolidated if mode == 'consolidated' else None)
+                stats[mode]['latency'].append(time.perf_counter() - start)
+                calls_after, tokens_after = model_usage()
+                stats[mode]['calls'] += calls_after - calls_before
+                stats[mode]['tokens'] += tokens_after - tokens_before
+
+            # 两种模式摘录的剂量写法不同，按药名的通用名比较
+            normalizer = get_normalizer()
+            drug_agreement.append(overlap(
+                normalizer.canonical_list([drug['name'] for drug in results['sequential']['prescribed_drugs']]),
+                normalizer.canonical_list([drug['name'] for drug in results['consolidated']['prescribed_drugs']])))
+            exam_agreement.append(overlap([e.get('name') for e in results['sequential']['examinations']],
+                                          [e.get('name') for e in results['consolidated']['examinations']]))
+
+    n = len(cases) * args.runs
+    print(f"{'模式':<14}{'p50(s)':>9}{'max(s)':>9}{'调用/例':>9}{'token/例':>10}")
+    for mode, s in stats.items():
+        print(f"{mode:<14}{statistics.median(s['latency']):>9.2f}{max(s['latency']):>9.2f}"
+              f"{s['calls'] / n:>9.1f}{s['tokens'] / n:>10.0f}")
+    print(f"\n处方药物一致率: {statistics.mean(drug_agreement):.0%}")
+    print(f"检查项目一致率: {statistics.mean(exam_agreement):.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+提示词前缀缓存基准（本地模型替身，不需要 API Key）
+
+用 local_backend 模拟上游的前缀缓存，按顺序模式的各阶段模板发送一批问诊，比较：
+- per_task: 每个任务只发送自己的固定指令（单独都低于最小缓存长度）
+- shared:   所有任务共用 SHARED_INSTRUCTION（system / explicit 两种发送方式）
+报告输入 token、命中缓存的比例和平均每次调用未缓存的 token；
+shared 的未缓存 token 不低于 per_task 时退出码为 1。
+本地替身按 1 个字符 1 个 token 计，真实分词器下共享指令的 token 数更少；服务运行时用
+count_tokens 实测，低于 PROMPT_SHARED_MIN_TOKENS 时不使用共享指令（见 prompts.py）。
+
+用法: python benchmarks/prompt_cache.py [--consultations 50]
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 本地替身不受上游配额限制，也不写审计日志或共享限流状态
+os.environ.update(MODEL_RPM='1000000', MODEL_TPM='1000000000', MODEL_RATE_STATE_PATH='', AUDIT_ENABLED='0')
+
+import local_backend  # noqa: E402
+from gemini_client import GeminiModel  # noqa: E402
+import prompts  # noqa: E402
+from prompts import (CONSOLIDATED_PROMPT, DRUG_CHECK_PROMPT, DRUG_EXTRACTION_PROMPT,  # noqa: E402
+                     EXAMINATIONS_PROMPT, SOAP_PROMPT)
+
+SYMPTOMS = ['头痛', '发热', '咳嗽', '胸闷', '腹痛', '腹泻', '乏力', '关节痛', '皮疹', '失眠']
+
+
+def consultation(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(6, 20)):
+        symptom = rng.choice(SYMPTOMS)
+        lines.append(f"医生：{symptom}持续多久了？\n患者：大概{rng.randint(1, 14)}天，{rng.choice(['时好时坏', '越来越重', '晚上明显'])}。")
+    return '\n'.join(lines)
+
+
+def calls(transcript: str):
+    patient = '- 姓名：测试\n- 年龄：45\n- 性别：男'
+    yield 'soap', SOAP_PROMPT, SOAP_PROMPT.render(patient=patient, transcript=transcript)
+    yield 'examinations', EXAMINATIONS_PROMPT, EXAMINATIONS_PROMPT.render(
+        soap_summary='- 主诉：头痛\n- 初步诊断：偏头痛', transcript=transcript[:1000] + '...')
+    yield 'drug_extraction', DRUG_EXTRACTION_PROMPT, DRUG_EXTRACTION_PROMPT.render(plan='布洛芬 0.3g bid')
+    yield 'drug_check', DRUG_CHECK_PROMPT, DRUG_CHECK_PROMPT.render(patient='- 过敏史：无', drugs='布洛芬')
+    yield 'consolidated', CONSOLIDATED_PROMPT, CONSOLIDATED_PROMPT.render(patient=patient, transcript=transcript)
+
+
+def run(layout: str, mode: str, transcripts):
+    local_backend.reset()
+    model = GeminiModel('local', 'local-model', backend='local', cache_mode=mode)
+    count = 0
+    for transcript in transcripts:
+        for stage, template, prompt in calls(transcript):
+            # 两种布局都固定下来比较，不经过 shared_prefix_enabled 的长度判断
+            shared = layout == 'shared' and template.shared
+            instruction = prompts.SHARED_INSTRUCTION if shared else template.instruction
+            model._call('local-model', prompt, None, stage, system_instruction=instruction)
+            count += 1
+    usage = local_backend.stats()['local-model']
+    return usage['input_tokens'], usage['cached_tokens'], count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="提示词前缀缓存基准")
+    parser.add_argument('--consultations', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    transcripts = [consultation(rng) for _ in range(args.consultations)]
+
+    results = {}
+    print(f"{'布局':<10}{'发送方式':<10}{'输入 token':>12}{'缓存命中':>10}{'未缓存/次':>12}")
+    for layout, mode in (('per_task', 'system'), ('shared', 'system'), ('shared', 'explicit')):
+        total, cached, count = run(layout, mode, transcripts)
+        results[(layout, mode)] = (total - cached) / count
+        print(f"{layout:<10}{mode:<10}{total:>12}{cached / total:>10.0%}{(total - cached) / count:>12.0f}")
+
+    baseline = results[('per_task', 'system')]
+    if any(uncached >= baseline for key, uncached in results.items() if key[0] == 'shared'):
+        print("\n❌ 共享前缀没有减少未缓存的输入 token")
+        sys.exit(1)
+    print(f"\n✅ 共享前缀每次调用少处理 {baseline - results[('shared', 'system')]:.0f} 个未缓存 token")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+启动时间基准与回归检查
+
+- 用 python -X importtime 报告 app / ehr_agent 的导入耗时排行
+- 多次冷启动测量：导入 Web 应用并响应 /health、导入命令行入口
+- 检查重型依赖没有在启动时被导入，启动耗时不超过预算；任何一项失败则退出码为 1
+
+用法: python benchmarks/startup.py [--runs 5] [--max-web-ms 1200] [--max-cli-ms 1000]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 这些模块只应在第一次调用模型 / 使用语音输入时加载
+LAZY_MODULES = ['google.generativeai', 'pyaudio', 'speech_recognition', 'pydub']
+
+WEB_STARTUP = "import app; assert app.app.test_client().get('/health').status_code == 200"
+CLI_STARTUP = "import ehr_agent"
+
+
+def run_python(code, *flags):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *flags, '-c', code], cwd=PROJECT_DIR,
+                            capture_output=True, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"启动失败:\n{result.stderr}")
+    return elapsed, result
+
+
+def import_profile(module, top=15):
+    _, result = run_python(f"import {module}", '-X', 'importtime')
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    # 被测模块本身及其直接导入，子模块的耗时已计入累计值
+    total = next(row for row in rows if row[2] == 0 and row[3] == module)
+    direct = [row for row in rows[:rows.index(total)] if row[2] == 1]
+    direct.sort(reverse=True)
+    top_level = [total] + direct
+    return top_level[:top]
+
+
+def measure(code, runs):
+    return statistics.median(run_python(code)[0] for _ in range(runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动时间基准")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-web-ms', type=float, default=1200)
+    parser.add_argument('--max-cli-ms', type=float, default=1000)
+    args = parser.parse_args()
+
+    failures = []
+    for module in ('app', 'ehr_agent'):
+        print(f"\n导入耗时排行: {module}")
+        print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+        for cumulative_us, self_us, depth, name in import_profile(module):
+            print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {'  ' * depth}{name}")
+
+    check = (f"import sys, app, ehr_agent; "
+             f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+    _, result = run_python(check)
+    eager = [m for m in result.stdout.strip().split(',') if m]
+    if eager:
+        failures.append(f"启动时导入了应延迟加载的模块: {', '.join(eager)}")
+
+    web_ms = measure(WEB_STARTUP, args.runs)
+    cli_ms = measure(CLI_STARTUP, args.runs)
+    print(f"\nWeb 冷启动 + /health: {web_ms:.0f} ms（预算 {args.max_web_ms:.0f} ms）")
+    print(f"CLI 冷启动:           {cli_ms:.0f} ms（预算 {args.max_cli_ms:.0f} ms）")
+    if web_ms > args.max_web_ms:
+        failures.append(f"Web 启动耗时 {web_ms:.0f} ms 超出预算")
+    if cli_ms > args.max_cli_ms:
+        failures.append(f"CLI 启动耗时 {cli_ms:.0f} ms 超出预算")
+
+    if failures:
+        print("\n❌ 启动时间回归:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("\n✅ 启动时间检查通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+请求取消：客户端断开、任务被取消或被新请求取代时，停止仍在进行的模型调用
+
+当前上下文的 CancelToken 通过 scope() 设置，模型调用在排队等待配额时、
+以及流式接收响应的每个分片之间调用 check()。Cancelled 继承 BaseException，
+各模块里 `except Exception` 的兜底处理不会把取消当作普通错误吞掉。
+"""
+import contextvars
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from metrics import metrics
+
+# 两次探测之间的最短间隔（秒），探测可能需要读数据库或检查套接字
+PROBE_INTERVAL = 0.5
+
+_current = contextvars.ContextVar('cancel_token', default=None)
+
+
+class Cancelled(BaseException):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """probe() 返回取消原因（字符串）或 None；也可以由其他线程直接调用 cancel()"""
+
+    def __init__(self, probe: Optional[Callable[[], Optional[str]]] = None):
+        self.probe = probe
+        self.reason: Optional[str] = None
+        self._last_probe = 0.0
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.probe is not None:
+            now = time.monotonic()
+            with self._lock:
+                if now - self._last_probe >= PROBE_INTERVAL:
+                    self._last_probe = now
+                    try:
+                        reason = self.probe()
+                    except Exception:
+                        reason = None
+                    if reason:
+                        self.cancel(reason)
+        return self.reason is not None
+
+    def check(self, stage: str = 'default'):
+        if self.cancelled:
+            metrics.inc('model_calls_cancelled_total', stage=stage, reason=self.reason)
+            raise Cancelled(self.reason)
+
+
+def current() -> Optional[CancelToken]:
+    return _current.get()
+
+
+@contextmanager
+def scope(token: CancelToken):
+    """在此上下文内发起的模型调用受 token 控制"""
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def client_disconnect_probe(environ) -> Optional[Callable[[], Optional[str]]]:
+    """检测 HTTP 客户端是否已断开：对端关闭连接后，非阻塞 peek 读到 0 字节
+
+    需要服务器在 environ 中提供原始套接字（gunicorn、werkzeug 开发服务器都会提供），
+    否则返回 None。请求体已读完，之后套接字上不会再有合法数据，peek 不会消耗任何内容。
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return None
+
+    def probe() -> Optional[str]:
+        try:
+            data = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            return 'client_disconnected'
+        return 'client_disconnected' if data == b'' else None
+
+    return probe
@@ -5,6 +5,34 @@ load_dotenv()
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# sequential: SOAP、检查推荐、药物提取、冲突检查各调用一次模型
+# consolidated: 一次调用生成 SOAP + 检查推荐 + 药物列表，冲突检查仍单独调用
+GENERATION_MODE = os.getenv("GENERATION_MODE", "sequential")
+
+# 模型分级路由：GEMINI_MODEL 为主模型，MODEL_ROUTES 中标为 fast 的阶段用 MODEL_FAST，
+# 标为 auto 的阶段在提示词（固定指令不计入，只计可变内容）不超过 MODEL_ROUTE_FAST_MAX_CHARS 字符时用 MODEL_FAST；
+# 其余阶段（含药物冲突检查）用主模型
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "1") == "1"
+MODEL_FAST = os.getenv("MODEL_FAST", "gemini-2.5-flash-lite")
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "drug_extraction=fast,soap=auto,examinations=auto")
+MODEL_ROUTE_FAST_MAX_CHARS = int(os.getenv("MODEL_ROUTE_FAST_MAX_CHARS", "2000"))
+
+# 固定指令的发送方式（见 prompts.py）
+# inline: 拼在每次请求的内容前面（旧方式，仅用于对比）
+# system: 作为 system instruction 发送，前缀固定，可命中上游的隐式前缀缓存
+# explicit: 每个模型创建一次缓存内容（有效期 PROMPT_CACHE_TTL 秒，到期前重建），失败时退回 system
+PROMPT_CACHE_MODE = os.getenv("PROMPT_CACHE_MODE", "system")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+# 上游隐式缓存的最小前缀长度（token）；共享指令实测达不到时，各任务改回只发送自己的指令
+PROMPT_SHARED_MIN_TOKENS = int(os.getenv("PROMPT_SHARED_MIN_TOKENS", "1024"))
+# 无法实测时按估计判断，估计结果只保留这么多秒，之后重新实测
+PROMPT_SHARED_RETRY_SECONDS = float(os.getenv("PROMPT_SHARED_RETRY_SECONDS", "300"))
+# gemini: 调用 Gemini API；local: 本地替身（不联网，返回固定结果并统计缓存/未缓存的输入 token）
+# record: 调用 Gemini 并把响应录制到 MODEL_RECORDINGS_PATH；replay: 只用录制的响应，不联网
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini")
+MODEL_RECORDINGS_PATH = os.getenv("MODEL_RECORDINGS_PATH", "state/model_recordings.jsonl")
+# 回放时按录制耗时的倍数等待，0 表示立即返回
+MODEL_REPLAY_LATENCY_SCALE = float(os.getenv("MODEL_REPLAY_LATENCY_SCALE", "1"))
 
 MICROPHONE_INDEX = None
 SAMPLE_RATE = 16000
@@ -13,5 +41,110 @@ RECORD_TIMEOUT = 1.0
 PHRASE_TIMEOUT = 3.0
 
 RECORDINGS_DIR = "recordings"
+# 录音存储格式：flac（无损）、opus（语音，体积最小）或 wav
+RECORDING_FORMAT = os.getenv("RECORDING_FORMAT", "flac")
+RECORDING_OPUS_BITRATE = os.getenv("RECORDING_OPUS_BITRATE", "24k")
+
+# 识别前的预处理：VAD 去静音 + 增益归一化
+ASR_PREPROCESS = os.getenv("ASR_PREPROCESS", "1") == "1"
+ASR_TARGET_DBFS = -20.0
+VAD_FRAME_MS = 20
+VAD_ENERGY_MARGIN_DB = 10.0
+VAD_HANGOVER_MS = 200
+VAD_MIN_SILENCE_MS = 400
 OUTPUT_DIR = "output"
 
+# 大于该字节数的 JSON/HTML 响应按需 gzip 压缩
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+# WebSocket 实时问诊转录
+LIVE_ASR_WORKERS = int(os.getenv("LIVE_ASR_WORKERS", "16"))
+LIVE_MAX_BUFFERED_CHUNKS = int(os.getenv("LIVE_MAX_BUFFERED_CHUNKS", "32"))
+LIVE_MAX_PENDING_SEGMENTS = int(os.getenv("LIVE_MAX_PENDING_SEGMENTS", "4"))
+LIVE_MAX_MESSAGE_BYTES = int(os.getenv("LIVE_MAX_MESSAGE_BYTES", str(1024 * 1024)))
+LIVE_PARTIAL_INTERVAL = float(os.getenv("LIVE_PARTIAL_INTERVAL", "2.0"))
+LIVE_SILENCE_MS = 700
+LIVE_MAX_SEGMENT_SECONDS = 15.0
+# 浏览器可声明的 pcm16 采样率范围
+LIVE_MIN_SAMPLE_RATE = 8000
+LIVE_MAX_SAMPLE_RATE = 48000
+
+# 生产环境 WSGI 服务（serve.py）
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:8000")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "4"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "50"))
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", "180"))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "60"))
+WEB_DRAIN_SECONDS = float(os.getenv("WEB_DRAIN_SECONDS", "10"))
+WEB_PRELOAD_APP = os.getenv("WEB_PRELOAD_APP", "1") == "1"
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", "0"))
+
+# 准入控制：每组路由的 并发上限:等待队列长度（model 同步生成接口，poll 任务长轮询，stream SSE/导出，
+# live 实时问诊 WebSocket（每个连接占用一个线程，默认与 LIVE_ASR_WORKERS 相同），api 会话、任务提交、保存报告等其余接口）。
+# 各组之和应小于 WEB_THREADS，剩余线程留给健康检查和静态资源
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_POOLS = os.getenv("ADMISSION_POOLS",
+                            f"model=6:4,poll=6:0,stream=4:0,api=8:4,live={LIVE_ASR_WORKERS}:0")
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+# 自适应模式：model 组的平均处理耗时超过目标值时自动收紧并发上限
+ADMISSION_ADAPTIVE = os.getenv("ADMISSION_ADAPTIVE", "0") == "1"
+ADMISSION_TARGET_LATENCY = float(os.getenv("ADMISSION_TARGET_LATENCY", "30"))
+
+# 后台任务队列
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_QUEUE_DEPTH = int(os.getenv("JOB_MAX_QUEUE_DEPTH", "100"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_LONG_POLL_MAX = 25
+# 以 watch 方式提交的任务超过该秒数没有被轮询时视为客户端已离开，自动取消
+JOB_ABANDON_SECONDS = float(os.getenv("JOB_ABANDON_SECONDS", "120"))
+
+# 模型调用限流（所有 worker 通过 MODEL_RATE_STATE_PATH 共享配额，留空则仅进程内限流）
+MODEL_RPM = int(os.getenv("MODEL_RPM", "60"))
+MODEL_TPM = int(os.getenv("MODEL_TPM", "1000000"))
+MODEL_RATE_STATE_PATH = os.getenv("MODEL_RATE_STATE_PATH", "state/model_rate.db")
+MODEL_QUEUE_TIMEOUT = float(os.getenv("MODEL_QUEUE_TIMEOUT", "120"))
+
+# 检查项目推荐缓存
+EXAM_CACHE_ENABLED = os.getenv("EXAM_CACHE_ENABLED", "1") == "1"
+EXAM_CACHE_REFINE = os.getenv("EXAM_CACHE_REFINE", "0") == "1"
+EXAM_CACHE_PATH = os.getenv("EXAM_CACHE_PATH", "state/exam_cache.json")
+EXAM_CACHE_SIZE = int(os.getenv("EXAM_CACHE_SIZE", "500"))
+EXAM_CACHE_TTL = float(os.getenv("EXAM_CACHE_TTL", str(7 * 24 * 3600)))
+EXAM_CACHE_WARM_TOP = 50
+# 写入后延迟 EXAM_CACHE_SAVE_DELAY 秒在后台落盘，期间的多次写入合并为一次
+EXAM_CACHE_SAVE_DELAY = float(os.getenv("EXAM_CACHE_SAVE_DELAY", "2.0"))
+
+# 相似问诊缓存：相似度达到 THRESHOLD 时把历史病历作为参考病历放入提示词（从不直接复用），默认关闭
+SOAP_SIMILAR_CACHE_ENABLED = os.getenv("SOAP_SIMILAR_CACHE_ENABLED", "0") == "1"
+SOAP_SIMILAR_CACHE_SIZE = int(os.getenv("SOAP_SIMILAR_CACHE_SIZE", "1000"))
+SOAP_SIMILAR_THRESHOLD = float(os.getenv("SOAP_SIMILAR_THRESHOLD", "0.7"))
+
+# 问诊会话：内存中最多保留 SESSION_MAX_BYTES，超出按 LRU 淘汰；
+# 设置 SESSION_DB_PATH 时会话同时写入磁盘，淘汰后仍可取回，多个 worker 共享
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(12 * 3600)))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "state/sessions.db")
+
+# FHIR 批量导出的 HTTP 接口需要 Authorization: Bearer <FHIR_EXPORT_TOKEN>；为空时接口关闭，只能用命令行导出
+FHIR_EXPORT_TOKEN = os.getenv("FHIR_EXPORT_TOKEN", "")
+
+# 审计日志：模型调用、报告保存、导出记录写入 AUDIT_DIR 下的压缩分段文件
+# AUDIT_OVERFLOW 为写入队列满时的处理方式：block（最多等待 AUDIT_BLOCK_TIMEOUT 秒）、drop_new、drop_oldest
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "1") == "1"
+AUDIT_DIR = os.getenv("AUDIT_DIR", "audit")
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "10000"))
+AUDIT_OVERFLOW = os.getenv("AUDIT_OVERFLOW", "block")
+AUDIT_BLOCK_TIMEOUT = float(os.getenv("AUDIT_BLOCK_TIMEOUT", "0.5"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_FSYNC_INTERVAL = float(os.getenv("AUDIT_FSYNC_INTERVAL", "5.0"))
+AUDIT_SEGMENT_BYTES = int(os.getenv("AUDIT_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+AUDIT_SEGMENT_SECONDS = float(os.getenv("AUDIT_SEGMENT_SECONDS", str(24 * 3600)))
+
+# 药名规范化词表
+DRUG_LEXICON_PATH = os.getenv(
+    "DRUG_LEXICON_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "drug_lexicon.tsv")
+)
+
@@ -0,0 +1,99 @@
+from typing import Dict, Optional
+import json
+from datetime import datetime
+from gemini_client import GeminiModel
+from drug_normalizer import split_drug_list, unique_medications
+from prompts import CONSOLIDATED_PROMPT, PATIENT_FIELDS, patient_lines
+
+EMPTY_SOAP = {
+    "subjective": "",
+    "objective": "",
+    "assessment": "",
+    "plan": "",
+    "chief_complaint": "",
+    "preliminary_diagnosis": []
+}
+
+class ConsolidatedGenerator:
+    """一次模型调用同时生成 SOAP 病历、检查项目推荐和结构化的处方药物列表
+
+    顺序模式下 SOAP、检查推荐、药物提取各自发送一遍问诊内容；合并模式只发送一次，
+    药物直接以列表形式返回，不再需要从治疗计划文本中提取。
+    药物冲突检查属于安全关键环节，仍由 DrugChecker 单独调用。
+    """
+
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash", temperature: float = 0.3):
+        self.model = GeminiModel(api_key, model)
+        self.temperature = temperature
+
+    def generate(self, consultation_transcript: str, patient_info: Optional[Dict] = None) -> Dict:
+        """返回 {'soap': ..., 'examinations': [...], 'prescribed_drugs': [...]}
+
+        结构与顺序模式下 generate_soap、recommend_examinations、extract_drugs_from_plan 的返回值相同：
+        prescribed_drugs 为 {'name', 'dose', 'frequency'} 列表，剂量随药名一起交给药物冲突检查。
+        """
+        prompt = CONSOLIDATED_PROMPT.render(
+            patient=patient_lines(patient_info, PATIENT_FIELDS + (('current_medications', '当前用药', '无'),)),
+            transcript=consultation_transcript,
+        )
+
+        try:
+            generation_config = {
+                "temperature": self.temperature,
+                "response_mime_type": "application/json",
+            }
+
+            response = self.model.generate_content(prompt, generation_config=generation_config, stage='consolidated',
+                                                   system_instruction=CONSOLIDATED_PROMPT.system_instruction)
+            result = json.loads(response.text)
+        except Exception as e:
+            print(f"合并生成错误: {e}")
+            return {
+                'soap': dict(EMPTY_SOAP, error=str(e)),
+                'examinations': [],
+                'prescribed_drugs': []
+            }
+
+        soap_data = dict(EMPTY_SOAP, **(result.get('soap') or {}))
+        soap_data['generated_at'] = datetime.now().isoformat()
+        return {
+            'soap': soap_data,
+            'examinations': result.get('examinations') or [],
+            'prescribed_drugs': unique_medications(result.get('medications') or []),
+        }
+
+
+def run_consultation(consultation_transcript: str, patient_info: Optional[Dict],
+                     soap_generator, exam_recommender, drug_checker,
+                     consolidated: Optional[ConsolidatedGenerator] = None) -> Dict:
+    """完整流程：传入 consolidated 时走合并模式（两次调用），否则顺序调用四次
+
+    两种模式返回相同结构：soap、examinations、prescribed_drugs、drug_check。
+    """
+    patient_info = patient_info or {}
+    if consolidated is not None:
+        combined = consolidated.generate(consultation_transcript, patient_info)
+        soap_data = combined['soap']
+        examinations = combined['examinations']
+        prescribed_drugs = combined['prescribed_drugs']
+    else:
+        soap_data = soap_generator.generate_soap(consultation_transcript, patient_info)
+        examinations = exam_recommender.recommend_examinations(soap_data, consultation_transcript, patient_info)
+        prescribed_drugs = drug_checker.extract_drugs_from_plan(soap_data.get('plan', ''))
+
+    drug_check = None
+    if prescribed_drugs:
+        allergies = split_drug_list(patient_info.get('allergies'))
+        current_meds = split_drug_list(patient_info.get('current_medications'))
+        drug_check = drug_checker.check_drug_conflicts(
+            prescribed_drugs=prescribed_drugs,
+            patient_allergies=allergies if allergies else None,
+            current_medications=current_meds if current_meds else None,
+            medical_history=patient_info.get('medical_history')
+        )
+    return {
+        'soap': soap_data,
+        'examinations': examinations,
+        'prescribed_drugs': prescribed_drugs,
+        'drug_check': drug_check
+    }
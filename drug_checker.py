@@ -1,56 +1,44 @@
-import google.generativeai as genai
 from typing import List, Dict, Optional
 import json
+from gemini_client import GeminiModel
+from model_router import json_validator
+from drug_normalizer import get_normalizer, unique_medications
+from prompts import DRUG_CHECK_PROMPT, DRUG_EXTRACTION_PROMPT
 
 class DrugChecker:
-    def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash",
+                 temperature: float = 0.2, extraction_temperature: float = 0.1):
+        self.model = GeminiModel(api_key, model, lane='safety')
+        self.temperature = temperature
+        self.extraction_temperature = extraction_temperature
+        self.normalizer = get_normalizer()
     
     def check_drug_conflicts(self, 
-                            prescribed_drugs: List[str],
+                            prescribed_drugs: List[Dict],
                             patient_allergies: Optional[List[str]] = None,
                             current_medications: Optional[List[str]] = None,
                             medical_history: Optional[str] = None) -> Dict:
+        # 药名、剂量、用法原样交给模型，按药名附注通用名；近似匹配不替换药名
+        prescribed_drugs = self.normalizer.annotate_medications(prescribed_drugs)
+        patient_allergies = self.normalizer.annotate_list(patient_allergies or [])
+        current_medications = self.normalizer.annotate_list(current_medications or [])
         allergies_text = "无" if not patient_allergies else ", ".join(patient_allergies)
         current_meds_text = "无" if not current_medications else ", ".join(current_medications)
         history_text = medical_history or "无"
         
-        prompt = f"""
-你是一位经验丰富的临床药师。请检查以下处方药物的安全性。
-
-处方药物：
-{', '.join(prescribed_drugs)}
-
-患者信息：
-- 过敏史：{allergies_text}
-- 当前用药：{current_meds_text}
-- 病史：{history_text}
-
-请检查以下内容：
-1. 药物过敏风险：处方药物是否与患者过敏史冲突
-2. 药物相互作用：处方药物之间是否存在相互作用
-3. 药物与当前用药冲突：处方药物是否与患者当前用药冲突
-4. 药物与疾病冲突：处方药物是否与患者病史冲突
-5. 剂量合理性：药物剂量是否合理
-
-请以JSON格式返回，包含：
-- has_conflicts: 是否存在冲突（布尔值）
-- allergy_warnings: 过敏警告列表
-- drug_interactions: 药物相互作用列表（包含药物对和说明）
-- contraindications: 禁忌症列表
-- dosage_warnings: 剂量警告列表
-- recommendations: 建议列表
-- severity: 总体严重程度（高/中/低/无）
-"""
+        prompt = DRUG_CHECK_PROMPT.render(
+            patient=f"- 过敏史：{allergies_text}\n- 当前用药：{current_meds_text}\n- 病史：{history_text}",
+            drugs=', '.join(prescribed_drugs),
+        )
         
         try:
             generation_config = {
-                "temperature": 0.2,
+                "temperature": self.temperature,
                 "response_mime_type": "application/json",
             }
             
-            response = self.model.generate_content(prompt, generation_config=generation_config)
+            response = self.model.generate_content(prompt, generation_config=generation_config, stage='drug_check',
+                                                   system_instruction=DRUG_CHECK_PROMPT.system_instruction)
             return json.loads(response.text)
             
         except Exception as e:
@@ -66,31 +54,36 @@ class DrugChecker:
                 "severity": "未知"
             }
     
-    def extract_drugs_from_plan(self, plan_text: str) -> List[str]:
-        prompt = f"""
-请从以下治疗计划中提取所有提到的药物名称。
-
-治疗计划：
-{plan_text}
-
-请以JSON格式返回，包含一个drugs数组，每个元素是药物名称。
-只提取明确的药物名称，不包括检查项目或其他非药物内容。
-"""
+    def extract_drugs_from_plan(self, plan_text: str) -> List[Dict]:
+        prompt = DRUG_EXTRACTION_PROMPT.render(plan=plan_text)
         
         try:
             generation_config = {
-                "temperature": 0.1,
+                "temperature": self.extraction_temperature,
                 "response_mime_type": "application/json",
             }
             
-            response = self.model.generate_content(prompt, generation_config=generation_config)
+            response = self.model.generate_content(prompt, generation_config=generation_config, stage='drug_extraction',
+                                                   validate=self._extraction_validator(plan_text),
+                                                   system_instruction=DRUG_EXTRACTION_PROMPT.system_instruction)
             result = json.loads(response.text)
-            return result.get('drugs', [])
+            # 与合并模式相同的 {'name', 'dose', 'frequency'}，剂量和用法药物冲突检查要用到
+            return unique_medications(result.get('drugs', []))
             
         except Exception as e:
             print(f"提取药物名称错误: {e}")
             return []
     
+    @staticmethod
+    def _extraction_validator(plan_text: str):
+        # 提取出的药名必须原样出现在治疗计划中，出现计划里没有的药名时升级到主模型
+        plan = ''.join(plan_text.split())
+        return json_validator(lambda result: (
+            isinstance(result.get('drugs'), list)
+            and all(isinstance(drug, dict) and isinstance(drug.get('name'), str)
+                    and ''.join(drug['name'].split()) in plan for drug in result['drugs'])
+        ))
+    
     def format_check_results(self, check_results: Dict) -> str:
         if "error" in check_results:
             return f"错误: {check_results['error']}"
@@ -0,0 +1,283 @@
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from config import DRUG_LEXICON_PATH
+
+# 剂量、频次、剂型等后缀，匹配前去掉
+DOSAGE_PATTERN = re.compile(
+    r'\d+(?:\.\d+)?\s*(?:mg|g|ml|μg|ug|mcg|iu|u|毫克|克|毫升|微克|万单位|单位|国际单位|%|片|粒|袋|支|滴)?'
+    r'(?:\s*[/×x*]\s*\d*\s*(?:mg|g|ml|片|粒|袋|支|次|日|天|d))*',
+    re.IGNORECASE
+)
+FREQUENCY_PATTERN = re.compile(
+    r'\b(?:qd|bid|tid|qid|qn|prn|po|iv|ivgtt|im|sc|q\d+h)\b|每[日天晚]\d*次?|一日\d*次|口服|静滴|静脉滴注|肌注|睡前|饭[前后]',
+    re.IGNORECASE
+)
+FORM_SUFFIXES = (
+    '缓释胶囊', '肠溶胶囊', '缓释片', '控释片', '肠溶片', '分散片', '咀嚼片', '泡腾片', '薄膜衣片',
+    '干混悬剂', '混悬液', '注射液', '注射剂', '口服液', '口服溶液', '滴眼液', '气雾剂', '喷雾剂',
+    '吸入剂', '颗粒', '胶囊', '软膏', '乳膏', '糖浆', '片剂', '粉针', '针剂', '贴剂', '栓', '片', '针',
+    'extended-release', 'sustained-release', 'tablets', 'tablet', 'capsules', 'capsule', 'injection',
+    'suspension', 'syrup', 'tabs', 'tab', 'caps', 'cap', 'inj', 'sr', 'er', 'xr', 'cr',
+)
+SALT_PREFIXES = ('盐酸', '硫酸', '马来酸', '苯磺酸', '富马酸', '酒石酸', '琥珀酸', '甲磺酸', '醋酸')
+SPLIT_PATTERN = re.compile(r'[,，、;；/\n]+')
+# 处方药物的结构：药名单独一项，规范化只看药名
+MEDICATION_FIELDS = ('name', 'dose', 'frequency')
+
+
+class DrugMatch(NamedTuple):
+    query: str
+    drug_id: Optional[str]
+    name: str
+    method: str  # exact / fuzzy / unknown
+    distance: int = 0
+    # 近似匹配到的通用名，仅供提示“是否为”，不作为识别结果（drug_id 为 None）
+    suggestion: Optional[str] = None
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein 距离，超过 limit 时提前返回 limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """基于编辑距离的 BK 树，用于容错查找（错别字、语音识别同音字）"""
+
+    def __init__(self):
+        self.root: Optional[Tuple[str, Dict[int, tuple]]] = None
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0], len(word) + len(node[0]))
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word: str, max_distance: int) -> List[Tuple[int, str]]:
+        if self.root is None:
+            return []
+        results = []
+        stack = [self.root]
+        while stack:
+            candidate, children = stack.pop()
+            distance = edit_distance(word, candidate, max_distance + len(word) + len(candidate))
+            if distance <= max_distance:
+                results.append((distance, candidate))
+            for d in range(distance - max_distance, distance + max_distance + 1):
+                child = children.get(d)
+                if child is not None:
+                    stack.append(child)
+        return sorted(results)
+
+
+def clean_drug_name(name: str) -> str:
+    """统一全半角与大小写，去掉剂量、频次、剂型和标点"""
+    text = unicodedata.normalize('NFKC', name).lower().strip()
+    text = re.sub(r'[（(][^）)]*[）)]', ' ', text)
+    text = FREQUENCY_PATTERN.sub(' ', text)
+    text = DOSAGE_PATTERN.sub(' ', text)
+    text = re.sub(r'[\s\-_·.,，。:：]+', ' ', text).strip()
+    changed = True
+    while changed and text:
+        changed = False
+        for suffix in FORM_SUFFIXES:
+            if text.endswith(suffix) and len(text) > len(suffix):
+                text = text[:-len(suffix)].strip()
+                changed = True
+    return text.replace(' ', '')
+
+
+def split_drug_list(text: Optional[str]) -> List[str]:
+    """拆分患者填写的药物/过敏史列表，兼容中英文分隔符；“无”视为空"""
+    if not text or text.strip() == '无':
+        return []
+    return [part.strip() for part in SPLIT_PATTERN.split(text) if part.strip()]
+
+
+def unique_drug_list(names: List[str]) -> List[str]:
+    """保留原文（含剂量、用法），只去掉空白和完全重复（忽略全半角、大小写）的条目"""
+    result = []
+    seen = set()
+    for name in names:
+        text = str(name).strip()
+        key = unicodedata.normalize('NFKC', text).lower()
+        if text and key not in seen:
+            seen.add(key)
+            result.append(text)
+    return result
+
+
+def as_medication(item) -> Dict[str, str]:
+    """处方药物统一为 {'name', 'dose', 'frequency'}；旧数据中的文本整体作为药名"""
+    if isinstance(item, dict):
+        return {field: str(item.get(field) or '').strip() for field in MEDICATION_FIELDS}
+    return {'name': str(item).strip(), 'dose': '', 'frequency': ''}
+
+
+def medication_text(medication) -> str:
+    """'药名 剂量 用法'，只用于提示词、报告和界面显示"""
+    medication = as_medication(medication)
+    return ' '.join(medication[field] for field in MEDICATION_FIELDS if medication[field])
+
+
+def unique_medications(items: List) -> List[Dict[str, str]]:
+    """去掉没有药名和完全重复（忽略全半角、大小写）的条目"""
+    result = []
+    seen = set()
+    for item in items:
+        medication = as_medication(item)
+        key = unicodedata.normalize('NFKC', medication_text(medication)).lower()
+        if medication['name'] and key not in seen:
+            seen.add(key)
+            result.append(medication)
+    return result
+
+
+class DrugNormalizer:
+    """把药名（中文通用名、英文名、商品名、带剂量的写法）映射到统一的药物 ID
+
+    词表在第一次查询时从 DRUG_LEXICON_PATH 加载：只有精确匹配（同义词字典）才映射到药物 ID。
+    查不到时在 BK 树上按编辑距离容错查找，结果只作为建议：头孢克洛/头孢克肟、
+    氧氟沙星/左氧氟沙星这类只差一个字的是不同药物，不能替换；多个药物距离相同则不给建议。
+    """
+
+    def __init__(self, lexicon_path: str = DRUG_LEXICON_PATH):
+        self.lexicon_path = lexicon_path
+        self._aliases: Dict[str, str] = {}
+        self._names: Dict[str, str] = {}
+        self._tree = BKTree()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with open(self.lexicon_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip() or line.startswith('#'):
+                        continue
+                    drug_id, name_zh, name_en, aliases = (line.rstrip('\n').split('\t') + [''] * 4)[:4]
+                    self._names[drug_id] = name_zh
+                    for alias in [name_zh, name_en, drug_id] + aliases.split('|'):
+                        key = clean_drug_name(alias)
+                        if key and key not in self._aliases:
+                            self._aliases[key] = drug_id
+                            self._tree.add(key)
+            self._loaded = True
+
+    @staticmethod
+    def _max_distance(key: str) -> int:
+        # 短中文药名容错过宽会误配，4 字以上才允许 1 处差异
+        if key.isascii():
+            return 0 if len(key) < 5 else (1 if len(key) < 9 else 2)
+        return 0 if len(key) < 4 else (1 if len(key) < 8 else 2)
+
+    @lru_cache(maxsize=4096)
+    def normalize(self, name: str) -> DrugMatch:
+        self._load()
+        key = clean_drug_name(name)
+        if not key:
+            return DrugMatch(name, None, name.strip(), 'unknown')
+
+        candidates = [key]
+        for prefix in SALT_PREFIXES:
+            if key.startswith(prefix) and len(key) > len(prefix) + 1:
+                candidates.append(key[len(prefix):])
+        for candidate in candidates:
+            drug_id = self._aliases.get(candidate)
+            if drug_id:
+                return DrugMatch(name, drug_id, self._names[drug_id], 'exact')
+
+        max_distance = self._max_distance(key)
+        if max_distance:
+            matches = self._tree.search(key, max_distance)
+            if matches:
+                best = matches[0][0]
+                ids = {self._aliases[alias] for distance, alias in matches if distance == best}
+                if len(ids) == 1:
+                    return DrugMatch(name, None, name.strip(), 'fuzzy', best, self._names[ids.pop()])
+        return DrugMatch(name, None, name.strip(), 'unknown')
+
+    def canonical_list(self, names: List[str]) -> List[str]:
+        """规范化并去重：精确匹配的药物返回通用名（不含剂量），其余保留原文"""
+        result = []
+        seen = set()
+        for name in names:
+            match = self.normalize(name)
+            key = match.drug_id or clean_drug_name(name)
+            if key and key not in seen:
+                seen.add(key)
+                result.append(match.name)
+        return result
+
+    def annotate_list(self, names: List[str]) -> List[str]:
+        """供安全检查使用：保留原文（含剂量、用法），只去掉完全重复的条目
+
+        写法与通用名不同的已知药物附注通用名；近似匹配只附注建议，提醒核对，原文不变。
+        """
+        return [text + self._annotation(text) for text in unique_drug_list(names)]
+
+    def annotate_medications(self, medications: List) -> List[str]:
+        """处方药物渲染为“药名 剂量 用法”文本，按药名附注通用名
+
+        按药物 ID 去重：商品名、英文名写法不同但药物、剂量、用法都相同的条目只保留一条。
+        """
+        result = []
+        seen = set()
+        for medication in unique_medications(medications):
+            match = self.normalize(medication['name'])
+            key = (match.drug_id or clean_drug_name(medication['name']),
+                   *(''.join(unicodedata.normalize('NFKC', medication[field]).lower().split())
+                     for field in ('dose', 'frequency')))
+            if key not in seen:
+                seen.add(key)
+                result.append(medication_text(medication) + self._annotation(medication['name']))
+        return result
+
+    def _annotation(self, name: str) -> str:
+        match = self.normalize(name)
+        if match.method == 'exact':
+            # 原文已经是中文或英文通用名时不附注，提示词不必变长
+            if match.name in name or clean_drug_name(name) == clean_drug_name(match.drug_id):
+                return ''
+            return f"（通用名：{match.name}）"
+        if match.method == 'fuzzy':
+            return f"（词表中未找到，可能是{match.suggestion}，请核对）"
+        return ''
+
+
+_normalizer = None
+
+
+def get_normalizer() -> DrugNormalizer:
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = DrugNormalizer()
+    return _normalizer
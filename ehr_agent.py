@@ -6,14 +6,17 @@ from rich.panel import Panel
 from rich.prompt import Prompt, Confirm
 
 from config import (
-    GOOGLE_API_KEY, GEMINI_MODEL, RECORDINGS_DIR, OUTPUT_DIR,
+    GOOGLE_API_KEY, GEMINI_MODEL, GENERATION_MODE, RECORDINGS_DIR, OUTPUT_DIR,
     MICROPHONE_INDEX
 )
-from voice_recorder import VoiceRecorder
-from speech_to_text import SpeechToText
 from soap_generator import SOAPGenerator
 from examination_recommender import ExaminationRecommender
 from drug_checker import DrugChecker
+from consolidated_generator import ConsolidatedGenerator
+from drug_normalizer import medication_text, split_drug_list
+from fhir_export import save_record
+import audit_log
+import prompts
 
 console = Console()
 
@@ -29,20 +32,41 @@ class EHRAgent:
             raise ValueError("GOOGLE_API_KEY 未设置或无效")
         
        
-        # init
-        self.voice_recorder = VoiceRecorder()
-        self.speech_to_text = SpeechToText(google_api_key=GOOGLE_API_KEY)
+        # init（音频组件在选择语音输入时才加载）
+        self._voice_recorder = None
+        self._speech_to_text = None
         self.soap_generator = SOAPGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
         self.exam_recommender = ExaminationRecommender(GOOGLE_API_KEY, GEMINI_MODEL)
         self.drug_checker = DrugChecker(GOOGLE_API_KEY, GEMINI_MODEL)
+        prompts.use_token_counter(self.soap_generator.model.count_tokens)
+        self.consolidated_generator = (ConsolidatedGenerator(GOOGLE_API_KEY, GEMINI_MODEL)
+                                       if GENERATION_MODE == 'consolidated' else None)
         
         self.consultation_transcript = ""
         self.patient_info = {}
         self.soap_data = {}
+        # 各阶段结果，保存报告时直接复用；合并模式下检查推荐和药物列表随 SOAP 一起生成
+        self.examinations = None
+        self.prescribed_drugs = None
+        self.check_results = None
         
         os.makedirs(RECORDINGS_DIR, exist_ok=True)
         os.makedirs(OUTPUT_DIR, exist_ok=True)
     
+    @property
+    def voice_recorder(self):
+        if self._voice_recorder is None:
+            from voice_recorder import VoiceRecorder
+            self._voice_recorder = VoiceRecorder()
+        return self._voice_recorder
+    
+    @property
+    def speech_to_text(self):
+        if self._speech_to_text is None:
+            from speech_to_text import SpeechToText
+            self._speech_to_text = SpeechToText(google_api_key=GOOGLE_API_KEY)
+        return self._speech_to_text
+    
     def collect_patient_info(self) -> Dict:
         console.print("\n[bold cyan]收集患者基本信息[/bold cyan]")
         info = {}
@@ -93,10 +117,18 @@ class EHRAgent:
     
     def generate_soap_note(self) -> Dict:
         console.print("\n[bold cyan]正在生成SOAP病历...[/bold cyan]")
-        soap_data = self.soap_generator.generate_soap(
-            self.consultation_transcript,
-            self.patient_info
-        )
+        self.examinations = self.prescribed_drugs = self.check_results = None
+        if self.consolidated_generator is not None:
+            combined = self.consolidated_generator.generate(self.consultation_transcript, self.patient_info)
+            soap_data = combined['soap']
+            if 'error' not in soap_data:
+                self.examinations = combined['examinations']
+                self.prescribed_drugs = combined['prescribed_drugs']
+        else:
+            soap_data = self.soap_generator.generate_soap(
+                self.consultation_transcript,
+                self.patient_info
+            )
         self.soap_data = soap_data
         soap_text = self.soap_generator.format_soap_text(soap_data)
         console.print(Panel(soap_text, title="SOAP 病历", border_style="cyan"))
@@ -104,30 +136,29 @@ class EHRAgent:
     
     def recommend_examinations(self) -> List[Dict]:
         console.print("\n[bold cyan]正在推荐检查项目...[/bold cyan]")
-        examinations = self.exam_recommender.recommend_examinations(
-            self.soap_data,
-            self.consultation_transcript
-        )
+        if self.examinations is None:
+            self.examinations = self.exam_recommender.recommend_examinations(
+                self.soap_data,
+                self.consultation_transcript,
+                self.patient_info
+            )
+        examinations = self.examinations
         exam_text = self.exam_recommender.format_recommendations(examinations)
         console.print(Panel(exam_text, title="检查项目推荐", border_style="green"))
         return examinations
     
     def check_drug_conflicts(self) -> Dict:
         console.print("\n[bold cyan]正在检查药物冲突...[/bold cyan]")
-        plan_text = self.soap_data.get('plan', '')
-        prescribed_drugs = self.drug_checker.extract_drugs_from_plan(plan_text)
+        if self.prescribed_drugs is None:
+            self.prescribed_drugs = self.drug_checker.extract_drugs_from_plan(self.soap_data.get('plan', ''))
+        prescribed_drugs = self.prescribed_drugs
         
         if not prescribed_drugs:
             console.print("[yellow]未在治疗计划中发现药物，跳过药物冲突检查[/yellow]")
             return {}
         
-        allergies = []
-        if self.patient_info.get('allergies') and self.patient_info['allergies'] != '无':
-            allergies = [a.strip() for a in self.patient_info['allergies'].split(',')]
-        
-        current_meds = []
-        if self.patient_info.get('current_medications') and self.patient_info['current_medications'] != '无':
-            current_meds = [m.strip() for m in self.patient_info['current_medications'].split(',')]
+        allergies = split_drug_list(self.patient_info.get('allergies'))
+        current_meds = split_drug_list(self.patient_info.get('current_medications'))
         
         check_results = self.drug_checker.check_drug_conflicts(
             prescribed_drugs=prescribed_drugs,
@@ -135,6 +166,7 @@ class EHRAgent:
             current_medications=current_meds if current_meds else None,
             medical_history=self.patient_info.get('medical_history')
         )
+        self.check_results = check_results
         
         check_text = self.drug_checker.format_check_results(check_results)
         console.print(Panel(check_text, title="药物冲突检查", border_style="yellow"))
@@ -144,38 +176,46 @@ class EHRAgent:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"ehr_report_{timestamp}.txt"
         filepath = os.path.join(OUTPUT_DIR, filename)
+        record = {
+            'patient_info': self.patient_info,
+            'transcript': self.consultation_transcript,
+            'soap': self.soap_data,
+        }
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write("="*60 + "\n")
-            f.write("EHR Agent 问诊报告\n")
-            f.write("="*60 + "\n\n")
-            
-            f.write("【患者信息】\n")
-            for key, value in self.patient_info.items():
-                f.write(f"{key}: {value}\n")
-            f.write("\n")
-            
-            f.write("【问诊记录】\n")
-            f.write(self.consultation_transcript + "\n\n")
-            
-            f.write(self.soap_generator.format_soap_text(self.soap_data))
-            f.write("\n")
-            
+        # 报告先在内存中拼好，写入文件和审计摘要用同一份内容
+        parts = []
+        parts.append("="*60 + "\n")
+        parts.append("EHR Agent 问诊报告\n")
+        parts.append("="*60 + "\n\n")
+        
+        parts.append("【患者信息】\n")
+        for key, value in self.patient_info.items():
+            parts.append(f"{key}: {value}\n")
+        parts.append("\n")
+        
+        parts.append("【问诊记录】\n")
+        parts.append(self.consultation_transcript + "\n\n")
+        
+        parts.append(self.soap_generator.format_soap_text(self.soap_data))
+        parts.append("\n")
+        
+        examinations = self.examinations
+        if examinations is None:
             examinations = self.exam_recommender.recommend_examinations(
-                self.soap_data, self.consultation_transcript
+                self.soap_data, self.consultation_transcript, self.patient_info
             )
-            f.write(self.exam_recommender.format_recommendations(examinations))
-            f.write("\n")
-            
-            plan_text = self.soap_data.get('plan', '')
-            prescribed_drugs = self.drug_checker.extract_drugs_from_plan(plan_text)
-            if prescribed_drugs:
-                allergies = []
-                if self.patient_info.get('allergies') and self.patient_info['allergies'] != '无':
-                    allergies = [a.strip() for a in self.patient_info['allergies'].split(',')]
-                current_meds = []
-                if self.patient_info.get('current_medications') and self.patient_info['current_medications'] != '无':
-                    current_meds = [m.strip() for m in self.patient_info['current_medications'].split(',')]
+        record['examinations'] = examinations
+        parts.append(self.exam_recommender.format_recommendations(examinations))
+        parts.append("\n")
+        
+        prescribed_drugs = self.prescribed_drugs
+        if prescribed_drugs is None:
+            prescribed_drugs = self.drug_checker.extract_drugs_from_plan(self.soap_data.get('plan', ''))
+        if prescribed_drugs:
+            check_results = self.check_results
+            if check_results is None:
+                allergies = split_drug_list(self.patient_info.get('allergies'))
+                current_meds = split_drug_list(self.patient_info.get('current_medications'))
                 
                 check_results = self.drug_checker.check_drug_conflicts(
                     prescribed_drugs=prescribed_drugs,
@@ -183,8 +223,18 @@ class EHRAgent:
                     current_medications=current_meds if current_meds else None,
                     medical_history=self.patient_info.get('medical_history')
                 )
-                f.write(self.drug_checker.format_check_results(check_results))
+            record['drug_check'] = {'prescribed_drugs': prescribed_drugs, 'results': check_results}
+            parts.append("【处方药物】\n")
+            parts.append(', '.join(medication_text(drug) for drug in prescribed_drugs) + "\n")
+            parts.append(self.drug_checker.format_check_results(check_results))
         
+        report_content = ''.join(parts)
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(report_content)
+        
+        save_record(filepath, record)
+        audit_log.record('report_saved', filename=filename, client='cli',
+                         patient_id=self.patient_info.get('patient_id'), content=report_content)
         console.print(f"\n[green]报告已保存至: {filepath}[/green]")
         return filepath
     
@@ -204,6 +254,15 @@ class EHRAgent:
             self.patient_info = self.collect_patient_info()
             
             use_voice = Confirm.ask("是否使用语音输入？", default=True)
+            if use_voice:
+                try:
+                    # 麦克风录音依赖 pyaudio（speech_recognition 导入时不检查它），转写依赖音频处理库，
+                    # 任何一个缺失都改为手动输入
+                    import voice_recorder  # noqa: F401
+                    self.speech_to_text
+                except ImportError as e:
+                    console.print(f"[yellow]语音组件不可用（{e}），改为手动输入[/yellow]")
+                    use_voice = False
             
             if use_voice:
                 transcript = self.record_consultation()
@@ -238,7 +297,8 @@ class EHRAgent:
             import traceback
             console.print(f"[dim]{traceback.format_exc()}[/dim]")
         finally:
-            self.voice_recorder.cleanup()
+            if self._voice_recorder is not None:
+                self._voice_recorder.cleanup()
 
 def main():
     agent = EHRAgent()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+检查项目推荐缓存：按（初步诊断 + 年龄段 + 性别）缓存推荐结果
+
+预热: python exam_cache.py warm [--reports output] [--top 50]
+"""
+import argparse
+import atexit
+import copy
+import glob
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, List, Optional
+
+from config import (OUTPUT_DIR, EXAM_CACHE_PATH, EXAM_CACHE_SIZE, EXAM_CACHE_TTL, EXAM_CACHE_WARM_TOP,
+                    EXAM_CACHE_SAVE_DELAY)
+from metrics import metrics
+
+# 诊断中的不确定性修饰词不影响检查方案
+DIAGNOSIS_QUALIFIERS = re.compile(r'[?？]|待查|待排|可能性大|可能|考虑|疑似|不除外|初步|诊断')
+PRIORITY_HEADINGS = {'【高优先级】': '高', '【中优先级】': '中', '【低优先级】': '低'}
+# 推荐理由是针对某位患者写的，不进入缓存；命中时换成这条说明
+CACHED_REASON = '相同诊断、年龄段和性别的常用检查方案'
+
+
+def normalize_diagnosis(diagnosis: str) -> str:
+    text = unicodedata.normalize('NFKC', diagnosis).lower()
+    text = re.sub(r'^\s*\d+[.、)]\s*', '', text)
+    text = DIAGNOSIS_QUALIFIERS.sub('', text)
+    return re.sub(r'[\s\-_,，。.;；:：()（）\[\]【】]+', '', text)
+
+
+def age_band(age) -> str:
+    match = re.search(r'\d+', str(age or ''))
+    if not match:
+        return 'unknown'
+    years = int(match.group())
+    if years < 18:
+        return '0-17'
+    if years < 40:
+        return '18-39'
+    if years < 65:
+        return '40-64'
+    return '65+'
+
+
+def sex_code(gender) -> str:
+    gender = str(gender or '').strip().lower()
+    if gender in ('男', 'm', 'male'):
+        return 'M'
+    if gender in ('女', 'f', 'female'):
+        return 'F'
+    return 'U'
+
+
+def make_key(diagnoses, patient_info: Optional[Dict] = None) -> Optional[str]:
+    if isinstance(diagnoses, str):
+        diagnoses = re.split(r'[,，、;；\n]+', diagnoses)
+    normalized = sorted({normalize_diagnosis(d) for d in diagnoses or [] if d})
+    normalized = [d for d in normalized if d]
+    if not normalized:
+        return None
+    patient_info = patient_info or {}
+    return f"{'|'.join(normalized)}#{age_band(patient_info.get('age'))}#{sex_code(patient_info.get('gender'))}"
+
+
+class ExamBundleCache:
+    """LRU 缓存，持久化到 JSON 文件；文件被其他进程更新后自动重新加载
+
+    写入只更新内存并安排一次延迟落盘（save_delay 秒后在后台线程执行），请求路径上不写文件。
+    """
+
+    def __init__(self, path: str = EXAM_CACHE_PATH, capacity: int = EXAM_CACHE_SIZE,
+                 ttl: float = EXAM_CACHE_TTL, save_delay: float = EXAM_CACHE_SAVE_DELAY):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.save_delay = save_delay
+        self._entries: 'OrderedDict[str, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._mtime = None
+        # 尚未落盘的键；重新加载文件时保留它们的内存版本
+        self._dirty = set()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取检查推荐缓存失败: {e}")
+            return
+        entries = OrderedDict(entries)
+        for key in self._dirty:
+            if key in self._entries:
+                entries.pop(key, None)
+                entries[key] = self._entries[key]
+        while len(entries) > self.capacity:
+            entries.popitem(last=False)
+        self._entries = entries
+        self._mtime = mtime
+
+    def _schedule_save(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """把未落盘的写入保存到文件：在锁内序列化，锁外写文件"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._reload_if_changed()
+            data = json.dumps(self._entries, ensure_ascii=False)
+            self._dirty.clear()
+        with self._save_lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+            mtime = os.path.getmtime(self.path)
+        with self._lock:
+            self._mtime = mtime
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            self._reload_if_changed()
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry['updated_at'] > self.ttl:
+                metrics.inc('exam_cache_total', result='miss')
+                return None
+            self._entries.move_to_end(key)
+            entry['hits'] = entry.get('hits', 0) + 1
+        metrics.inc('exam_cache_total', result='hit')
+        return [dict(exam, reason=CACHED_REASON) for exam in copy.deepcopy(entry['examinations'])]
+
+    def put(self, key: str, examinations: List[Dict], source: str = 'model'):
+        if not examinations:
+            return
+        with self._lock:
+            self._reload_if_changed()
+            previous = self._entries.pop(key, {})
+            self._entries[key] = {
+                'examinations': [{k: v for k, v in exam.items() if k != 'reason'}
+                                 for exam in copy.deepcopy(examinations)],
+                'updated_at': time.time(),
+                'hits': previous.get('hits', 0),
+                'source': source,
+            }
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._dirty.add(key)
+            self._schedule_save()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def parse_report(text: str) -> Optional[Dict]:
+    """从保存的问诊报告中解析诊断、年龄、性别和推荐检查项目"""
+    patient_info = {}
+    for label, field in (('age', 'age'), ('年龄', 'age'), ('gender', 'gender'), ('性别', 'gender')):
+        match = re.search(rf'^{label}:\s*(.+)$', text, re.MULTILINE)
+        if match and field not in patient_info:
+            patient_info[field] = match.group(1).strip()
+
+    diagnoses = None
+    match = re.search(r'【初步诊断】\n(.*)', text) or re.search(r'^初步诊断:\s*(.*)$', text, re.MULTILINE)
+    if match:
+        diagnoses = match.group(1).strip()
+
+    examinations = []
+    if '【推荐检查项目】' in text:
+        section = text.split('【推荐检查项目】', 1)[1]
+        priority = None
+        lines = section.splitlines()
+        for i, line in enumerate(lines):
+            if line.strip() in PRIORITY_HEADINGS:
+                priority = PRIORITY_HEADINGS[line.strip()]
+                continue
+            if line.startswith('【'):
+                break
+            item = re.match(r'^\d+\.\s*(.+?)\s*\(([^()]*)\)\s*$', line)
+            if item and priority:
+                reason = ''
+                if i + 1 < len(lines) and lines[i + 1].strip().startswith('理由:'):
+                    reason = lines[i + 1].strip()[len('理由:'):].strip()
+                examinations.append({'name': item.group(1), 'type': item.group(2),
+                                     'reason': reason, 'priority': priority})
+
+    key = make_key(diagnoses, patient_info)
+    if not key or not examinations:
+        return None
+    return {'key': key, 'examinations': examinations}
+
+
+def warm_from_reports(cache: ExamBundleCache, reports_dir: str = OUTPUT_DIR,
+                      top: int = EXAM_CACHE_WARM_TOP) -> Dict:
+    """用历史报告预热缓存：取最常见的 top 个诊断键，保留在过半报告中出现的检查项目"""
+    bundles = defaultdict(list)
+    for path in glob.glob(os.path.join(reports_dir, 'ehr_report_*.txt')):
+        try:
+            with open(path, encoding='utf-8') as f:
+                parsed = parse_report(f.read())
+        except OSError:
+            continue
+        if parsed:
+            bundles[parsed['key']].append(parsed['examinations'])
+
+    ranked = sorted(bundles.items(), key=lambda item: len(item[1]), reverse=True)[:top]
+    for key, reports in ranked:
+        counts = Counter(exam['name'] for exams in reports for exam in exams)
+        latest = {exam['name']: exam for exams in reports for exam in exams}
+        selected = [latest[name] for name, n in counts.most_common() if n * 2 >= len(reports)]
+        cache.put(key, selected, source='warmup')
+    cache.flush()
+    return {'reports': sum(len(r) for r in bundles.values()), 'keys': len(bundles), 'warmed': len(ranked)}
+
+
+_cache = None
+
+
+def get_exam_cache() -> ExamBundleCache:
+    global _cache
+    if _cache is None:
+        _cache = ExamBundleCache()
+    return _cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查项目推荐缓存")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    warm = subparsers.add_parser('warm', help='用历史报告预热缓存')
+    warm.add_argument('--reports', default=OUTPUT_DIR)
+    warm.add_argument('--top', type=int, default=EXAM_CACHE_WARM_TOP)
+    args = parser.parse_args()
+
+    if args.command == 'warm':
+        summary = warm_from_reports(get_exam_cache(), args.reports, args.top)
+        print(f"解析报告 {summary['reports']} 份，诊断键 {summary['keys']} 个，已预热 {summary['warmed']} 个")
+
+
+if __name__ == '__main__':
+    main()
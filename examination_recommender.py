@@ -1,50 +1,85 @@
-import google.generativeai as genai
-from typing import List, Dict
+from typing import List, Dict, Optional
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from gemini_client import GeminiModel
+from model_router import json_validator
+from config import EXAM_CACHE_ENABLED, EXAM_CACHE_REFINE
+from exam_cache import get_exam_cache, make_key
+from metrics import metrics
+from prompts import EXAMINATIONS_PROMPT
+import model_scheduler
+
+# 每个检查项目都要有名称和有效的优先级，否则升级到主模型
+validate_examinations = json_validator(lambda result: (
+    isinstance(result.get('examinations'), list)
+    and all(isinstance(e, dict) and e.get('name') and e.get('priority') in ('高', '中', '低')
+            for e in result['examinations'])
+))
 
 class ExaminationRecommender:
-    def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash",
+                 use_cache: bool = EXAM_CACHE_ENABLED, refine_cached: bool = EXAM_CACHE_REFINE,
+                 temperature: float = 0.3):
+        self.model = GeminiModel(api_key, model)
+        self.temperature = temperature
+        self.cache = get_exam_cache() if use_cache else None
+        self.refine_cached = refine_cached
+        self._refining = set()
+        self._refine_lock = threading.Lock()
+        self._refine_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='exam-refine')
     
-    def recommend_examinations(self, soap_data: Dict, consultation_transcript: str) -> List[Dict]:
-        prompt = f"""
-你是一位经验丰富的临床医生。请根据以下SOAP病历和问诊记录，推荐必要的检查项目。
-
-SOAP病历摘要：
-- 主诉：{soap_data.get('chief_complaint', '未提供')}
-- 初步诊断：{', '.join(soap_data.get('preliminary_diagnosis', []))}
-- 评估：{soap_data.get('assessment', '')}
-
-问诊记录：
-{consultation_transcript[:1000]}...
-
-请推荐必要的检查项目，包括：
-1. 常规检查（血常规、尿常规等）
-2. 生化检查（肝肾功能、血糖等）
-3. 影像学检查（X光、CT、MRI、超声等）
-4. 特殊检查（根据病情需要）
-
-对于每个推荐的检查项目，请说明：
-- 检查名称
-- 检查类型（常规/生化/影像/特殊）
-- 推荐理由
-- 优先级（高/中/低）
-
-请以JSON格式返回，包含一个examinations数组，每个元素包含：
-- name: 检查名称
-- type: 检查类型
-- reason: 推荐理由
-- priority: 优先级
-"""
+    def recommend_examinations(self, soap_data: Dict, consultation_transcript: str,
+                               patient_info: Optional[Dict] = None) -> List[Dict]:
+        # 常见诊断的检查方案基本固定，按诊断 + 年龄段 + 性别复用
+        key = make_key(soap_data.get('preliminary_diagnosis'), patient_info) if self.cache is not None else None
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if self.refine_cached:
+                    self._refine_in_background(key, soap_data, consultation_transcript)
+                return cached
+        
+        examinations = self._generate(soap_data, consultation_transcript)
+        if key:
+            self.cache.put(key, examinations)
+        return examinations
+    
+    def _refine_in_background(self, key: str, soap_data: Dict, consultation_transcript: str):
+        """先返回缓存结果，再用低优先级的模型调用结合本次问诊刷新缓存"""
+        with self._refine_lock:
+            if key in self._refining:
+                return
+            self._refining.add(key)
+        
+        def refine():
+            try:
+                with model_scheduler.lane('batch'):
+                    examinations = self._generate(soap_data, consultation_transcript)
+                self.cache.put(key, examinations, source='refine')
+                metrics.inc('exam_cache_refine_total', result='ok' if examinations else 'empty')
+            finally:
+                with self._refine_lock:
+                    self._refining.discard(key)
+        
+        self._refine_executor.submit(refine)
+    
+    def _generate(self, soap_data: Dict, consultation_transcript: str) -> List[Dict]:
+        soap_summary = (f"- 主诉：{soap_data.get('chief_complaint', '未提供')}\n"
+                        f"- 初步诊断：{', '.join(soap_data.get('preliminary_diagnosis', []))}\n"
+                        f"- 评估：{soap_data.get('assessment', '')}")
+        prompt = EXAMINATIONS_PROMPT.render(soap_summary=soap_summary,
+                                            transcript=consultation_transcript[:1000] + '...')
         
         try:
             generation_config = {
-                "temperature": 0.3,
+                "temperature": self.temperature,
                 "response_mime_type": "application/json",
             }
             
-            response = self.model.generate_content(prompt, generation_config=generation_config)
+            response = self.model.generate_content(prompt, generation_config=generation_config, stage='examinations',
+                                                   validate=validate_examinations,
+                                                   system_instruction=EXAMINATIONS_PROMPT.system_instruction)
             result = json.loads(response.text)
             return result.get('examinations', [])
             
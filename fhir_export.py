@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+FHIR 批量导出：把保存报告时一并写入的结构化记录转换为 FHIR R4 资源（NDJSON）
+
+导出: python fhir_export.py [--since 2024-05-01] [--until 2024-05-31] [--out export]
+
+记录逐条读取、逐个资源写出，内存占用与导出的时间范围无关。
+"""
+import argparse
+import glob
+import html
+import json
+import os
+import uuid
+from datetime import date, datetime, time as dt_time
+from typing import Dict, Iterator, List, Optional
+
+import audit_log
+from config import OUTPUT_DIR
+from drug_normalizer import as_medication, get_normalizer
+
+RESOURCE_TYPES = ('Composition', 'Condition', 'ServiceRequest', 'MedicationRequest', 'DetectedIssue')
+RECORD_PREFIX = 'ehr_report_'
+TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S'
+
+LOINC = 'http://loinc.org'
+ACT_CODE = 'http://terminology.hl7.org/CodeSystem/v3-ActCode'
+DRUG_LEXICON_SYSTEM = 'urn:ehr-agent:drug-lexicon'
+ID_NAMESPACE = uuid.UUID('6f1c3c0e-4a51-4f0e-9a55-0c7d3b8e2a10')
+
+SOAP_SECTIONS = (
+    ('chief_complaint', '主诉', '10154-3', 'Chief complaint Narrative'),
+    ('subjective', '主观资料 (S)', '61150-9', 'Subjective Narrative'),
+    ('objective', '客观资料 (O)', '61149-1', 'Objective Narrative'),
+    ('assessment', '评估 (A)', '51848-0', 'Evaluation note'),
+    ('plan', '计划 (P)', '18776-5', 'Plan of care note'),
+)
+PRIORITY_CODES = {'高': 'urgent', '中': 'routine', '低': 'routine'}
+SEVERITY_CODES = {'高': 'high', '中': 'moderate', '低': 'low'}
+# (检查结果字段, 标题, v3-ActCode)
+ISSUE_KINDS = (
+    ('allergy_warnings', '过敏警告', 'ALGY'),
+    ('drug_interactions', '药物相互作用', 'DRG'),
+    ('contraindications', '禁忌症', None),
+    ('dosage_warnings', '剂量警告', 'DOSE'),
+)
+
+
+def record_path(report_path: str) -> str:
+    return os.path.splitext(report_path)[0] + '.json'
+
+
+def save_record(report_path: str, record: Dict) -> str:
+    """在文本报告旁保存结构化记录，供导出使用"""
+    path = record_path(report_path)
+    record = dict(record, id=os.path.basename(os.path.splitext(report_path)[0])[len(RECORD_PREFIX):],
+                  saved_at=datetime.now().isoformat(timespec='seconds'))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _record_time(path: str) -> Optional[datetime]:
+    stamp = os.path.basename(path)[len(RECORD_PREFIX):-len('.json')][:15]
+    try:
+        return datetime.strptime(stamp, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def iter_records(reports_dir: str = OUTPUT_DIR, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None) -> Iterator[Dict]:
+    """按时间顺序逐条读取记录；时间取自文件名，范围之外的文件不会被打开"""
+    for path in sorted(glob.glob(os.path.join(reports_dir, f'{RECORD_PREFIX}*.json'))):
+        saved = _record_time(path)
+        if saved is None or (since and saved < since) or (until and saved > until):
+            continue
+        try:
+            with open(path, encoding='utf-8') as f:
+                yield json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取记录失败 {path}: {e}")
+
+
+def _id(record_id: str, *parts) -> str:
+    return str(uuid.uuid5(ID_NAMESPACE, '/'.join([record_id, *map(str, parts)])))
+
+
+def _narrative(text: str) -> Dict:
+    body = html.escape(text or '').replace('\n', '<br/>')
+    return {'status': 'generated', 'div': f'<div xmlns="http://www.w3.org/1999/xhtml">{body}</div>'}
+
+
+def _issue_text(item) -> str:
+    if isinstance(item, dict):
+        drugs = item.get('drugs')
+        if isinstance(drugs, list):
+            drugs = ' + '.join(map(str, drugs))
+        return f"{drugs}: {item.get('description', '')}" if drugs else item.get('description', json.dumps(item, ensure_ascii=False))
+    return str(item)
+
+
+def record_to_resources(record: Dict) -> Iterator[Dict]:
+    """把一条问诊记录转换为 FHIR 资源，Composition 最后产出并引用同一记录中的其他资源"""
+    record_id = record['id']
+    saved_at = record.get('saved_at')
+    patient_info = record.get('patient_info') or {}
+    subject = {'display': patient_info.get('name') or '未知患者'}
+    soap = record.get('soap') or {}
+    entries = {resource_type: [] for resource_type in RESOURCE_TYPES}
+
+    def emit(resource: Dict) -> Dict:
+        entries[resource['resourceType']].append({'reference': f"{resource['resourceType']}/{resource['id']}"})
+        return resource
+
+    diagnoses = soap.get('preliminary_diagnosis') or []
+    if isinstance(diagnoses, str):
+        diagnoses = [diagnoses]
+    for i, diagnosis in enumerate(diagnoses):
+        yield emit({
+            'resourceType': 'Condition',
+            'id': _id(record_id, 'Condition', i),
+            'clinicalStatus': {'coding': [{
+                'system': 'http://terminology.hl7.org/CodeSystem/condition-clinical', 'code': 'active'}]},
+            'verificationStatus': {'coding': [{
+                'system': 'http://terminology.hl7.org/CodeSystem/condition-ver-status', 'code': 'provisional'}]},
+            'category': [{'coding': [{
+                'system': 'http://terminology.hl7.org/CodeSystem/condition-category',
+                'code': 'encounter-diagnosis'}]}],
+            'code': {'text': diagnosis},
+            'subject': subject,
+            'recordedDate': saved_at,
+        })
+
+    for i, exam in enumerate(record.get('examinations') or []):
+        resource = {
+            'resourceType': 'ServiceRequest',
+            'id': _id(record_id, 'ServiceRequest', i),
+            'status': 'draft',
+            'intent': 'proposal',
+            'priority': PRIORITY_CODES.get(exam.get('priority'), 'routine'),
+            'code': {'text': exam.get('name', '')},
+            'subject': subject,
+            'authoredOn': saved_at,
+        }
+        if exam.get('type'):
+            resource['category'] = [{'text': exam['type']}]
+        if exam.get('reason'):
+            resource['reasonCode'] = [{'text': exam['reason']}]
+        yield emit(resource)
+
+    drug_check = record.get('drug_check') or {}
+    normalizer = get_normalizer()
+    medication_refs = []
+    for i, drug in enumerate(drug_check.get('prescribed_drugs') or []):
+        drug = as_medication(drug)
+        match = normalizer.normalize(drug['name'])
+        medication = {'text': drug['name']}
+        if match.drug_id:
+            medication['coding'] = [{'system': DRUG_LEXICON_SYSTEM, 'code': match.drug_id, 'display': match.name}]
+        request_resource = {
+            'resourceType': 'MedicationRequest',
+            'id': _id(record_id, 'MedicationRequest', i),
+            'status': 'draft',
+            'intent': 'proposal',
+            'medicationCodeableConcept': medication,
+            'subject': subject,
+            'authoredOn': saved_at,
+        }
+        dosage = ' '.join(drug[field] for field in ('dose', 'frequency') if drug[field])
+        if dosage:
+            request_resource['dosageInstruction'] = [{'text': dosage}]
+        resource = emit(request_resource)
+        medication_refs.append({'reference': f"MedicationRequest/{resource['id']}"})
+        yield resource
+
+    results = drug_check.get('results') or {}
+    for field, title, code in ISSUE_KINDS:
+        for i, item in enumerate(results.get(field) or []):
+            issue_code = {'text': title}
+            if code:
+                issue_code['coding'] = [{'system': ACT_CODE, 'code': code}]
+            resource = {
+                'resourceType': 'DetectedIssue',
+                'id': _id(record_id, 'DetectedIssue', field, i),
+                'status': 'preliminary',
+                'code': issue_code,
+                'patient': subject,
+                'identifiedDateTime': saved_at,
+                'detail': _issue_text(item),
+            }
+            if results.get('severity') in SEVERITY_CODES:
+                resource['severity'] = SEVERITY_CODES[results['severity']]
+            if medication_refs:
+                resource['implicated'] = medication_refs
+            yield emit(resource)
+
+    sections = []
+    for field, title, code, display in SOAP_SECTIONS:
+        if soap.get(field):
+            sections.append({
+                'title': title,
+                'code': {'coding': [{'system': LOINC, 'code': code, 'display': display}]},
+                'text': _narrative(soap[field]),
+            })
+    for resource_type, title in (('Condition', '初步诊断'), ('ServiceRequest', '推荐检查项目'),
+                                 ('MedicationRequest', '处方药物'), ('DetectedIssue', '药物安全检查')):
+        if entries[resource_type]:
+            sections.append({'title': title, 'entry': entries[resource_type]})
+    yield {
+        'resourceType': 'Composition',
+        'id': _id(record_id, 'Composition'),
+        'status': 'final',
+        'type': {'coding': [{'system': LOINC, 'code': '11506-3', 'display': 'Progress note'}]},
+        'subject': subject,
+        'date': saved_at,
+        'author': [{'display': 'EHR Agent'}],
+        'title': 'SOAP 病历',
+        'section': sections,
+    }
+
+
+def iter_resources(records: Iterator[Dict], resource_types=RESOURCE_TYPES) -> Iterator[Dict]:
+    for record in records:
+        for resource in record_to_resources(record):
+            if resource['resourceType'] in resource_types:
+                yield resource
+
+
+def iter_ndjson(records: Iterator[Dict], resource_types=RESOURCE_TYPES) -> Iterator[str]:
+    for resource in iter_resources(records, resource_types):
+        yield json.dumps(resource, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def export_to_directory(out_dir: str, records: Iterator[Dict], resource_types=RESOURCE_TYPES) -> Dict[str, int]:
+    """按 FHIR Bulk Data 的约定，每种资源写一个 <类型>.ndjson 文件，返回各类型的数量"""
+    os.makedirs(out_dir, exist_ok=True)
+    files = {t: open(os.path.join(out_dir, f'{t}.ndjson'), 'w', encoding='utf-8') for t in resource_types}
+    counts = {t: 0 for t in resource_types}
+    try:
+        for resource in iter_resources(records, resource_types):
+            resource_type = resource['resourceType']
+            files[resource_type].write(json.dumps(resource, ensure_ascii=False, separators=(',', ':')) + '\n')
+            counts[resource_type] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+def parse_date_range(since: Optional[str], until: Optional[str]):
+    """since/until 为 ISO 日期或时间；只给日期时 until 包含当天
+
+    记录时间取自文件名（本地时间，不带时区），带时区的时间先换算为本地时间再去掉时区。
+    """
+    def parse(value: Optional[str], end: bool) -> Optional[datetime]:
+        if not value:
+            return None
+        if len(value) == 10:
+            day = date.fromisoformat(value)
+            return datetime.combine(day, dt_time.max if end else dt_time.min)
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is not None:
+            moment = moment.astimezone().replace(tzinfo=None)
+        return moment
+    return parse(since, False), parse(until, True)
+
+
+def parse_resource_types(value: Optional[str]) -> List[str]:
+    if not value:
+        return list(RESOURCE_TYPES)
+    types = [t.strip() for t in value.split(',') if t.strip()]
+    unknown = [t for t in types if t not in RESOURCE_TYPES]
+    if unknown:
+        raise ValueError(f"不支持的资源类型: {', '.join(unknown)}")
+    return types
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出问诊记录为 FHIR NDJSON")
+    parser.add_argument('--reports', default=OUTPUT_DIR, help='报告目录')
+    parser.add_argument('--since', help='起始日期，如 2024-05-01')
+    parser.add_argument('--until', help='结束日期（含），如 2024-05-31')
+    parser.add_argument('--types', help=f"资源类型，逗号分隔，默认全部: {','.join(RESOURCE_TYPES)}")
+    parser.add_argument('--out', default='export', help='输出目录')
+    args = parser.parse_args()
+
+    try:
+        since, until = parse_date_range(args.since, args.until)
+        resource_types = parse_resource_types(args.types)
+    except ValueError as e:
+        parser.error(str(e))
+
+    audit_log.record('fhir_export', since=args.since, until=args.until, types=','.join(resource_types),
+                     client='cli', out=args.out)
+    counts = export_to_directory(args.out, iter_records(args.reports, since, until), resource_types)
+    for resource_type, count in counts.items():
+        print(f"{resource_type}: {count}")
+
+
+if __name__ == '__main__':
+    main()
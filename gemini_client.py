@@ -0,0 +1,205 @@
+import datetime
+import threading
+import time
+from typing import Callable, Optional
+
+import audit_log
+import cancellation
+from config import (MODEL_BACKEND, MODEL_RECORDINGS_PATH, MODEL_REPLAY_LATENCY_SCALE, PROMPT_CACHE_MODE,
+                    PROMPT_CACHE_TTL)
+from metrics import metrics
+from model_router import get_router, record_route
+from model_scheduler import SchedulerTimeout, estimate_tokens, get_scheduler
+
+
+class GeminiModel:
+    """google.generativeai.GenerativeModel 的延迟加载包装
+
+    导入 SDK（连同 gRPC/protobuf）需要一秒以上，推迟到第一次调用模型时才进行，
+    只访问首页、健康检查或不需要模型的命令行流程不必为此付出启动时间。
+    每次调用都先经过全局调度器取得配额，排队时间与模型耗时分别记录。
+    model_name 为主模型；每次调用由路由器按阶段和输入长度决定实际使用的模型。
+    当前上下文有 CancelToken 时以流式接收响应，每个分片之间检查是否已取消，
+    取消后不再等待剩余输出（关闭流即取消上游生成）。
+    每次调用（包括失败和取消）都写一条审计记录。
+    固定指令通过 system_instruction 传入，按 cache_mode（见 config.PROMPT_CACHE_MODE）发送；
+    模型客户端按（模型名, 指令）缓存，explicit 模式下每个组合创建一次缓存内容并在到期前重建。
+    backend 为 local / record / replay 时使用 local_backend 中的离线后端。
+    """
+
+    def __init__(self, api_key: str, model_name: str = "gemini-2.5-flash", lane: str = 'interactive',
+                 cache_mode: str = PROMPT_CACHE_MODE, backend: str = MODEL_BACKEND):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.lane = lane
+        self.cache_mode = cache_mode
+        self.backend = backend
+        self.recordings_path = MODEL_RECORDINGS_PATH
+        self.replay_latency_scale = MODEL_REPLAY_LATENCY_SCALE
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def count_tokens(self, text: str) -> Optional[int]:
+        """用主模型的分词器统计 token 数；无法统计（SDK 不可用、网络错误等）时返回 None"""
+        try:
+            return self.load().count_tokens(text).total_tokens
+        except Exception as e:
+            print(f"统计 token 失败（{self.model_name}）: {e}")
+            return None
+
+    def load(self, model_name: Optional[str] = None, system_instruction: Optional[str] = None):
+        model_name = model_name or self.model_name
+        if self.cache_mode == 'inline':
+            system_instruction = None
+        key = (model_name, system_instruction)
+        entry = self._models.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is None or time.monotonic() >= entry[1]:
+                    entry = self._models[key] = self._create(model_name, system_instruction)
+        return entry[0]
+
+    def _create(self, model_name: str, system_instruction: Optional[str]):
+        """返回 (模型客户端, 需要重建的时刻)"""
+        if self.backend == 'local':
+            from local_backend import LocalModel
+            return LocalModel(model_name, system_instruction, explicit=self.cache_mode == 'explicit'), float('inf')
+        if self.backend == 'replay':
+            from local_backend import ReplayModel, get_recordings
+            return ReplayModel(model_name, system_instruction, get_recordings(self.recordings_path),
+                               self.replay_latency_scale), float('inf')
+        if self.backend == 'record':
+            from local_backend import RecordingModel, get_recordings
+            model, refresh_at = self._create_gemini(model_name, system_instruction)
+            recordings = get_recordings(self.recordings_path)
+            return RecordingModel(model, model_name, system_instruction, recordings), refresh_at
+        return self._create_gemini(model_name, system_instruction)
+
+    def _create_gemini(self, model_name: str, system_instruction: Optional[str]):
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        if system_instruction and self.cache_mode == 'explicit':
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=model_name, system_instruction=system_instruction,
+                    ttl=datetime.timedelta(seconds=PROMPT_CACHE_TTL),
+                )
+                # 留出余量，避免请求发出时缓存刚好过期
+                refresh_at = time.monotonic() + PROMPT_CACHE_TTL - min(300, PROMPT_CACHE_TTL / 10)
+                return genai.GenerativeModel.from_cached_content(cached), refresh_at
+            except Exception as e:
+                # 指令低于模型的最小缓存长度、模型不支持显式缓存等情况，退回 system instruction
+                print(f"创建缓存内容失败（{model_name}），改用 system instruction: {e}")
+                metrics.inc('prompt_cache_errors_total', model=model_name)
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction or None), float('inf')
+
+    def generate_content(self, prompt, generation_config: Optional[dict] = None,
+                         stage: str = 'default', validate: Optional[Callable] = None, **kwargs):
+        """validate(response) 返回 False 时视为输出不合格：快速模型的结果会升级到主模型重试"""
+        model_name, reason = get_router().route(stage, prompt, self.model_name)
+        record_route(stage, model_name, reason)
+        if model_name == self.model_name:
+            return self._call(model_name, prompt, generation_config, stage, **kwargs)
+
+        try:
+            response = self._call(model_name, prompt, generation_config, stage, **kwargs)
+            if validate is None or validate(response):
+                return response
+            failure = 'validation'
+        except SchedulerTimeout:
+            # 排队超时与模型无关，换模型也要重新排队
+            raise
+        except Exception:
+            failure = 'error'
+        metrics.inc('model_escalations_total', stage=stage, model=model_name, cause=failure)
+        record_route(stage, self.model_name, 'escalation')
+        return self._call(self.model_name, prompt, generation_config, stage, **kwargs)
+
+    def _call(self, model_name: str, prompt, generation_config, stage: str,
+              system_instruction: Optional[str] = None, **kwargs):
+        model = self.load(model_name, system_instruction)
+        variable_prompt = prompt
+        if system_instruction and self.cache_mode == 'inline':
+            prompt = f"{system_instruction}\n\n{prompt}"
+        scheduler = get_scheduler()
+        estimated = estimate_tokens(str(prompt))
+        if system_instruction and self.cache_mode != 'inline':
+            # 缓存命中的 token 同样计入上游的 TPM 配额
+            estimated += len(system_instruction)
+        token = cancellation.current()
+        if token is not None:
+            token.check(stage)
+        queue_wait = scheduler.acquire(estimated, lane_name=self.lane)
+
+        start = time.monotonic()
+        response = None
+        status = 'error'
+        try:
+            if token is None:
+                response = model.generate_content(prompt, generation_config=generation_config, **kwargs)
+            else:
+                response = model.generate_content(prompt, generation_config=generation_config,
+                                                  stream=True, **kwargs)
+                try:
+                    for _ in response:
+                        token.check(stage)
+                finally:
+                    if token.reason is not None:
+                        self._close_stream(response)
+            status = 'ok'
+        except cancellation.Cancelled:
+            status = 'cancelled'
+            raise
+        except Exception:
+            metrics.inc('model_errors_total', model=model_name, stage=stage)
+            raise
+        finally:
+            latency = time.monotonic() - start
+            metrics.observe('model_latency_seconds', latency, model=model_name, stage=stage)
+            self._audit(model_name, stage, status, variable_prompt, response, latency, queue_wait)
+            if status != 'ok':
+                # 取消或失败的调用没有用量数据，预扣的 token 全部退回
+                scheduler.settle(estimated, 0)
+
+        usage = getattr(response, 'usage_metadata', None)
+        actual = getattr(usage, 'total_token_count', None) if usage is not None else None
+        scheduler.settle(estimated, actual)
+        if actual:
+            metrics.inc('model_tokens_total', actual, model=model_name, stage=stage)
+        input_tokens = getattr(usage, 'prompt_token_count', None) or 0
+        if input_tokens:
+            cached = getattr(usage, 'cached_content_token_count', None) or 0
+            metrics.inc('model_input_tokens_total', input_tokens - cached, model=model_name, stage=stage, cached='false')
+            if cached:
+                metrics.inc('model_input_tokens_total', cached, model=model_name, stage=stage, cached='true')
+        return response
+
+    def _audit(self, model_name: str, stage: str, status: str, prompt, response, latency: float, queue_wait: float):
+        usage = getattr(response, 'usage_metadata', None)
+        result = None
+        if status == 'ok':
+            try:
+                result = response.text
+            except Exception:
+                pass
+        audit_log.record(
+            'model_call', stage=stage, model=model_name, lane=self.lane, status=status,
+            latency=round(latency, 3), queue_wait=round(queue_wait, 3),
+            prompt=prompt, result=result,
+            prompt_tokens=getattr(usage, 'prompt_token_count', None),
+            cached_tokens=getattr(usage, 'cached_content_token_count', None),
+            output_tokens=getattr(usage, 'candidates_token_count', None),
+            total_tokens=getattr(usage, 'total_token_count', None),
+        )
+
+    @staticmethod
+    def _close_stream(response):
+        # 流式响应的底层迭代器（gRPC 流）支持 cancel()，不支持时交给垃圾回收关闭
+        iterator = getattr(response, '_iterator', None)
+        cancel = getattr(iterator, 'cancel', None)
+        if callable(cancel):
+            try:
+                cancel()
+            except Exception:
+                pass
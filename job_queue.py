@@ -0,0 +1,396 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import audit_log
+import cancellation
+from metrics import metrics
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+FINAL_STATUSES = ('succeeded', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL,
+    owner TEXT,
+    expires_at REAL,
+    watched INTEGER NOT NULL DEFAULT 0,
+    last_seen REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+# 旧版本数据库中没有的列
+MIGRATIONS = {
+    'watched': 'ALTER TABLE jobs ADD COLUMN watched INTEGER NOT NULL DEFAULT 0',
+    'last_seen': 'ALTER TABLE jobs ADD COLUMN last_seen REAL',
+    'cancel_requested': 'ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0',
+    'owner': 'ALTER TABLE jobs ADD COLUMN owner TEXT',
+}
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """持久化在本地 SQLite 中的后台任务队列
+
+    提交后立即返回任务 ID，由固定数量的工作线程执行。任务记录保存在磁盘上，
+    worker 重启后会重新领取排队中的任务，以及租约已过期的运行中任务。
+    多个进程可以共享同一个数据库文件，领取任务通过写事务互斥。
+    每次领取都生成新的 owner，运行期间由心跳线程按 lease_seconds 的三分之一续租；
+    只有仍持有租约的 owner 才能写入结果，租约被其他 worker 接管后旧的执行会被取消。
+
+    任务可以被取消：排队中的直接标记为 cancelled，运行中的通过 CancelToken
+    在下一次模型调用检查点中止。以 watch 方式提交的任务由客户端持续轮询，
+    超过 abandon_seconds 没有轮询（页面已关闭）时视为被放弃，同样取消。
+    """
+
+    def __init__(self, db_path: str, handlers: Dict[str, Callable[[Dict], Dict]],
+                 workers: int = 4, max_depth: int = 100, result_ttl: float = 3600,
+                 lease_seconds: float = 600, max_attempts: int = 3, poll_interval: float = 1.0,
+                 abandon_seconds: float = 120):
+        self.db_path = db_path
+        self.handlers = handlers
+        self.workers = workers
+        self.max_depth = max_depth
+        self.result_ttl = result_ttl
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.abandon_seconds = abandon_seconds
+
+        self._job_available = threading.Condition()
+        self._job_finished = threading.Condition()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._threads = []
+        self._last_cleanup = 0.0
+        # 本进程中正在运行的任务，取消时直接通知，不必等下一次探测
+        self._tokens: Dict[str, cancellation.CancelToken] = {}
+        # 本进程持有租约的任务：job_id -> owner，由心跳线程续租
+        self._leases: Dict[str, str] = {}
+        self._tokens_lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+
+        metrics.gauge('job_queue_depth', lambda: self.stats()['queued'])
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def start(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._lease_loop, name='job-lease', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            self._started = True
+
+    def submit(self, kind: str, payload: Dict, watch: bool = False) -> Dict:
+        if kind not in self.handlers:
+            raise ValueError(f"未知的任务类型: {kind}")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if depth >= self.max_depth:
+                conn.execute('ROLLBACK')
+                metrics.inc('job_rejected_total', kind=kind)
+                raise JobQueueFull(f"任务队列已满（{depth}）")
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created_at, watched, last_seen) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), now, int(watch), now)
+            )
+            conn.execute('COMMIT')
+
+        metrics.inc('job_submitted_total', kind=kind)
+        with self._job_available:
+            self._job_available.notify()
+        return {'job_id': job_id, 'type': kind, 'status': 'queued', 'created_at': now}
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._connection() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or (row['expires_at'] and row['expires_at'] < time.time()):
+            return None
+        return self._to_dict(row)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict]:
+        """等待任务结束或超时，返回任务的最新状态"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in FINAL_STATUSES:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            # 任务可能由其他进程完成，因此按间隔轮询数据库
+            with self._job_finished:
+                self._job_finished.wait(min(0.5, remaining))
+
+    def touch(self, job_id: str):
+        """客户端仍在等待结果"""
+        with self._connection() as conn:
+            conn.execute('UPDATE jobs SET last_seen = ? WHERE id = ?', (time.time(), job_id))
+
+    def cancel(self, job_id: str, reason: str = 'cancelled') -> Optional[Dict]:
+        """取消任务，返回任务的最新状态；已结束的任务不受影响"""
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT kind, status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None
+            if row['status'] == 'queued':
+                conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', error = ?, finished_at = ?, expires_at = ? WHERE id = ?",
+                    (reason, now, now + self.result_ttl, job_id)
+                )
+                metrics.inc('job_cancelled_total', kind=row['kind'], reason=reason, state='queued')
+            elif row['status'] == 'running':
+                conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+            conn.execute('COMMIT')
+
+        with self._tokens_lock:
+            token = self._tokens.get(job_id)
+        if token is not None:
+            token.cancel(reason)
+        with self._job_finished:
+            self._job_finished.notify_all()
+        return self.get(job_id)
+
+    def _cancel_reason(self, job_id: str) -> Optional[str]:
+        """运行中任务的取消探测：被显式取消，或客户端已放弃"""
+        with self._connection() as conn:
+            row = conn.execute('SELECT cancel_requested, watched, last_seen FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+        if row is None:
+            return None
+        if row['cancel_requested']:
+            return 'cancelled'
+        if row['watched'] and row['last_seen'] and row['last_seen'] < time.time() - self.abandon_seconds:
+            return 'abandoned'
+        return None
+
+    def stats(self) -> Dict:
+        with self._connection() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+            oldest = conn.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE status = 'queued'"
+            ).fetchone()[0]
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update({row['status']: row['n'] for row in rows})
+        counts['oldest_queued_age'] = round(time.time() - oldest, 3) if oldest else 0.0
+        return counts
+
+    def _claim(self) -> Optional[Tuple[sqlite3.Row, str]]:
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # 客户端已放弃的排队任务不再执行
+            abandoned = conn.execute(
+                "UPDATE jobs SET status = 'cancelled', error = 'abandoned', finished_at = ?, expires_at = ? "
+                "WHERE status = 'queued' AND watched = 1 AND last_seen < ?",
+                (now, now + self.result_ttl, now - self.abandon_seconds)
+            ).rowcount
+            if abandoned:
+                metrics.inc('job_cancelled_total', abandoned, reason='abandoned', state='queued')
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            if row['cancel_requested']:
+                # 运行中被取消、随后 worker 崩溃的任务，恢复时直接结束
+                conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', error = 'cancelled', finished_at = ?, expires_at = ? "
+                    "WHERE id = ?", (now, now + self.result_ttl, row['id'])
+                )
+                conn.execute('COMMIT')
+                return None
+            if row['attempts'] >= self.max_attempts:
+                # 多次领取都没有完成（worker 反复崩溃），不再重试
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, expires_at = ? WHERE id = ?",
+                    ('任务多次执行中断', now, now + self.result_ttl, row['id'])
+                )
+                conn.execute('COMMIT')
+                return None
+            owner = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, lease_until = ?, owner = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (now, now + self.lease_seconds, owner, row['id'])
+            )
+            conn.execute('COMMIT')
+            if row['status'] == 'running':
+                metrics.inc('job_recovered_total', kind=row['kind'])
+            return row, owner
+
+    def _renew_leases(self):
+        with self._tokens_lock:
+            leases = list(self._leases.items())
+        if not leases:
+            return
+        lost = []
+        with self._connection() as conn:
+            lease_until = time.time() + self.lease_seconds
+            for job_id, owner in leases:
+                renewed = conn.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                    (lease_until, job_id, owner)
+                ).rowcount
+                if not renewed:
+                    lost.append(job_id)
+        for job_id in lost:
+            # 租约已被其他 worker 接管（例如本进程曾长时间停顿），停止这次执行
+            with self._tokens_lock:
+                token = self._tokens.get(job_id)
+            if token is not None:
+                token.cancel('lease_lost')
+
+    def _lease_loop(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self._renew_leases()
+            except sqlite3.Error as e:
+                print(f"任务续租失败: {e}")
+
+    def _finish(self, job_id: str, owner: str, status: str, result: Optional[Dict] = None,
+                error: Optional[str] = None) -> bool:
+        """写入任务结果；租约已被其他 worker 接管时不写入，返回 False"""
+        now = time.time()
+        with self._connection() as conn:
+            finished = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, expires_at = ? "
+                "WHERE id = ? AND owner = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, now, now + self.result_ttl, job_id, owner)
+            ).rowcount
+        with self._job_finished:
+            self._job_finished.notify_all()
+        return bool(finished)
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        with self._connection() as conn:
+            conn.execute('DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?', (now,))
+
+    def _worker_loop(self):
+        while True:
+            try:
+                self._cleanup()
+                claimed = self._claim()
+            except sqlite3.Error as e:
+                print(f"任务队列数据库错误: {e}")
+                claimed = None
+            if claimed is None:
+                with self._job_available:
+                    self._job_available.wait(self.poll_interval)
+                continue
+            self._run(*claimed)
+
+    def _run(self, row: sqlite3.Row, owner: str):
+        kind = row['kind']
+        started = time.time()
+        metrics.observe('job_wait_seconds', started - row['created_at'], kind=kind)
+        job_id = row['id']
+        token = cancellation.CancelToken(probe=lambda: self._cancel_reason(job_id))
+        with self._tokens_lock:
+            self._tokens[job_id] = token
+            self._leases[job_id] = owner
+        try:
+            with cancellation.scope(token), audit_log.context(job_id=job_id, job_type=kind):
+                result = self.handlers[kind](json.loads(row['payload']))
+            status, fields = 'succeeded', {'result': result}
+        except cancellation.Cancelled as e:
+            status, fields = 'cancelled', {'error': e.reason}
+        except Exception as e:
+            status, fields = 'failed', {'error': str(e)}
+        finally:
+            with self._tokens_lock:
+                self._tokens.pop(job_id, None)
+                self._leases.pop(job_id, None)
+        try:
+            finished = self._finish(job_id, owner, status, **fields)
+        except sqlite3.Error as e:
+            # 结果没有写入，租约到期后任务会被重新领取
+            print(f"任务队列数据库错误: {e}")
+            finished = None
+        if finished:
+            metrics.inc('job_completed_total', kind=kind, status=status)
+            if status == 'cancelled':
+                metrics.inc('job_cancelled_total', kind=kind, reason=fields['error'], state='running')
+        elif finished is not None:
+            metrics.inc('job_lease_lost_total', kind=kind)
+        metrics.observe('job_run_seconds', time.time() - started, kind=kind)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict:
+        return {
+            'job_id': row['id'],
+            'type': row['kind'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'attempts': row['attempts'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+            'watched': bool(row['watched']),
+        }
@@ -0,0 +1,307 @@
+import io
+import json
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+from pydub import AudioSegment
+from simple_websocket import ConnectionClosed
+
+from audio_preprocess import frame_features, pcm_to_float
+from config import (
+    SAMPLE_RATE, LIVE_ASR_WORKERS, LIVE_MAX_BUFFERED_CHUNKS,
+    LIVE_MAX_PENDING_SEGMENTS, LIVE_PARTIAL_INTERVAL,
+    LIVE_SILENCE_MS, LIVE_MAX_SEGMENT_SECONDS,
+    LIVE_MIN_SAMPLE_RATE, LIVE_MAX_SAMPLE_RATE
+)
+
+SUPPORTED_FORMATS = ('webm', 'ogg', 'pcm16')
+
+# (开始秒, 结束秒, PCM 数据)
+Segment = Tuple[float, float, bytes]
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def parse_sample_rate(value) -> Optional[int]:
+    """校验浏览器声明的采样率，非整数或超出范围时返回 None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        sample_rate = int(value)
+    except (TypeError, ValueError):
+        return None
+    if sample_rate != value and str(sample_rate) != value:
+        return None
+    if not LIVE_MIN_SAMPLE_RATE <= sample_rate <= LIVE_MAX_SAMPLE_RATE:
+        return None
+    return sample_rate
+
+
+def get_asr_executor() -> ThreadPoolExecutor:
+    # 所有连接共享一个识别线程池，连接数再多也不会超过识别服务的并发上限
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LIVE_ASR_WORKERS,
+                                           thread_name_prefix='live-asr')
+    return _executor
+
+
+class EnergySegmenter:
+    """按帧能量把连续的 16-bit PCM 流切成语音段"""
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE, frame_ms: int = 30,
+                 energy_threshold: int = 300, silence_ms: int = LIVE_SILENCE_MS,
+                 max_segment_seconds: float = LIVE_MAX_SEGMENT_SECONDS):
+        self.sample_rate = sample_rate
+        self.frame_bytes = int(sample_rate * frame_ms / 1000) * 2
+        self.energy_threshold = energy_threshold
+        # 阈值为 16-bit 样本的 RMS，换算成 frame_features 使用的满幅 dB
+        self.threshold_db = 20 * math.log10(energy_threshold / 32768)
+        self.silence_frames = max(1, silence_ms // frame_ms)
+        self.max_segment_bytes = int(max_segment_seconds * sample_rate) * 2
+        self._remainder = b''
+        self._segment = bytearray()
+        self._segment_start = 0
+        self._position = 0
+        self._silent_run = 0
+
+    def _speech_frames(self, pcm: bytes):
+        """每帧是否为语音：整批 PCM 一次用 NumPy 计算帧能量"""
+        energy_db, _ = frame_features(pcm_to_float(pcm), self.frame_bytes // 2)
+        return (energy_db > self.threshold_db).tolist()
+
+    def _close(self) -> Segment:
+        end = len(self._segment) - self._silent_run * self.frame_bytes
+        pcm = bytes(self._segment[:end])
+        start = self._segment_start / 2 / self.sample_rate
+        self._segment = bytearray()
+        self._silent_run = 0
+        return start, start + len(pcm) / 2 / self.sample_rate, pcm
+
+    def feed(self, pcm: bytes) -> List[Segment]:
+        data = self._remainder + pcm
+        usable = len(data) - len(data) % self.frame_bytes
+        self._remainder = data[usable:]
+
+        segments = []
+        speech = self._speech_frames(data[:usable]) if usable else []
+        for offset, is_speech in zip(range(0, usable, self.frame_bytes), speech):
+            frame = data[offset:offset + self.frame_bytes]
+            if is_speech:
+                if not self._segment:
+                    self._segment_start = self._position
+                self._segment += frame
+                self._silent_run = 0
+            elif self._segment:
+                self._segment += frame
+                self._silent_run += 1
+                if self._silent_run >= self.silence_frames:
+                    segments.append(self._close())
+            # 语音开始前的静音直接丢弃
+            self._position += self.frame_bytes
+            if len(self._segment) >= self.max_segment_bytes:
+                segments.append(self._close())
+        return segments
+
+    def pending(self) -> bytes:
+        return bytes(self._segment)
+
+    def flush(self) -> Optional[Segment]:
+        if not self._segment:
+            return None
+        return self._close()
+
+
+class LiveTranscriptionSession:
+    """一个 WebSocket 连接上的实时问诊转录
+
+    浏览器发送 {"type": "start", "format": ...}，随后以二进制消息发送音频块，
+    最后发送 {"type": "stop"}。服务端推回 partial/final 片段，结束时发送 done。
+    """
+
+    def __init__(self, ws, speech_to_text, executor: Optional[ThreadPoolExecutor] = None,
+                 max_buffered_chunks: int = LIVE_MAX_BUFFERED_CHUNKS,
+                 max_pending_segments: int = LIVE_MAX_PENDING_SEGMENTS,
+                 partial_interval: float = LIVE_PARTIAL_INTERVAL):
+        self.ws = ws
+        self.speech_to_text = speech_to_text
+        self.executor = executor or get_asr_executor()
+        self.chunks = queue.Queue(maxsize=max_buffered_chunks)
+        self.segment_slots = threading.Semaphore(max_pending_segments)
+        self.partial_interval = partial_interval
+
+        self.audio_format = 'webm'
+        self.sample_rate = SAMPLE_RATE
+        self.segmenter = None
+        self.closed = False
+
+        self.send_lock = threading.Lock()
+        self.results_lock = threading.Lock()
+        self.futures = []
+        self.finished = {}
+        self.next_index = 0
+        self.segment_count = 0
+        self.outstanding = 0
+        self.partial_busy = False
+        self.last_partial_at = 0.0
+
+    def send(self, message: dict):
+        if self.closed:
+            return
+        with self.send_lock:
+            try:
+                self.ws.send(json.dumps(message, ensure_ascii=False))
+            except ConnectionClosed:
+                self.closed = True
+
+    def run(self):
+        worker = None
+        try:
+            while True:
+                message = self.ws.receive()
+                if isinstance(message, str):
+                    try:
+                        control = json.loads(message)
+                    except ValueError:
+                        control = None
+                    if not isinstance(control, dict):
+                        self.send({'type': 'error', 'error': '无法解析的控制消息'})
+                        continue
+                    if control.get('type') == 'start' and worker is None:
+                        audio_format = control.get('format', 'webm')
+                        if audio_format not in SUPPORTED_FORMATS:
+                            self.send({'type': 'error', 'error': f'不支持的音频格式: {audio_format}'})
+                            return
+                        if audio_format == 'pcm16':
+                            sample_rate = parse_sample_rate(control.get('sample_rate', SAMPLE_RATE))
+                            if sample_rate is None:
+                                self.send({'type': 'error', 'error': (
+                                    f"采样率必须是 {LIVE_MIN_SAMPLE_RATE}-{LIVE_MAX_SAMPLE_RATE} 之间的整数: "
+                                    f"{control.get('sample_rate')}")})
+                                return
+                            self.sample_rate = sample_rate
+                        self.audio_format = audio_format
+                        self.segmenter = EnergySegmenter(self.sample_rate)
+                        worker = threading.Thread(target=self._process_chunks, daemon=True)
+                        worker.start()
+                        self.send({'type': 'ready'})
+                    elif control.get('type') == 'stop':
+                        break
+                elif message is not None and worker is not None:
+                    self._enqueue(message)
+        except ConnectionClosed:
+            self.closed = True
+        finally:
+            if worker is not None:
+                if self.closed:
+                    # 连接已断开，缓冲区里的音频不再识别
+                    while not self.chunks.empty():
+                        self.chunks.get_nowait()
+                self.chunks.put(None)
+                worker.join()
+                if self.closed:
+                    for future in self.futures:
+                        future.cancel()
+                wait(self.futures)
+            self.send({'type': 'done'})
+
+    def _enqueue(self, chunk: bytes):
+        try:
+            self.chunks.put_nowait(chunk)
+            return
+        except queue.Full:
+            pass
+        # 缓冲区已满：通知浏览器暂停发送，同时停止读取 socket，让 TCP 窗口把压力传回去
+        self.send({'type': 'backpressure', 'paused': True})
+        self.chunks.put(chunk)
+        while self.chunks.qsize() > self.chunks.maxsize // 2 and not self.closed:
+            time.sleep(0.05)
+        self.send({'type': 'backpressure', 'paused': False})
+
+    def _decode(self, chunk: bytes) -> bytes:
+        if self.audio_format == 'pcm16':
+            return chunk
+        # 浏览器每个音频块都是完整的 webm/ogg 文件（MediaRecorder 定时重启）
+        segment = AudioSegment.from_file(io.BytesIO(chunk), format=self.audio_format)
+        return segment.set_channels(1).set_frame_rate(self.sample_rate).set_sample_width(2).raw_data
+
+    def _process_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None or self.closed:
+                break
+            try:
+                pcm = self._decode(chunk)
+            except Exception as e:
+                self.send({'type': 'error', 'error': f'音频解码失败: {e}'})
+                continue
+            for segment in self.segmenter.feed(pcm):
+                self._submit_final(segment)
+            self._maybe_submit_partial()
+
+        if not self.closed:
+            tail = self.segmenter.flush()
+            if tail:
+                self._submit_final(tail)
+
+    def _submit_final(self, segment: Segment):
+        # 每个连接同时在识别的语音段有上限，超出时阻塞解码线程，进而填满缓冲区
+        self.segment_slots.acquire()
+        start, end, pcm = segment
+        with self.results_lock:
+            index = self.segment_count
+            self.segment_count += 1
+            self.outstanding += 1
+        future = self.executor.submit(self.speech_to_text.transcribe_stream, pcm, self.sample_rate)
+        future.add_done_callback(lambda f: self._on_final(index, start, end, f))
+        self.futures = [f for f in self.futures if not f.done()]
+        self.futures.append(future)
+
+    def _on_final(self, index: int, start: float, end: float, future):
+        self.segment_slots.release()
+        text = ''
+        if not future.cancelled() and future.exception() is None:
+            text = future.result() or ''
+        with self.results_lock:
+            self.outstanding -= 1
+            self.finished[index] = {
+                'type': 'final', 'index': index,
+                'start': round(start, 2), 'end': round(end, 2), 'text': text
+            }
+            # 识别结果可能乱序完成，按段序号依次推送
+            while self.next_index in self.finished:
+                self.send(self.finished.pop(self.next_index))
+                self.next_index += 1
+
+    def _maybe_submit_partial(self):
+        if self.partial_interval <= 0 or self.partial_busy:
+            return
+        if time.monotonic() - self.last_partial_at < self.partial_interval:
+            return
+        pcm = self.segmenter.pending()
+        if len(pcm) < self.sample_rate * 2:
+            return
+        with self.results_lock:
+            # 中间结果只在没有待识别的完整段时才做，优先保证 final
+            if self.outstanding:
+                return
+            index = self.segment_count
+        self.partial_busy = True
+        self.last_partial_at = time.monotonic()
+        future = self.executor.submit(self.speech_to_text.transcribe_stream, pcm, self.sample_rate)
+        future.add_done_callback(lambda f: self._on_partial(index, f))
+
+    def _on_partial(self, index: int, future):
+        self.partial_busy = False
+        if future.cancelled() or future.exception() is not None:
+            return
+        text = future.result()
+        # 该段已经结束则丢弃过期的中间结果
+        if text and index == self.segment_count:
+            self.send({'type': 'partial', 'index': index, 'text': text})
@@ -0,0 +1,312 @@
+"""
+离线模型后端：本地替身，以及真实响应的录制与回放
+
+MODEL_BACKEND=local 时 GeminiModel 用 LocalModel 代替 genai.GenerativeModel：不联网，返回结构合法的
+固定结果，并按上游的前缀缓存规则统计输入 token，用于在没有 API Key 的环境里运行完整流程、
+比较不同 PROMPT_CACHE_MODE 下缓存命中的输入 token。
+
+MODEL_BACKEND=record 时照常调用 Gemini，并把每次的响应、token 用量和耗时追加到
+MODEL_RECORDINGS_PATH；MODEL_BACKEND=replay 时按（模型、指令、内容、生成参数）查找录制的响应，
+不联网，并按录制时的耗时等待，评估结果中的延迟仍有参考意义。
+
+计费规则的近似：
+- 1 个字符计 1 个 token（与 model_scheduler.estimate_tokens 一致）
+- 隐式缓存：完整输入（system instruction + 内容）按 BLOCK_TOKENS 分块做链式哈希，
+  同一模型此前见过的最长前缀算作缓存命中，命中长度不足 MIN_CACHE_TOKENS 时不计
+- 显式缓存：system instruction 部分全部算作缓存命中
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from metrics import metrics
+
+BLOCK_TOKENS = 256
+MIN_CACHE_TOKENS = 1024
+# 每个模型保留的前缀块数，超出后淘汰最久未命中的
+MAX_BLOCKS = 100000
+
+OUTPUT_TOKENS = 200
+# 录制 count_tokens 结果时代替生成参数，与生成调用的键区分
+COUNT_TOKENS = {'count_tokens': True}
+
+_TASK_LINE = re.compile(r'^任务：(\w+)$', re.MULTILINE)
+
+CANNED_RESULTS = {
+    'soap': {
+        'chief_complaint': '（本地模型）',
+        'subjective': '（本地模型）主观资料',
+        'objective': '（本地模型）客观资料',
+        'assessment': '（本地模型）评估',
+        'plan': '（本地模型）计划',
+        'preliminary_diagnosis': ['（本地模型）'],
+    },
+    'examinations': {
+        'examinations': [{'name': '血常规', 'type': '常规', 'reason': '（本地模型）', 'priority': '中'}],
+    },
+    'drug_check': {
+        'has_conflicts': False,
+        'allergy_warnings': [],
+        'drug_interactions': [],
+        'contraindications': [],
+        'dosage_warnings': [],
+        'recommendations': [],
+        'severity': '无',
+    },
+    'drug_extraction': {'drugs': []},
+}
+CANNED_RESULTS['consolidated'] = {
+    'soap': CANNED_RESULTS['soap'],
+    'examinations': CANNED_RESULTS['examinations']['examinations'],
+    'medications': [],
+}
+
+
+class PrefixCache:
+    def __init__(self):
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.requests = 0
+
+    def lookup_and_store(self, text: str) -> int:
+        """返回命中缓存的 token 数，并把本次输入的所有完整块记入缓存"""
+        digest = b''
+        hits = 0
+        matching = True
+        with self._lock:
+            for start in range(0, len(text) - BLOCK_TOKENS + 1, BLOCK_TOKENS):
+                digest = hashlib.sha1(digest + text[start:start + BLOCK_TOKENS].encode('utf-8')).digest()
+                if matching and digest in self._blocks:
+                    self._blocks.move_to_end(digest)
+                    hits += 1
+                else:
+                    matching = False
+                    self._blocks[digest] = None
+            while len(self._blocks) > MAX_BLOCKS:
+                self._blocks.popitem(last=False)
+        cached = hits * BLOCK_TOKENS
+        return cached if cached >= MIN_CACHE_TOKENS else 0
+
+    def account(self, input_tokens: int, cached_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.input_tokens += input_tokens
+            self.cached_tokens += cached_tokens
+
+
+_caches: Dict[str, PrefixCache] = {}
+_caches_lock = threading.Lock()
+
+
+def _cache_for(model_name: str) -> PrefixCache:
+    with _caches_lock:
+        cache = _caches.get(model_name)
+        if cache is None:
+            cache = _caches[model_name] = PrefixCache()
+        return cache
+
+
+def stats() -> Dict[str, Dict]:
+    """各模型累计的请求数、输入 token 与其中命中缓存的 token"""
+    with _caches_lock:
+        return {name: {'requests': cache.requests, 'input_tokens': cache.input_tokens,
+                       'cached_tokens': cache.cached_tokens}
+                for name, cache in _caches.items()}
+
+
+def reset():
+    with _caches_lock:
+        _caches.clear()
+
+
+class UsageMetadata:
+    def __init__(self, prompt_token_count: int, cached_content_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class TokenCount:
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+class LocalResponse:
+    def __init__(self, text: str, usage_metadata: UsageMetadata):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        # 流式接口：整个结果作为一个分片
+        yield self
+
+
+class LocalModel:
+    """与 genai.GenerativeModel.generate_content 兼容的最小接口"""
+
+    def __init__(self, model_name: str, system_instruction: Optional[str] = None, explicit: bool = False):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ''
+        self.explicit = explicit
+        self._cache = _cache_for(model_name)
+
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        contents = str(contents)
+        text = self.system_instruction + contents
+        if self.explicit:
+            cached = len(self.system_instruction)
+        else:
+            cached = self._cache.lookup_and_store(text)
+        self._cache.account(len(text), cached)
+
+        result = json.dumps(CANNED_RESULTS.get(self._task(contents), {}), ensure_ascii=False)
+        return LocalResponse(result, UsageMetadata(len(text), cached, OUTPUT_TOKENS))
+
+    def count_tokens(self, contents) -> TokenCount:
+        return TokenCount(len(str(contents)))
+
+    @staticmethod
+    def _task(contents: str) -> Optional[str]:
+        match = _TASK_LINE.search(contents)
+        if match:
+            return match.group(1)
+        if '治疗计划：' in contents:
+            return 'drug_extraction'
+        return None
+
+
+class RecordingMissing(Exception):
+    """回放时没有找到对应的录制响应"""
+
+
+class Recordings:
+    """录制文件：每行一条 JSON，{key, model, text, usage, latency}；同一 key 以最后一条为准
+
+    count_tokens 的结果也录制（text 为 token 数），回放时与录制时选择同样的指令布局。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry['key']] = entry
+
+    @staticmethod
+    def key(model_name: str, system_instruction: Optional[str], contents, generation_config) -> str:
+        material = json.dumps([model_name, system_instruction or '', str(contents), generation_config or {}],
+                              ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self._entries.get(key)
+
+    def put(self, entry: Dict):
+        with self._lock:
+            self._entries[entry['key']] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_recordings: Dict[str, Recordings] = {}
+
+
+def get_recordings(path: str) -> Recordings:
+    with _caches_lock:
+        recordings = _recordings.get(path)
+        if recordings is None:
+            recordings = _recordings[path] = Recordings(path)
+        return recordings
+
+
+def _usage(response) -> Dict[str, int]:
+    usage = getattr(response, 'usage_metadata', None)
+    return {field: getattr(usage, field, None) or 0
+            for field in ('prompt_token_count', 'cached_content_token_count', 'candidates_token_count')}
+
+
+class RecordingModel:
+    """包装真实模型：以非流式调用，把响应写入录制文件"""
+
+    def __init__(self, model, model_name: str, system_instruction: Optional[str], recordings: Recordings):
+        self.model = model
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.recordings = recordings
+
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        start = time.monotonic()
+        response = self.model.generate_content(contents, generation_config=generation_config, **kwargs)
+        text = response.text
+        entry = {
+            'key': Recordings.key(self.model_name, self.system_instruction, contents, generation_config),
+            'model': self.model_name,
+            'text': text,
+            'usage': _usage(response),
+            'latency': round(time.monotonic() - start, 3),
+        }
+        self.recordings.put(entry)
+        return _replayed(entry)
+
+    def count_tokens(self, contents) -> TokenCount:
+        total = self.model.count_tokens(contents).total_tokens
+        self.recordings.put({
+            'key': Recordings.key(self.model_name, None, contents, COUNT_TOKENS),
+            'model': self.model_name,
+            'text': str(total),
+            'usage': _usage(None),
+            'latency': 0,
+        })
+        return TokenCount(total)
+
+
+class ReplayModel:
+    """按录制响应回答；latency_scale 为等待录制耗时的倍数，0 表示不等待"""
+
+    def __init__(self, model_name: str, system_instruction: Optional[str], recordings: Recordings,
+                 latency_scale: float = 1.0):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.recordings = recordings
+        self.latency_scale = latency_scale
+
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        entry = self.recordings.get(Recordings.key(self.model_name, self.system_instruction, contents,
+                                                   generation_config))
+        if entry is None:
+            metrics.inc('model_replay_missing_total', model=self.model_name)
+            raise RecordingMissing(f"没有录制的响应（{self.model_name}）")
+        if self.latency_scale > 0:
+            time.sleep(entry['latency'] * self.latency_scale)
+        return _replayed(entry)
+
+    def count_tokens(self, contents) -> TokenCount:
+        entry = self.recordings.get(Recordings.key(self.model_name, None, contents, COUNT_TOKENS))
+        if entry is None:
+            raise RecordingMissing(f"没有录制的 token 统计（{self.model_name}）")
+        return TokenCount(int(entry['text']))
+
+
+def _replayed(entry: Dict) -> LocalResponse:
+    usage = entry['usage']
+    return LocalResponse(entry['text'], UsageMetadata(usage['prompt_token_count'],
+                                                      usage['cached_content_token_count'],
+                                                      usage['candidates_token_count']))
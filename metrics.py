@@ -0,0 +1,83 @@
+import threading
+from collections import deque
+from typing import Callable, Dict
+
+
+def _key(name: str, labels: Dict) -> str:
+    if not labels:
+        return name
+    label_text = ','.join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{label_text}}}"
+
+
+class Histogram:
+    """保留最近 window 个观测值，用于计算分位数"""
+
+    def __init__(self, window: int = 1024):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict:
+        ordered = sorted(self.values)
+        if not ordered:
+            return {'count': 0, 'sum': 0.0}
+
+        def quantile(q):
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'mean': round(self.sum / self.count, 4),
+            'p50': quantile(0.5),
+            'p95': quantile(0.95),
+            'max': round(ordered[-1], 4),
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name: str, callback: Callable[[], float], **labels):
+        """注册在快照时才求值的指标（队列深度等）"""
+        with self._lock:
+            self.gauges[_key(name, labels)] = callback
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: h.snapshot() for key, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+        gauge_values = {}
+        for key, callback in gauges.items():
+            try:
+                gauge_values[key] = callback()
+            except Exception as e:
+                gauge_values[key] = f"error: {e}"
+        return {'counters': counters, 'gauges': gauge_values, 'histograms': histograms}
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,74 @@
+"""
+按阶段和输入长度选择模型：简单任务和短问诊用快速模型，长问诊和安全关键环节用主模型
+
+- MODEL_ROUTES 为每个阶段指定 fast / strong / auto，未列出的阶段使用主模型
+- auto：提示词不超过 MODEL_ROUTE_FAST_MAX_CHARS 时用快速模型，否则用主模型
+- 调用方提供校验函数时，快速模型的输出校验不通过（或调用出错）会升级到主模型重试一次
+"""
+import json
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from config import MODEL_ROUTING_ENABLED, MODEL_FAST, MODEL_ROUTES, MODEL_ROUTE_FAST_MAX_CHARS
+from metrics import metrics
+
+TIERS = ('fast', 'strong', 'auto')
+
+
+def parse_routes(spec: str) -> Dict[str, str]:
+    """'drug_extraction=fast,soap=auto' -> {'drug_extraction': 'fast', 'soap': 'auto'}"""
+    routes = {}
+    for item in spec.split(','):
+        stage, _, tier = item.strip().partition('=')
+        if not stage:
+            continue
+        if tier not in TIERS:
+            raise ValueError(f"MODEL_ROUTES 中 {stage} 的模型档位无效: {tier}")
+        routes[stage] = tier
+    return routes
+
+
+class ModelRouter:
+    def __init__(self, fast_model: str, routes: Dict[str, str], fast_max_chars: int, enabled: bool = True):
+        self.fast_model = fast_model
+        self.routes = routes
+        self.fast_max_chars = fast_max_chars
+        self.enabled = enabled
+
+    def route(self, stage: str, prompt, strong_model: str) -> Tuple[str, str]:
+        """返回 (模型名, 选择原因)"""
+        tier = self.routes.get(stage, 'strong') if self.enabled else 'strong'
+        if tier == 'auto':
+            if len(str(prompt)) <= self.fast_max_chars:
+                return self.fast_model, 'short_input'
+            return strong_model, 'long_input'
+        if tier == 'fast':
+            return self.fast_model, 'stage'
+        return strong_model, 'stage'
+
+
+def json_validator(check: Callable[[object], bool]) -> Callable[[object], bool]:
+    """把针对解析后 JSON 的检查包装成针对模型响应的校验函数"""
+    def validate(response) -> bool:
+        try:
+            return bool(check(json.loads(response.text)))
+        except Exception:
+            return False
+    return validate
+
+
+def record_route(stage: str, model: str, reason: str):
+    metrics.inc('model_route_total', stage=stage, model=model, reason=reason)
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(MODEL_FAST, parse_routes(MODEL_ROUTES), MODEL_ROUTE_FAST_MAX_CHARS,
+                                  enabled=MODEL_ROUTING_ENABLED)
+    return _router
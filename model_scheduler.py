@@ -0,0 +1,267 @@
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+import cancellation
+from config import MODEL_RPM, MODEL_TPM, MODEL_RATE_STATE_PATH, MODEL_QUEUE_TIMEOUT
+from metrics import metrics
+
+# 优先级从高到低
+LANES = ('safety', 'interactive', 'batch')
+
+# 低优先级通道只能在桶内余量高于该比例时取令牌，为其他进程中的药物安全检查预留额度
+LANE_RESERVE = {'safety': 0.0, 'interactive': 0.1, 'batch': 0.3}
+
+_current_lane = contextvars.ContextVar('model_lane', default=None)
+_current_flow = contextvars.ContextVar('model_flow', default='default')
+
+
+class SchedulerTimeout(Exception):
+    pass
+
+
+@contextmanager
+def lane(name: str):
+    """在此上下文内发起的模型调用使用指定的优先级通道"""
+    token = _current_lane.set(name)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+@contextmanager
+def flow(key: str):
+    """同一通道内按流（客户端、会话）轮转，避免单个客户端占满配额"""
+    token = _current_flow.set(key or 'default')
+    try:
+        yield
+    finally:
+        _current_flow.reset(token)
+
+
+# 排队时还不知道输出长度，先按该值预估，调用结束后按实际用量修正
+OUTPUT_TOKEN_ESTIMATE = 1024
+
+
+def estimate_tokens(text: str) -> int:
+    # 中文约 1 字 1 token，英文约 4 字符 1 token；取保守值
+    return max(1, len(text)) + OUTPUT_TOKEN_ESTIMATE
+
+
+class RateLimiter:
+    """进程内的请求数 / token 数双令牌桶"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self._state = {'requests': (float(rpm), now), 'tokens': (float(tpm), now)}
+
+    def _level(self, name: str, capacity: int, now: float) -> float:
+        level, updated = self._state[name]
+        return min(capacity, level + (now - updated) * capacity / 60.0)
+
+    def try_take(self, tokens: int, reserve: float = 0.0) -> float:
+        """尝试取 1 个请求和 tokens 个 token，成功返回 0，否则返回建议等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            return self._try_take(now, tokens, reserve)
+
+    def _try_take(self, now: float, tokens: int, reserve: float) -> float:
+        waits = []
+        levels = {}
+        for name, capacity, amount in (('requests', self.rpm, 1), ('tokens', self.tpm, tokens)):
+            if capacity <= 0:
+                continue
+            level = self._level(name, capacity, now)
+            levels[name] = level
+            # 单次请求超过桶容量时按满桶处理，避免永远拿不到
+            need = min(amount, capacity) + reserve * capacity
+            if level < need:
+                waits.append((need - level) * 60.0 / capacity)
+        if waits:
+            return max(waits)
+        for name, capacity, amount in (('requests', self.rpm, 1), ('tokens', self.tpm, tokens)):
+            if capacity > 0:
+                self._state[name] = (levels[name] - amount, now)
+        return 0.0
+
+    def adjust(self, tokens: int):
+        """调用结束后用实际 token 数修正预估值（可以为负，即退还）"""
+        if self.tpm <= 0 or not tokens:
+            return
+        with self._lock:
+            now = time.monotonic()
+            level = self._level('tokens', self.tpm, now)
+            self._state['tokens'] = (level - tokens, now)
+
+
+class SharedRateLimiter(RateLimiter):
+    """状态保存在 SQLite 中的令牌桶，同一台机器上的多个 worker 共享配额"""
+
+    def __init__(self, path: str, rpm: int, tpm: int):
+        super().__init__(rpm, tpm)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)')
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _shared_state(self):
+        # 跨进程必须使用墙上时钟
+        with self._lock, self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            rows = conn.execute('SELECT name, level, updated FROM buckets').fetchall()
+            self._state = {'requests': (float(self.rpm), now), 'tokens': (float(self.tpm), now)}
+            self._state.update({name: (level, updated) for name, level, updated in rows})
+            try:
+                yield now
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.executemany('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                             [(name, level, updated) for name, (level, updated) in self._state.items()])
+            conn.execute('COMMIT')
+
+    def try_take(self, tokens: int, reserve: float = 0.0) -> float:
+        with self._shared_state() as now:
+            return self._try_take(now, tokens, reserve)
+
+    def adjust(self, tokens: int):
+        if self.tpm <= 0 or not tokens:
+            return
+        with self._shared_state() as now:
+            level = self._level('tokens', self.tpm, now)
+            self._state['tokens'] = (level - tokens, now)
+
+
+class _Ticket:
+    __slots__ = ('lane', 'flow', 'tokens')
+
+    def __init__(self, lane: str, flow: str, tokens: int):
+        self.lane = lane
+        self.flow = flow
+        self.tokens = tokens
+
+
+class ModelScheduler:
+    """所有模型调用的统一入口：限流 + 优先级通道 + 通道内按流轮转的公平队列"""
+
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+        self._cond = threading.Condition()
+        self._queues = {name: OrderedDict() for name in LANES}
+        for name in LANES:
+            metrics.gauge('model_queue_depth', lambda name=name: self.depth(name), lane=name)
+
+    def depth(self, lane_name: str) -> int:
+        with self._cond:
+            return sum(len(tickets) for tickets in self._queues[lane_name].values())
+
+    def _head(self) -> Optional[_Ticket]:
+        for name in LANES:
+            flows = self._queues[name]
+            if flows:
+                return next(iter(flows.values()))[0]
+        return None
+
+    def _remove(self, ticket: _Ticket, rotate: bool):
+        flows = self._queues[ticket.lane]
+        tickets = flows[ticket.flow]
+        tickets.remove(ticket)
+        if not tickets:
+            del flows[ticket.flow]
+        elif rotate:
+            # 同一通道内各流轮流获得配额
+            flows.move_to_end(ticket.flow)
+
+    def acquire(self, tokens: int, lane_name: Optional[str] = None, flow: Optional[str] = None,
+                timeout: float = MODEL_QUEUE_TIMEOUT) -> float:
+        """阻塞直到获得配额，返回排队等待的秒数
+
+        上下文中通过 lane() 指定的通道优先于调用方给出的默认通道，但不会把 safety 降级：
+        药物安全检查在 batch 上下文中（如后台刷新）发起时仍走 safety 通道。
+        排队期间请求被取消时放弃排队，抛出 Cancelled。
+        """
+        if lane_name != 'safety':
+            lane_name = _current_lane.get() or lane_name or 'interactive'
+        flow = flow or _current_flow.get()
+        ticket = _Ticket(lane_name, flow, tokens)
+        token = cancellation.current()
+        # 有取消令牌时分段等待，以便及时发现取消
+        max_wait = cancellation.PROBE_INTERVAL if token is not None else None
+        start = time.monotonic()
+        deadline = start + timeout
+
+        with self._cond:
+            self._queues[lane_name].setdefault(flow, deque()).append(ticket)
+        try:
+            while True:
+                # 取消探测可能读数据库，在锁外进行
+                if token is not None:
+                    token.check('queue')
+                with self._cond:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc('model_queue_timeout_total', lane=lane_name)
+                        raise SchedulerTimeout(f"模型调用排队超时（{timeout:.0f} 秒）")
+                    if self._head() is not ticket:
+                        self._cond.wait(min(remaining, max_wait or remaining))
+                        continue
+                # 只有队首取令牌；共享限流器要开写事务读写磁盘，不占用 _cond
+                delay = self.limiter.try_take(tokens, LANE_RESERVE.get(lane_name, 0.0))
+                with self._cond:
+                    if delay == 0:
+                        self._remove(ticket, rotate=True)
+                        ticket = None
+                        self._cond.notify_all()
+                        break
+                    self._cond.wait(min(delay, remaining, max_wait or remaining))
+        finally:
+            if ticket is not None:
+                with self._cond:
+                    self._remove(ticket, rotate=False)
+                    self._cond.notify_all()
+
+        waited = time.monotonic() - start
+        metrics.observe('model_queue_wait_seconds', waited, lane=lane_name)
+        return waited
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        if actual_tokens is not None:
+            self.limiter.adjust(actual_tokens - estimated_tokens)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> ModelScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if MODEL_RATE_STATE_PATH:
+                limiter = SharedRateLimiter(MODEL_RATE_STATE_PATH, MODEL_RPM, MODEL_TPM)
+            else:
+                limiter = RateLimiter(MODEL_RPM, MODEL_TPM)
+            _scheduler = ModelScheduler(limiter)
+    return _scheduler
@@ -0,0 +1,242 @@
+"""
+提示词模板：固定指令与每次调用的可变内容分开
+
+固定指令作为 system instruction 发送（或由 PROMPT_CACHE_MODE=explicit 创建为缓存内容），
+每次请求只发送可变内容。SOAP、检查推荐、药物冲突检查和合并生成共用同一段系统指令，
+所有调用的前缀完全相同；各任务的指令单独都太短，无法被缓存。
+共享指令每次都要发送，只有达到上游前缀缓存的最小长度（PROMPT_SHARED_MIN_TOKENS）才划算：
+长度用模型的分词器实测（use_token_counter 注册的计数函数），无法实测时暂按偏低的估计，稍后重试；
+达不到时各任务改回只发送自己的指令。隐式缓存由上游尽力而为，达到最小长度也不保证命中。
+药物提取任务很小，单独使用自己的短指令，不为它发送整段共享前缀。
+
+模板在导入时编译为（标题, 变量名）序列，可变内容按从较稳定到最易变的顺序拼接，问诊记录放在最后。
+"""
+import math
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from config import PROMPT_SHARED_MIN_TOKENS, PROMPT_SHARED_RETRY_SECONDS
+
+SHARED_PREAMBLE = """你是一位经验丰富的临床医生和临床药师，为门诊问诊提供病历书写、检查项目推荐和用药安全检查。
+每次请求的第一行“任务：”指明本次要完成的任务。请只按对应任务的要求处理请求中给出的资料，
+以JSON格式返回该任务要求的字段，确保内容专业、准确、完整。"""
+
+SOAP_INSTRUCTION = """请根据问诊记录，生成一份完整的SOAP格式病历。
+
+请按照SOAP格式生成病历，包括：
+1. S (Subjective - 主观资料)：患者主诉、现病史、既往史、个人史等
+2. O (Objective - 客观资料)：体格检查发现、生命体征等
+3. A (Assessment - 评估)：初步诊断、鉴别诊断等
+4. P (Plan - 计划)：治疗方案、检查计划、用药计划、随访计划等
+
+请以JSON格式返回，包含以下字段：
+- subjective: 主观资料
+- objective: 客观资料
+- assessment: 评估
+- plan: 计划
+- chief_complaint: 主诉（简要）
+- preliminary_diagnosis: 初步诊断（列表）"""
+
+EXAMINATIONS_INSTRUCTION = """请根据SOAP病历摘要和问诊记录，推荐必要的检查项目，包括：
+1. 常规检查（血常规、尿常规等）
+2. 生化检查（肝肾功能、血糖等）
+3. 影像学检查（X光、CT、MRI、超声等）
+4. 特殊检查（根据病情需要）
+
+对于每个推荐的检查项目，请说明：
+- 检查名称
+- 检查类型（常规/生化/影像/特殊）
+- 推荐理由
+- 优先级（高/中/低）
+
+请以JSON格式返回，包含一个examinations数组，每个元素包含：
+- name: 检查名称
+- type: 检查类型
+- reason: 推荐理由
+- priority: 优先级"""
+
+DRUG_CHECK_INSTRUCTION = """请以临床药师的身份检查处方药物的安全性，检查以下内容：
+1. 药物过敏风险：处方药物是否与患者过敏史冲突
+2. 药物相互作用：处方药物之间是否存在相互作用
+3. 药物与当前用药冲突：处方药物是否与患者当前用药冲突
+4. 药物与疾病冲突：处方药物是否与患者病史冲突
+5. 剂量合理性：药物剂量是否合理
+
+请以JSON格式返回，包含：
+- has_conflicts: 是否存在冲突（布尔值）
+- allergy_warnings: 过敏警告列表
+- drug_interactions: 药物相互作用列表（包含药物对和说明）
+- contraindications: 禁忌症列表
+- dosage_warnings: 剂量警告列表
+- recommendations: 建议列表
+- severity: 总体严重程度（高/中/低/无）"""
+
+CONSOLIDATED_INSTRUCTION = """请根据问诊记录，一次性完成三项工作：
+生成SOAP格式病历、推荐必要的检查项目、列出治疗计划中的处方药物。
+
+请以JSON格式返回，包含以下三个字段：
+
+1. soap: SOAP病历对象，包含
+   - subjective: 主观资料（主诉、现病史、既往史、个人史等）
+   - objective: 客观资料（体格检查发现、生命体征等）
+   - assessment: 评估（初步诊断、鉴别诊断等）
+   - plan: 计划（治疗方案、检查计划、用药计划、随访计划等）
+   - chief_complaint: 主诉（简要）
+   - preliminary_diagnosis: 初步诊断（列表）
+
+2. examinations: 推荐检查项目数组（常规、生化、影像、特殊检查），每个元素包含
+   - name: 检查名称
+   - type: 检查类型（常规/生化/影像/特殊）
+   - reason: 推荐理由
+   - priority: 优先级（高/中/低）
+
+3. medications: soap.plan 中开具的药物数组，每个元素包含
+   - name: 药物名称（只写药名，不含剂量）
+   - dose: 剂量
+   - frequency: 用法用量
+   只列出明确的药物，不包括检查项目或其他非药物内容；没有用药时返回空数组。
+
+medications 必须与 soap.plan 中的用药一致。"""
+
+DRUG_EXTRACTION_INSTRUCTION = """请从治疗计划中提取所有提到的药物。
+请以JSON格式返回，包含一个drugs数组，每个元素包含
+- name: 药物名称（按计划原文摘录，只写药名，不含剂量）
+- dose: 剂量（计划中未写明时为空字符串）
+- frequency: 用法用量（计划中未写明时为空字符串）
+只提取明确的药物，不包括检查项目或其他非药物内容。"""
+
+
+class PromptTemplate:
+    def __init__(self, name: str, instruction: str, sections: Sequence[Tuple[Optional[str], str]],
+                 shared: bool = True):
+        self.name = name
+        self.instruction = instruction
+        self.shared = shared
+        # 预先拼好每段的前缀，渲染时只做拼接；值为空的段整体省略
+        self._parts = tuple((f"{title}：\n" if title else '', variable) for title, variable in sections)
+        self._header = f"任务：{name}\n\n" if shared else ''
+
+    @property
+    def system_instruction(self) -> str:
+        return SHARED_INSTRUCTION if self.shared and shared_prefix_enabled() else self.instruction
+
+    def render(self, **values) -> str:
+        body = '\n\n'.join(prefix + str(values[variable]) for prefix, variable in self._parts
+                           if values.get(variable))
+        return self._header + body
+
+
+SOAP_PROMPT = PromptTemplate('soap', SOAP_INSTRUCTION, (
+    ('患者基本信息', 'patient'),
+    ('问诊记录', 'transcript'),
+))
+EXAMINATIONS_PROMPT = PromptTemplate('examinations', EXAMINATIONS_INSTRUCTION, (
+    ('SOAP病历摘要', 'soap_summary'),
+    ('问诊记录', 'transcript'),
+))
+DRUG_CHECK_PROMPT = PromptTemplate('drug_check', DRUG_CHECK_INSTRUCTION, (
+    ('患者信息', 'patient'),
+    ('处方药物', 'drugs'),
+))
+CONSOLIDATED_PROMPT = PromptTemplate('consolidated', CONSOLIDATED_INSTRUCTION, (
+    ('患者基本信息', 'patient'),
+    ('问诊记录', 'transcript'),
+))
+DRUG_EXTRACTION_PROMPT = PromptTemplate('drug_extraction', DRUG_EXTRACTION_INSTRUCTION, (
+    ('治疗计划', 'plan'),
+), shared=False)
+
+TEMPLATES: Dict[str, PromptTemplate] = {t.name: t for t in (
+    SOAP_PROMPT, EXAMINATIONS_PROMPT, DRUG_CHECK_PROMPT, CONSOLIDATED_PROMPT, DRUG_EXTRACTION_PROMPT
+)}
+
+
+def _shared_instruction() -> str:
+    return SHARED_PREAMBLE + ''.join(
+        f"\n\n【任务：{t.name}】\n{t.instruction}" for t in TEMPLATES.values() if t.shared
+    )
+
+
+SHARED_INSTRUCTION = _shared_instruction()
+
+
+def set_instruction(name: str, instruction: str):
+    """替换某个任务的固定指令（用于评估不同措辞），共享指令随之重建"""
+    global SHARED_INSTRUCTION
+    TEMPLATES[name].instruction = instruction
+    SHARED_INSTRUCTION = _shared_instruction()
+
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]')
+_token_counter: Optional[Callable[[str], Optional[int]]] = None
+# 共享指令文本 -> (是否达到最小缓存长度, 有效期截止时间)；实测结果不过期
+_shared_verdicts: Dict[str, Tuple[bool, float]] = {}
+_verdict_lock = threading.Lock()
+# 计数函数每次更换都加一，换之前开始的实测不再写入
+_counter_version = 0
+
+
+def _low_token_estimate(text: str) -> int:
+    """偏低的 token 估计：中文字符按 0.6 个、其他字符按 4 个一组计"""
+    cjk = len(_CJK.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) / 4)
+
+
+def use_token_counter(counter: Optional[Callable[[str], Optional[int]]]):
+    """注册统计 token 的函数（如 GeminiModel.count_tokens），返回 None 表示无法统计"""
+    global _token_counter, _counter_version
+    with _verdict_lock:
+        _token_counter = counter
+        _counter_version += 1
+        _shared_verdicts.clear()
+
+
+def shared_prefix_enabled() -> bool:
+    """共享指令是否达到上游缓存的最小长度
+
+    实测是一次网络调用，在锁外进行，不阻塞其他模型调用；每段指令文本实测成功后不再统计。
+    无法实测时的估计结果只保留 PROMPT_SHARED_RETRY_SECONDS 秒，到期后重新实测。
+    """
+    instruction = SHARED_INSTRUCTION
+    with _verdict_lock:
+        cached = _shared_verdicts.get(instruction)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        counter, version = _token_counter, _counter_version
+
+    tokens = counter(instruction) if counter is not None else None
+    measured = tokens is not None
+    if not measured:
+        tokens = _low_token_estimate(instruction)
+    verdict = tokens >= PROMPT_SHARED_MIN_TOKENS
+
+    with _verdict_lock:
+        cached = _shared_verdicts.get(instruction)
+        if cached is not None and cached[1] == math.inf:
+            # 其他线程已先完成实测
+            return cached[0]
+        if version == _counter_version:
+            _shared_verdicts[instruction] = (
+                verdict, math.inf if measured else time.monotonic() + PROMPT_SHARED_RETRY_SECONDS)
+    if not verdict:
+        print(f"共享指令约 {tokens} token（{'实测' if measured else '估计'}），"
+              f"低于 {PROMPT_SHARED_MIN_TOKENS}，各任务改用自己的指令")
+    return verdict
+
+
+PATIENT_FIELDS = (
+    ('name', '姓名', '未知'),
+    ('age', '年龄', '未知'),
+    ('gender', '性别', '未知'),
+    ('medical_history', '既往史', '无'),
+    ('allergies', '过敏史', '无'),
+)
+
+
+def patient_lines(patient_info: Optional[Dict], fields: Sequence[Tuple[str, str, str]]) -> str:
+    """[(键, 标签, 缺省值)] -> '- 标签：值' 多行文本；没有患者信息时返回空字符串"""
+    if not patient_info:
+        return ''
+    return '\n'.join(f"- {label}：{patient_info.get(key, default)}" for key, label, default in fields)
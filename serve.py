@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+生产环境启动脚本：gunicorn 多进程（gthread）运行 EHR Agent Web 应用
+
+- 应用代码在 master 中预加载（WEB_PRELOAD_APP=1），fork 后共享只读内存
+- AI 组件在每个 worker 启动时初始化一次（gRPC 连接不能跨 fork 共享）
+- 收到 SIGTERM 的 worker 先进入排空状态：/health/ready 返回 503，
+  继续处理请求 WEB_DRAIN_SECONDS 秒后再优雅退出
+- kill -HUP <master> 平滑重启 worker；预加载模式下更新代码需使用 USR2 + QUIT
+- 准入控制各组占用的线程之和超过 threads - RESERVED_THREADS 时启动前给出警告
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+
+from gunicorn.app.base import BaseApplication
+
+from config import (
+    GOOGLE_API_KEY, WEB_BIND, WEB_WORKERS, WEB_THREADS, WEB_TIMEOUT,
+    WEB_GRACEFUL_TIMEOUT, WEB_DRAIN_SECONDS, WEB_PRELOAD_APP, WEB_MAX_REQUESTS,
+    ADMISSION_ENABLED, ADMISSION_POOLS
+)
+
+# 准入控制之外至少保留的线程数，用于健康检查和静态资源
+RESERVED_THREADS = 2
+
+
+def post_worker_init(worker):
+    import app as web_app
+
+    web_app.preload_models()
+    if not web_app.components_ready():
+        worker.log.warning("AI 组件初始化失败，就绪探针将返回 503")
+
+    def handle_term(sig, frame):
+        web_app.begin_drain()
+        worker.log.info("worker %s 开始排空，%s 秒后退出", worker.pid, WEB_DRAIN_SECONDS)
+        timer = threading.Timer(WEB_DRAIN_SECONDS, worker.handle_exit, args=(sig, frame))
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EHR Agent 生产环境服务")
+    parser.add_argument("--bind", default=WEB_BIND)
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--threads", type=int, default=WEB_THREADS)
+    args = parser.parse_args()
+
+    if not GOOGLE_API_KEY or GOOGLE_API_KEY == "your_google_api_key_here":
+        print("错误: 未设置有效的 GOOGLE_API_KEY")
+        sys.exit(1)
+
+    if ADMISSION_ENABLED:
+        from admission import parse_pools
+        required = sum(limit + queue_size for limit, queue_size in parse_pools(ADMISSION_POOLS).values())
+        if required > args.threads - RESERVED_THREADS:
+            print(f"警告: ADMISSION_POOLS 最多占用 {required} 个线程，"
+                  f"超过 {args.threads} - {RESERVED_THREADS}，过载时健康检查可能无法响应")
+
+    # 确保相对路径（output/、recordings/）相对于项目目录
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': max(WEB_GRACEFUL_TIMEOUT, int(WEB_DRAIN_SECONDS) + 5),
+        'keepalive': 5,
+        'preload_app': WEB_PRELOAD_APP,
+        'post_worker_init': post_worker_init,
+        'accesslog': '-',
+    }
+    if WEB_MAX_REQUESTS:
+        options['max_requests'] = WEB_MAX_REQUESTS
+        options['max_requests_jitter'] = max(1, WEB_MAX_REQUESTS // 10)
+
+    ProductionServer(options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import copy
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from metrics import metrics
+
+# 会话保存的字段；上游字段变化时，依赖它的下游结果随之失效
+# medications 为处方药物（{'name', 'dose', 'frequency'} 列表），合并模式下与 SOAP 一起生成
+SESSION_FIELDS = ('patient_info', 'transcript', 'soap', 'examinations', 'medications', 'drug_check')
+# SOAP 提示词包含患者信息，患者信息变化时 SOAP 及其下游都要重新生成
+DEPENDENTS = {
+    'patient_info': ('soap', 'examinations', 'medications', 'drug_check'),
+    'transcript': ('soap', 'examinations', 'medications', 'drug_check'),
+    'soap': ('examinations', 'medications', 'drug_check'),
+    'medications': ('drug_check',),
+}
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at);
+"""
+
+
+class StaleUpdate(Exception):
+    """写回的结果基于旧版本的会话，期间它依赖的输入已被修改"""
+
+
+def upstream(fields) -> set:
+    """fields 中各结果所依赖的会话字段"""
+    return {source for source, dependents in DEPENDENTS.items() if any(f in dependents for f in fields)}
+
+
+class SessionStore:
+    """问诊会话：转录文本、患者信息和各阶段结果保存在服务端，客户端只持有会话 ID
+
+    内存中按 LRU 保留最近使用的会话，总大小不超过 max_bytes。配置了 db_path 时
+    每次写入同时落盘（SQLite），被淘汰的会话仍可从磁盘取回，多个 worker 进程
+    也通过它共享会话；否则只在内存中保存，淘汰即丢失。
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, db_path: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # id -> (session, 序列化后的字节数)
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._bytes = 0
+        self._last_purge = 0.0
+
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connection() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+
+        metrics.gauge('session_memory_bytes', lambda: self._bytes)
+        metrics.gauge('session_memory_count', lambda: len(self._entries))
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _cache(self, session: Dict, size: int):
+        previous = self._entries.pop(session['id'], None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        self._entries[session['id']] = (session, size)
+        self._bytes += size
+        # 至少保留刚写入的会话
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            metrics.inc('session_evictions_total', spilled=str(bool(self.db_path)).lower())
+
+    def _drop(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _expired(self, session: Dict) -> bool:
+        return time.time() - session['updated_at'] > self.ttl
+
+    def _load(self, conn, session_id: str) -> Optional[Dict]:
+        """从磁盘读取；内存中的副本版本一致时直接使用，避免重复解析"""
+        row = conn.execute('SELECT version FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            self._drop(session_id)
+            return None
+        cached = self._entries.get(session_id)
+        if cached is not None and cached[0]['version'] == row[0]:
+            self._entries.move_to_end(session_id)
+            return cached[0]
+        data = conn.execute('SELECT data FROM sessions WHERE id = ?', (session_id,)).fetchone()[0]
+        session = json.loads(data)
+        self._cache(session, len(data.encode('utf-8')))
+        metrics.inc('session_disk_reads_total')
+        return session
+
+    def _save(self, session: Dict):
+        data = json.dumps(session, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        if self.db_path:
+            with self._connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                             (session['id'], data, session['version'], session['updated_at']))
+        self._cache(session, size)
+
+    def _purge_expired(self):
+        now = time.time()
+        if not self.db_path or now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        with self._connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE updated_at < ?', (now - self.ttl,))
+
+    def create(self, **fields) -> Dict:
+        now = time.time()
+        session = {field: fields.get(field) for field in SESSION_FIELDS}
+        session.update(id=uuid.uuid4().hex, version=1, created_at=now, updated_at=now)
+        with self._lock:
+            self._purge_expired()
+            self._save(session)
+        metrics.inc('sessions_created_total')
+        return copy.deepcopy(session)
+
+    def _get_locked(self, session_id: str, conn=None) -> Optional[Dict]:
+        if not SESSION_ID_PATTERN.match(session_id or ''):
+            return None
+        if conn is not None:
+            session = self._load(conn, session_id)
+        else:
+            entry = self._entries.get(session_id)
+            session = entry[0] if entry else None
+            if session is not None:
+                self._entries.move_to_end(session_id)
+        if session is not None and self._expired(session):
+            self._drop(session_id)
+            return None
+        return session
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            if self.db_path:
+                with self._connection() as conn:
+                    session = self._get_locked(session_id, conn)
+            else:
+                session = self._get_locked(session_id)
+        metrics.inc('session_lookups_total', result='hit' if session else 'miss')
+        return copy.deepcopy(session) if session else None
+
+    def update(self, session_id: str, read: Optional[Dict] = None, **fields) -> Optional[Dict]:
+        """更新字段；上游字段内容变化时清空依赖它的结果。会话不存在时返回 None
+
+        read 为计算这些结果时读取的会话。按版本比较后写入（compare-and-set）：版本已变化、
+        且结果所依赖的输入（如转录文本）与 read 不同时抛出 StaleUpdate，不写入；
+        只是其他结果先写入（如检查推荐与药物检查并行）时照常写入。
+        """
+        with self._lock:
+            if self.db_path:
+                with self._connection() as conn:
+                    # 写事务内读-改-写，其他进程的并发更新不会互相覆盖
+                    conn.execute('BEGIN IMMEDIATE')
+                    session = self._get_locked(session_id, conn)
+                    if session is None:
+                        conn.execute('ROLLBACK')
+                        return None
+                    try:
+                        self._check_current(session, read, fields)
+                    except StaleUpdate:
+                        conn.execute('ROLLBACK')
+                        raise
+                    session = self._apply(session, fields)
+                    data = json.dumps(session, ensure_ascii=False)
+                    conn.execute('UPDATE sessions SET data = ?, version = ?, updated_at = ? WHERE id = ?',
+                                 (data, session['version'], session['updated_at'], session_id))
+                    conn.execute('COMMIT')
+                self._cache(session, len(data.encode('utf-8')))
+            else:
+                session = self._get_locked(session_id)
+                if session is None:
+                    return None
+                self._check_current(session, read, fields)
+                session = self._apply(session, fields)
+                self._save(session)
+        return copy.deepcopy(session)
+
+    @staticmethod
+    def _check_current(session: Dict, read: Optional[Dict], fields: Dict):
+        if read is None or read['version'] == session['version']:
+            return
+        if any(read.get(field) != session.get(field) for field in upstream(fields)):
+            metrics.inc('session_stale_updates_total')
+            raise StaleUpdate(session['id'])
+
+    @staticmethod
+    def _apply(session: Dict, fields: Dict) -> Dict:
+        session = copy.deepcopy(session)
+        for field in SESSION_FIELDS:
+            if field in fields and fields[field] != session.get(field):
+                session[field] = fields[field]
+                for dependent in DEPENDENTS.get(field, ()):
+                    if dependent not in fields:
+                        session[dependent] = None
+        session['version'] += 1
+        session['updated_at'] = time.time()
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            existed = session_id in self._entries
+            self._drop(session_id)
+            if self.db_path:
+                with self._connection() as conn:
+                    existed = conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,)).rowcount > 0
+        return existed
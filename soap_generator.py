@@ -1,57 +1,64 @@
-import google.generativeai as genai
 from typing import Dict, Optional
 import json
 from datetime import datetime
+from gemini_client import GeminiModel
+from model_router import json_validator
+from config import SOAP_SIMILAR_CACHE_ENABLED
+from metrics import metrics
+from prompts import PATIENT_FIELDS, SOAP_PROMPT, patient_lines
+from transcript_cache import get_transcript_cache, minhash, normalize_transcript, similarity
+
+SOAP_FIELDS = ('chief_complaint', 'subjective', 'objective', 'assessment', 'plan', 'preliminary_diagnosis')
+
+# 快速模型的病历缺少主观资料、评估或计划，或没有诊断时升级到主模型
+validate_soap = json_validator(lambda result: (
+    all(isinstance(result.get(field), str) and result[field].strip()
+        for field in ('subjective', 'assessment', 'plan'))
+    and bool(result.get('preliminary_diagnosis'))
+))
 
 class SOAPGenerator:
-    def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash",
+                 use_similar_cache: bool = SOAP_SIMILAR_CACHE_ENABLED, temperature: float = 0.3):
+        self.model = GeminiModel(api_key, model)
+        self.temperature = temperature
+        self.similar_cache = get_transcript_cache() if use_similar_cache else None
     
     def generate_soap(self, consultation_transcript: str, patient_info: Optional[Dict] = None) -> Dict:
-        patient_context = ""
-        if patient_info:
-            patient_context = f"""
-患者基本信息：
-- 姓名：{patient_info.get('name', '未知')}
-- 年龄：{patient_info.get('age', '未知')}
-- 性别：{patient_info.get('gender', '未知')}
-- 既往史：{patient_info.get('medical_history', '无')}
-- 过敏史：{patient_info.get('allergies', '无')}
-"""
+        if self.similar_cache is None:
+            return self._generate(consultation_transcript, patient_info)
         
-        prompt = f"""
-你是一位经验丰富的临床医生。请根据以下问诊记录，生成一份完整的SOAP格式病历。
-
-{patient_context}
-
-问诊记录：
-{consultation_transcript}
-
-请按照SOAP格式生成病历，包括：
-1. S (Subjective - 主观资料)：患者主诉、现病史、既往史、个人史等
-2. O (Objective - 客观资料)：体格检查发现、生命体征等
-3. A (Assessment - 评估)：初步诊断、鉴别诊断等
-4. P (Plan - 计划)：治疗方案、检查计划、用药计划、随访计划等
-
-请以JSON格式返回，包含以下字段：
-- subjective: 主观资料
-- objective: 客观资料  
-- assessment: 评估
-- plan: 计划
-- chief_complaint: 主诉（简要）
-- preliminary_diagnosis: 初步诊断（列表）
-
-确保内容专业、准确、完整。
-"""
+        fingerprint = self.similar_cache.fingerprint(consultation_transcript, patient_info)
+        # 相似的历史病历属于其他患者，既不返回也不写进提示词，只用于统计命中与重复度
+        match = self.similar_cache.lookup(fingerprint)
+        result = self._generate(consultation_transcript, patient_info)
+        if 'error' not in result:
+            if match is not None:
+                # 历史病历与本次病历的相似度，衡量相似命中的重复程度
+                metrics.observe('soap_similar_cache_quality',
+                                similarity(self._soap_signature(match.result), self._soap_signature(result)))
+            self.similar_cache.add(fingerprint, consultation_transcript, result)
+        return result
+    
+    @staticmethod
+    def _soap_signature(soap_data: Dict):
+        return minhash(normalize_transcript(json.dumps([soap_data.get(f) for f in SOAP_FIELDS], ensure_ascii=False)))
+    
+    def _generate(self, consultation_transcript: str, patient_info: Optional[Dict] = None) -> Dict:
+        prompt = SOAP_PROMPT.render(
+            patient=patient_lines(patient_info, PATIENT_FIELDS),
+            transcript=consultation_transcript,
+        )
         
         try:
             generation_config = {
-                "temperature": 0.3,
+                "temperature": self.temperature,
                 "response_mime_type": "application/json",
             }
             
-            response = self.model.generate_content(prompt, generation_config=generation_config)
+            response = self.model.generate_content(prompt, generation_config=generation_config, stage='soap',
+                                                   validate=validate_soap,
+                                                   system_instruction=SOAP_PROMPT.system_instruction)
             result = json.loads(response.text)
             result['generated_at'] = datetime.now().isoformat()
             return result
@@ -1,5 +1,10 @@
+import os
 import speech_recognition as sr
-from typing import Optional
+from typing import Optional, Tuple
+from audio_codec import NATIVE_FORMATS, decode_to_pcm
+from audio_preprocess import TimeMap, preprocess_pcm
+from config import ASR_PREPROCESS
+from metrics import metrics
 
 class SpeechToText:
     def __init__(self, google_api_key: Optional[str] = None):
@@ -8,11 +13,34 @@ class SpeechToText:
         self.recognizer.dynamic_energy_threshold = True
         self.recognizer.pause_threshold = 0.8
         self.google_api_key = google_api_key
+        self.preprocess = ASR_PREPROCESS
+    
+    def _prepare(self, audio: sr.AudioData) -> Tuple[Optional[sr.AudioData], Optional[TimeMap]]:
+        """去静音、归一化增益；整段都是静音时音频为 None，不必调用识别服务
+
+        同时返回时间映射（未预处理时为 None），用于把识别结果的时间换算回原始录音。
+        """
+        if not self.preprocess:
+            return audio, None
+        result = preprocess_pcm(audio.get_raw_data(), audio.sample_rate, audio.sample_width)
+        metrics.inc('asr_audio_seconds_total', result.original_seconds, stage='input')
+        metrics.inc('asr_audio_seconds_total', result.kept_seconds, stage='sent')
+        if result.kept_seconds == 0:
+            return None, result.time_map
+        return sr.AudioData(result.pcm, result.sample_rate, 2), result.time_map
         
     def transcribe_file(self, audio_file: str, language: str = "zh-CN") -> Optional[str]:
         try:
-            with sr.AudioFile(audio_file) as source:
-                audio = self.recognizer.record(source)
+            if os.path.splitext(audio_file)[1].lower() in NATIVE_FORMATS:
+                with sr.AudioFile(audio_file) as source:
+                    audio = self.recognizer.record(source)
+            else:
+                # Opus 等压缩格式先解码为 PCM
+                pcm, sample_rate, sample_width = decode_to_pcm(audio_file)
+                audio = sr.AudioData(pcm, sample_rate, sample_width)
+            audio, _ = self._prepare(audio)
+            if audio is None:
+                return None
             
             if self.google_api_key:
                 text = self.recognizer.recognize_google(audio, language=language, key=self.google_api_key)
@@ -29,6 +57,9 @@ class SpeechToText:
             
             try:
                 audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
+                audio, _ = self._prepare(audio)
+                if audio is None:
+                    return ""
                 if self.google_api_key:
                     return self.recognizer.recognize_google(audio, language="zh-CN", key=self.google_api_key)
                 else:
@@ -41,7 +72,9 @@ class SpeechToText:
     
     def transcribe_stream(self, audio_data: bytes, sample_rate: int = 16000) -> Optional[str]:
         try:
-            audio = sr.AudioData(audio_data, sample_rate, 2)
+            audio, _ = self._prepare(sr.AudioData(audio_data, sample_rate, 2))
+            if audio is None:
+                return None
             if self.google_api_key:
                 return self.recognizer.recognize_google(audio, language="zh-CN", key=self.google_api_key)
             else:
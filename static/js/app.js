@@ -3,6 +3,22 @@
 let recognition = null;
 let isRecording = false;
 let soapData = null;
+// 服务端问诊会话：转录文本和患者信息只在变化时上传，各阶段请求只带会话 ID
+let sessionId = null;
+let sessionSynced = null;
+// 进行中的后台任务（按类型）：重新发起或输入变化时取消旧任务
+const activeJobs = {};
+
+// 服务端流式识别（WebSocket）
+const LIVE_CHUNK_MS = 3000;
+const LIVE_MAX_PENDING_CHUNKS = 20;
+let liveSocket = null;
+let liveStream = null;
+let liveRecorder = null;
+let liveChunkTimer = null;
+let livePaused = false;
+let livePendingChunks = [];
+let liveLastChunk = null;
 
 // 初始化
 document.addEventListener('DOMContentLoaded', function() {
@@ -62,12 +78,26 @@ function initializeSpeechRecognition() {
                 }
             }
         };
-    } else {
+    } else if (!getLiveAudioFormat()) {
         document.getElementById('start-recording').disabled = true;
         document.getElementById('start-recording').innerHTML = '<span class="icon">⚠️</span> 浏览器不支持语音识别';
     }
 }
 
+// 服务端识别所需的录音格式，不支持时返回 null
+function getLiveAudioFormat() {
+    if (!window.MediaRecorder || !window.WebSocket || !navigator.mediaDevices) {
+        return null;
+    }
+    if (MediaRecorder.isTypeSupported('audio/webm;codecs=opus')) {
+        return { mimeType: 'audio/webm;codecs=opus', format: 'webm' };
+    }
+    if (MediaRecorder.isTypeSupported('audio/ogg;codecs=opus')) {
+        return { mimeType: 'audio/ogg;codecs=opus', format: 'ogg' };
+    }
+    return null;
+}
+
 // 设置事件监听器
 function setupEventListeners() {
     // 录音控制
@@ -79,6 +109,17 @@ function setupEventListeners() {
     document.getElementById('consultation-text').addEventListener('input', function() {
         updateCharCount();
         updateButtonStates();
+        // 转录文本已变化，基于旧文本的结果不再需要
+        cancelAllJobs();
+    });
+    
+    // 关闭或离开页面时通知服务端取消仍在运行的任务
+    window.addEventListener('pagehide', function() {
+        Object.values(activeJobs).forEach(active => {
+            if (active.jobId) {
+                navigator.sendBeacon(`/api/jobs/${active.jobId}/cancel`);
+            }
+        });
     });
     
     // 功能按钮
@@ -90,6 +131,10 @@ function setupEventListeners() {
 
 // 开始录音
 function startRecording() {
+    if (!isRecording && getLiveAudioFormat()) {
+        startLiveRecording();
+        return;
+    }
     if (recognition && !isRecording) {
         try {
             recognition.start();
@@ -102,6 +147,10 @@ function startRecording() {
 
 // 停止录音
 function stopRecording() {
+    if (liveSocket && isRecording) {
+        stopLiveRecording();
+        return;
+    }
     if (recognition && isRecording) {
         isRecording = false;
         recognition.stop();
@@ -111,6 +160,148 @@ function stopRecording() {
     }
 }
 
+// 服务端流式识别：录音分块上传，服务端推回识别结果
+async function startLiveRecording() {
+    const audioFormat = getLiveAudioFormat();
+    try {
+        liveStream = await navigator.mediaDevices.getUserMedia({ audio: true });
+    } catch (e) {
+        console.error('获取麦克风失败:', e);
+        updateRecordingStatus('启动录音失败，请检查麦克风权限', false);
+        return;
+    }
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    liveSocket = new WebSocket(`${protocol}//${window.location.host}/ws/consultation`);
+    liveSocket.binaryType = 'arraybuffer';
+    livePaused = false;
+    livePendingChunks = [];
+
+    liveSocket.onopen = function() {
+        liveSocket.send(JSON.stringify({ type: 'start', format: audioFormat.format }));
+    };
+
+    liveSocket.onmessage = function(event) {
+        const message = JSON.parse(event.data);
+        if (message.type === 'ready') {
+            isRecording = true;
+            updateRecordingStatus('正在录音...', true);
+            document.getElementById('start-recording').disabled = true;
+            document.getElementById('stop-recording').disabled = false;
+            startLiveChunk(audioFormat.mimeType);
+        } else if (message.type === 'partial') {
+            updateRecordingStatus('正在录音... ' + message.text, true);
+        } else if (message.type === 'final') {
+            if (message.text) {
+                const textarea = document.getElementById('consultation-text');
+                textarea.value += message.text + ' ';
+                updateCharCount();
+                updateButtonStates();
+            }
+        } else if (message.type === 'backpressure') {
+            livePaused = message.paused;
+            if (!livePaused) {
+                flushLiveChunks();
+            }
+        } else if (message.type === 'error') {
+            console.error('服务端识别错误:', message.error);
+        } else if (message.type === 'done') {
+            liveSocket.close();
+        }
+    };
+
+    liveSocket.onerror = function() {
+        updateRecordingStatus('语音识别连接错误', false);
+    };
+
+    liveSocket.onclose = function() {
+        releaseLiveRecorder();
+        liveSocket = null;
+        if (isRecording) {
+            isRecording = false;
+            updateRecordingStatus('录音已停止', false);
+        }
+        document.getElementById('start-recording').disabled = false;
+        document.getElementById('stop-recording').disabled = true;
+    };
+}
+
+// 每个分块单独启动一次 MediaRecorder，保证每块都是可独立解码的完整文件
+function startLiveChunk(mimeType) {
+    liveRecorder = new MediaRecorder(liveStream, { mimeType: mimeType });
+    liveRecorder.ondataavailable = function(event) {
+        if (event.data.size > 0) {
+            liveLastChunk = event.data.arrayBuffer().then(sendLiveChunk);
+        }
+    };
+    liveRecorder.onstop = function() {
+        if (isRecording) {
+            startLiveChunk(mimeType);
+        } else {
+            Promise.resolve(liveLastChunk).then(finishLiveStream);
+        }
+    };
+    liveRecorder.start();
+    liveChunkTimer = setTimeout(function() {
+        if (liveRecorder && liveRecorder.state === 'recording') {
+            liveRecorder.stop();
+        }
+    }, LIVE_CHUNK_MS);
+}
+
+function sendLiveChunk(buffer) {
+    if (!liveSocket || liveSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    if (livePaused || livePendingChunks.length > 0) {
+        // 服务端要求暂停时在本地暂存，超出上限丢弃最旧的分块
+        livePendingChunks.push(buffer);
+        if (livePendingChunks.length > LIVE_MAX_PENDING_CHUNKS) {
+            livePendingChunks.shift();
+        }
+        return;
+    }
+    liveSocket.send(buffer);
+}
+
+function flushLiveChunks() {
+    while (!livePaused && livePendingChunks.length > 0) {
+        liveSocket.send(livePendingChunks.shift());
+    }
+}
+
+// 结束时把暂存的分块全部发出，服务端读取变慢会通过 TCP 自然限速
+function finishLiveStream() {
+    if (!liveSocket || liveSocket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    while (livePendingChunks.length > 0) {
+        liveSocket.send(livePendingChunks.shift());
+    }
+    liveSocket.send(JSON.stringify({ type: 'stop' }));
+}
+
+function stopLiveRecording() {
+    isRecording = false;
+    clearTimeout(liveChunkTimer);
+    updateRecordingStatus('正在完成识别...', false);
+    document.getElementById('stop-recording').disabled = true;
+    if (liveRecorder && liveRecorder.state === 'recording') {
+        liveRecorder.stop();
+    } else {
+        finishLiveStream();
+    }
+}
+
+function releaseLiveRecorder() {
+    clearTimeout(liveChunkTimer);
+    if (liveStream) {
+        liveStream.getTracks().forEach(track => track.stop());
+        liveStream = null;
+    }
+    liveRecorder = null;
+}
+
 // 更新录音状态
 function updateRecordingStatus(message, isRecording) {
     const statusEl = document.getElementById('recording-status');
@@ -124,6 +315,7 @@ function clearText() {
         document.getElementById('consultation-text').value = '';
         updateCharCount();
         updateButtonStates();
+        cancelAllJobs();
     }
 }
 
@@ -146,6 +338,10 @@ function showLoading() {
 
 // 隐藏加载提示
 function hideLoading() {
+    // 被取代的请求结束时，新请求可能仍在进行
+    if (Object.keys(activeJobs).length > 0) {
+        return;
+    }
     document.getElementById('loading').classList.add('hidden');
 }
 
@@ -161,30 +357,169 @@ function getPatientInfo() {
     };
 }
 
-// 生成 SOAP 病历
-async function generateSOAP() {
-    const transcript = document.getElementById('consultation-text').value.trim();
-    if (!transcript) {
-        alert('请先输入问诊记录');
+// 通过后台任务接口执行耗时的 AI 操作：提交后长轮询结果，单个请求不会超过代理超时
+const JOB_POLL_WAIT = 20;
+
+async function syncSession(restore = {}) {
+    const inputs = JSON.stringify({
+        transcript: document.getElementById('consultation-text').value.trim(),
+        patient_info: getPatientInfo()
+    });
+    if (sessionId && inputs === sessionSynced) {
         return;
     }
     
-    showLoading();
+    const body = sessionId ? inputs : JSON.stringify({ ...JSON.parse(inputs), ...restore });
+    const response = await fetchWithRetry(sessionId ? `/api/sessions/${sessionId}` : '/api/sessions', {
+        method: sessionId ? 'PATCH' : 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: body
+    });
+    if (response.status === 404 && sessionId) {
+        sessionId = null;
+        return syncSession(restore);
+    }
+    const result = await response.json();
+    if (!response.ok) {
+        throw new Error(result.error);
+    }
+    sessionId = result.session_id;
+    sessionSynced = inputs;
+}
+
+// 会话过期（服务端重启且未落盘、超过保留时间）时用本地保存的结果重建会话后重试一次
+async function runSessionJob(type) {
+    await syncSession();
+    let result = await runJob(type, { session_id: sessionId });
+    if (!result.success && result.session_expired) {
+        sessionId = null;
+        await syncSession(soapData ? { soap: soapData } : {});
+        result = await runJob(type, { session_id: sessionId });
+    }
+    return result;
+}
+
+// 服务端过载时返回 429/503 和 Retry-After，按建议的时间等待后重试
+const OVERLOAD_MAX_RETRIES = 5;
+
+async function fetchWithRetry(url, options = {}) {
+    for (let attempt = 0; ; attempt++) {
+        const response = await fetch(url, options);
+        if ((response.status !== 429 && response.status !== 503) || attempt >= OVERLOAD_MAX_RETRIES) {
+            return response;
+        }
+        const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 1;
+        await abortableSleep(retryAfter * 1000, options.signal);
+    }
+}
+
+function abortableSleep(ms, signal) {
+    return new Promise((resolve, reject) => {
+        if (signal && signal.aborted) {
+            reject(new DOMException('Aborted', 'AbortError'));
+            return;
+        }
+        const timer = setTimeout(resolve, ms);
+        if (signal) {
+            signal.addEventListener('abort', () => {
+                clearTimeout(timer);
+                reject(new DOMException('Aborted', 'AbortError'));
+            }, { once: true });
+        }
+    });
+}
+
+// 取消进行中的任务：中止浏览器端的请求，并通知服务端停止执行
+function cancelJob(type) {
+    const active = activeJobs[type];
+    if (!active) {
+        return;
+    }
+    delete activeJobs[type];
+    active.controller.abort();
+    if (active.jobId) {
+        fetch(`/api/jobs/${active.jobId}/cancel`, { method: 'POST', keepalive: true }).catch(() => {});
+    }
+}
+
+function cancelAllJobs() {
+    Object.keys(activeJobs).forEach(cancelJob);
+}
+
+// 同一类型的任务同时只保留最新一个；被取代或取消时返回 { cancelled: true }
+async function runJob(type, payload) {
+    cancelJob(type);
+    const controller = new AbortController();
+    const active = { controller: controller, jobId: null };
+    activeJobs[type] = active;
     
     try {
-        const response = await fetch('/api/generate-soap', {
+        const submitResponse = await fetchWithRetry('/api/jobs', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({
-                transcript: transcript,
-                patient_info: getPatientInfo()
-            })
+            body: JSON.stringify({ type: type, payload: payload, watch: true }),
+            signal: controller.signal
         });
+        const job = await submitResponse.json();
+        if (!job.success) {
+            return { success: false, error: job.error };
+        }
+        active.jobId = job.job_id;
+        if (controller.signal.aborted) {
+            // 提交请求返回前已被取消，此时才拿到任务 ID
+            fetch(`/api/jobs/${job.job_id}/cancel`, { method: 'POST', keepalive: true }).catch(() => {});
+            return { success: false, cancelled: true };
+        }
         
-        const result = await response.json();
+        while (true) {
+            const response = await fetchWithRetry(`/api/jobs/${job.job_id}?wait=${JOB_POLL_WAIT}`,
+                                                  { signal: controller.signal });
+            const current = await response.json();
+            if (!response.ok) {
+                return { success: false, error: current.error };
+            }
+            if (current.status === 'succeeded') {
+                return current.result;
+            }
+            if (current.status === 'failed') {
+                return { success: false, error: current.error };
+            }
+            if (current.status === 'cancelled') {
+                return { success: false, cancelled: true };
+            }
+        }
+    } catch (error) {
+        if (error.name === 'AbortError') {
+            return { success: false, cancelled: true };
+        }
+        throw error;
+    } finally {
+        if (activeJobs[type] === active) {
+            delete activeJobs[type];
+        }
+    }
+}
+
+// 生成 SOAP 病历
+async function generateSOAP() {
+    const transcript = document.getElementById('consultation-text').value.trim();
+    if (!transcript) {
+        alert('请先输入问诊记录');
+        return;
+    }
+    
+    showLoading();
+    
+    try {
+        const result = await runSessionJob('generate-soap');
         
+        if (result.cancelled) {
+            return;
+        }
         if (result.success) {
             soapData = result.data;
             displaySOAP(result.data);
@@ -242,20 +577,11 @@ async function recommendExaminations() {
     showLoading();
     
     try {
-        const transcript = document.getElementById('consultation-text').value.trim();
-        const response = await fetch('/api/recommend-examinations', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                soap_data: soapData,
-                transcript: transcript
-            })
-        });
-        
-        const result = await response.json();
+        const result = await runSessionJob('recommend-examinations');
         
+        if (result.cancelled) {
+            return;
+        }
         if (result.success) {
             displayExaminations(result.data);
         } else {
@@ -320,19 +646,11 @@ async function checkDrugConflicts() {
     showLoading();
     
     try {
-        const response = await fetch('/api/check-drug-conflicts', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                plan_text: soapData.plan,
-                patient_info: getPatientInfo()
-            })
-        });
-        
-        const result = await response.json();
+        const result = await runSessionJob('check-drug-conflicts');
         
+        if (result.cancelled) {
+            return;
+        }
         if (result.success) {
             displayDrugCheck(result.data, result.prescribed_drugs);
             document.getElementById('save-report').disabled = false;
@@ -352,7 +670,10 @@ function displayDrugCheck(data, prescribedDrugs) {
     let html = '';
     
     if (prescribedDrugs && prescribedDrugs.length > 0) {
-        html += `<h3>检测到的药物</h3><p>${prescribedDrugs.join(', ')}</p>`;
+        const drugText = prescribedDrugs.map(drug => typeof drug === 'object'
+            ? [drug.name, drug.dose, drug.frequency].filter(Boolean).join(' ')
+            : drug);
+        html += `<h3>检测到的药物</h3><p>${drugText.join(', ')}</p>`;
     }
     
     if (data.message) {
@@ -449,13 +770,16 @@ async function saveReport() {
             report += `初步诊断: ${(soapData.preliminary_diagnosis || []).join(', ')}\n\n`;
         }
         
+        await syncSession();
         const response = await fetch('/api/save-report', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                content: report
+                content: report,
+                // 结构化记录由服务端从会话中取出，随报告一起保存，用于 FHIR 导出
+                session_id: sessionId
             })
         });
         
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, Optional
+
+from flask import Flask, Response, abort, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class StaticAsset:
+    def __init__(self, filename: str, content: bytes):
+        self.filename = filename
+        self.content = content
+        self.etag = hashlib.sha256(content).hexdigest()
+        root, ext = os.path.splitext(filename)
+        self.fingerprinted = f"{root}.{self.etag[:12]}{ext}"
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        # 完整的 Content-Type，响应时原样使用，不再经过 Response 的 charset 补全
+        self.content_type = mimetype
+        if mimetype.startswith('text/') or mimetype == 'application/javascript':
+            self.content_type += '; charset=utf-8'
+        # 启动时预压缩，请求时只做查表
+        self.variants: Dict[str, bytes] = {}
+        if mimetype.startswith(COMPRESSIBLE_TYPES):
+            self.variants['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(content, quality=11)
+
+    def pick_encoding(self, accept_encoding) -> Optional[str]:
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encoding[encoding]:
+                # 压缩后反而更大的变体没有意义
+                if len(self.variants[encoding]) < len(self.content):
+                    return encoding
+        return None
+
+
+class StaticAssets:
+    """静态资源指纹化、预压缩，以及 JSON/HTML 响应的按需压缩"""
+
+    def __init__(self, app: Optional[Flask] = None, compress_min_size: int = 1024):
+        self.compress_min_size = compress_min_size
+        self.assets: Dict[str, StaticAsset] = {}
+        self.by_fingerprint: Dict[str, StaticAsset] = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.static_folder = app.static_folder
+        self.build_manifest()
+        app.url_defaults(self._fingerprint_url)
+        app.view_functions['static'] = self.send_static
+        app.after_request(self.compress_response)
+        app.extensions['static_assets'] = self
+
+    def build_manifest(self):
+        self.assets.clear()
+        self.by_fingerprint.clear()
+        for root, _, files in os.walk(self.static_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    asset = StaticAsset(filename, f.read())
+                self.assets[filename] = asset
+                self.by_fingerprint[asset.fingerprinted] = asset
+
+    def _fingerprint_url(self, endpoint: str, values: Dict):
+        if endpoint == 'static' and 'filename' in values:
+            asset = self.assets.get(values['filename'])
+            if asset is not None:
+                values['filename'] = asset.fingerprinted
+
+    def send_static(self, filename: str):
+        asset = self.by_fingerprint.get(filename)
+        if asset is None:
+            # 未指纹化的旧地址：照常返回，但每次都需要重新验证
+            if filename not in self.assets:
+                abort(404)
+            response = send_from_directory(self.static_folder, filename)
+            response.cache_control.no_cache = True
+            return response
+
+        if request.if_none_match.contains_weak(asset.etag):
+            response = Response(status=304)
+            response.set_etag(asset.etag)
+        else:
+            encoding = asset.pick_encoding(request.accept_encodings)
+            response = Response(asset.variants[encoding] if encoding else asset.content,
+                                content_type=asset.content_type)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            response.set_etag(asset.etag, weak=bool(encoding))
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def compress_response(self, response: Response) -> Response:
+        if (response.direct_passthrough
+                or response.is_streamed
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip']:
+            return response
+
+        data = response.get_data()
+        if len(data) < self.compress_min_size:
+            return response
+
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+        # 压缩后的表示与原文不是字节级一致，强 ETag 降级为弱 ETag
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
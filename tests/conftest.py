@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 测试不写审计日志、不共享限流状态，会话只存内存，任务库放在临时目录
+os.environ.setdefault('AUDIT_ENABLED', '0')
+os.environ.setdefault('MODEL_RATE_STATE_PATH', '')
+os.environ.setdefault('SESSION_DB_PATH', '')
+os.environ.setdefault('JOBS_DB_PATH', os.path.join(tempfile.mkdtemp(), 'jobs.db'))
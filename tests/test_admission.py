@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+from flask import Flask
+
+import admission
+from admission import AdmissionControl, Pool, Rejected, parse_pools
+from config import ADMISSION_POOLS, LIVE_ASR_WORKERS, WEB_THREADS
+
+
+def test_parse_pools():
+    assert parse_pools('model=6:4, poll=6, api=2:2') == {'model': (6, 4), 'poll': (6, 0), 'api': (2, 2)}
+
+
+def test_default_pools_fit_threads_and_live_consultations():
+    pools = parse_pools(ADMISSION_POOLS)
+    assert pools['live'][0] == LIVE_ASR_WORKERS
+    assert sum(limit + queue for limit, queue in pools.values()) <= WEB_THREADS - 2
+
+
+def test_websocket_has_its_own_pool():
+    assert admission.ROUTE_POOLS['consultation_ws'] == 'live'
+    assert admission.ROUTE_POOLS['job_events'] == 'stream'
+
+
+def test_full_queue_rejects_with_429():
+    pool = Pool('test', limit=1, queue_size=0, max_wait=0.1)
+    pool.acquire()
+    with pytest.raises(Rejected) as e:
+        pool.acquire()
+    assert e.value.status == 429
+    pool.release(0.01)
+    pool.acquire()
+
+
+def test_wait_timeout_rejects_with_503():
+    pool = Pool('test', limit=1, queue_size=1, max_wait=0.05)
+    pool.acquire()
+    with pytest.raises(Rejected) as e:
+        pool.acquire()
+    assert e.value.status == 503
+
+
+def test_queued_request_admitted_after_release():
+    pool = Pool('test', limit=1, queue_size=1, max_wait=2)
+    pool.acquire()
+    admitted = threading.Event()
+
+    def waiter():
+        pool.acquire()
+        admitted.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    assert not admitted.wait(0.05)
+    pool.release(0.01)
+    assert admitted.wait(1)
+    thread.join()
+
+
+def test_flask_routes_are_limited_and_health_is_exempt():
+    app = Flask(__name__)
+    entered, proceed = threading.Event(), threading.Event()
+
+    @app.route('/api/slow')
+    def slow():
+        entered.set()
+        proceed.wait(2)
+        return 'ok'
+
+    @app.route('/health')
+    def health():
+        return 'ok'
+
+    AdmissionControl(app, 'api=1:0')
+    client = app.test_client()
+    thread = threading.Thread(target=lambda: client.get('/api/slow'))
+    thread.start()
+    assert entered.wait(1)
+    try:
+        busy = client.get('/api/slow')
+        assert busy.status_code == 429
+        assert busy.headers['Retry-After']
+        assert client.get('/health').status_code == 200
+    finally:
+        proceed.set()
+        thread.join()
+    assert client.get('/api/slow').status_code == 200
+
+
+def test_route_pools_name_real_endpoints():
+    import app as web_app
+    assert set(admission.ROUTE_POOLS) <= set(web_app.app.view_functions)
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from consolidated_generator import ConsolidatedGenerator
+from drug_checker import DrugChecker
+from drug_normalizer import clean_drug_name, get_normalizer
+from fhir_export import record_to_resources
+
+
+@pytest.fixture(scope='module')
+def normalizer():
+    return get_normalizer()
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('阿莫西林', 'amoxicillin'),
+    ('Amoxicillin 0.5g tid', 'amoxicillin'),
+    ('阿莫仙胶囊', 'amoxicillin'),
+    ('苯磺酸氨氯地平片 5mg qd', 'amlodipine'),
+    ('强的松', 'prednisone'),
+])
+def test_exact_and_alias_matches(normalizer, name, expected):
+    match = normalizer.normalize(name)
+    assert match.method == 'exact'
+    assert match.drug_id == expected
+
+
+@pytest.mark.parametrize('name, lookalike', [
+    ('头孢克洛', '头孢克肟'),
+    ('氧氟沙星', '左氧氟沙星'),
+    ('泼尼松龙', '泼尼松'),
+    ('地氯雷他定', '氯雷他定'),
+    ('左氨氯地平', '氨氯地平'),
+])
+def test_lookalike_drugs_are_not_merged(normalizer, name, lookalike):
+    match = normalizer.normalize(name)
+    assert match.drug_id is None
+    assert match.name == name
+    if match.method == 'fuzzy':
+        assert match.suggestion == lookalike
+    assert normalizer.canonical_list([name, lookalike]) == [name, lookalike]
+
+
+def test_annotate_list_keeps_original_text_and_dose(normalizer):
+    annotated = normalizer.annotate_list(['阿莫仙 0.5g tid', '头孢克洛 0.25g bid', '阿莫仙 0.5g tid', '布洛芬'])
+    assert annotated[0] == '阿莫仙 0.5g tid（通用名：阿莫西林）'
+    assert annotated[1].startswith('头孢克洛 0.25g bid')
+    assert '头孢克肟' not in annotated[1].split('（')[0]
+    assert len(annotated) == 3
+
+
+def test_prescribed_aliases_are_checked_once(normalizer):
+    annotated = normalizer.annotate_medications([
+        {'name': '阿莫仙', 'dose': '0.5g', 'frequency': 'tid'},
+        {'name': 'Amoxicillin', 'dose': '0.5 g', 'frequency': 'TID'},
+        {'name': '阿莫西林', 'dose': '0.25g', 'frequency': 'tid'},
+        {'name': 'ibuprofen', 'dose': '0.3g', 'frequency': '每日两次'},
+    ])
+    # 通用名原文不附注；同一药物同剂量同用法只保留一条，剂量不同的保留
+    assert annotated == ['阿莫仙 0.5g tid（通用名：阿莫西林）', '阿莫西林 0.25g tid', 'ibuprofen 0.3g 每日两次']
+
+
+def test_canonical_list_deduplicates_aliases(normalizer):
+    assert normalizer.canonical_list(['阿莫西林', 'amoxicillin', '阿莫仙 0.5g']) == ['阿莫西林']
+
+
+def test_clean_drug_name_strips_dose_and_form():
+    assert clean_drug_name('盐酸二甲双胍缓释片 0.5g bid') == '盐酸二甲双胍'
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    def __init__(self, result):
+        self.result = result
+        self.prompts = []
+
+    def generate_content(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return FakeResponse(json.dumps(self.result, ensure_ascii=False))
+
+
+def test_consolidated_doses_reach_the_drug_check():
+    generator = ConsolidatedGenerator('key')
+    generator.model = FakeModel({'soap': {'plan': '阿莫西林 0.5g tid'}, 'examinations': [], 'medications': [
+        {'name': '阿莫西林', 'dose': '0.5g', 'frequency': 'tid'}, {'name': '阿莫西林', 'dose': '0.5g', 'frequency': 'tid'},
+    ]})
+    checker = DrugChecker('key')
+    checker.model = FakeModel({'has_conflicts': False})
+
+    combined = generator.generate('医生：开阿莫西林。', {})
+    assert combined['prescribed_drugs'] == [{'name': '阿莫西林', 'dose': '0.5g', 'frequency': 'tid'}]
+    checker.check_drug_conflicts(combined['prescribed_drugs'])
+    assert '阿莫西林 0.5g tid' in checker.model.prompts[0]
+
+
+def test_free_text_frequency_does_not_break_coding():
+    record = {'id': 'r1', 'drug_check': {'prescribed_drugs': [{'name': '布洛芬', 'dose': '0.3g', 'frequency': '每日两次'}]}}
+    request = next(r for r in record_to_resources(record) if r['resourceType'] == 'MedicationRequest')
+    assert request['medicationCodeableConcept']['coding'][0]['code'] == get_normalizer().normalize('布洛芬').drug_id
+    assert request['dosageInstruction'] == [{'text': '0.3g 每日两次'}]
+
+
+def test_extracted_drugs_match_consolidated_shape():
+    checker = DrugChecker('key')
+    checker.model = FakeModel({'drugs': [{'name': '布洛芬', 'dose': '0.3g', 'frequency': '每日两次'}]})
+    assert checker.extract_drugs_from_plan('布洛芬 0.3g 每日两次') == [
+        {'name': '布洛芬', 'dose': '0.3g', 'frequency': '每日两次'}]
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+
+import cancellation
+import gemini_client
+from gemini_client import GeminiModel
+from job_queue import JobQueue
+from model_scheduler import ModelScheduler, RateLimiter
+
+
+def wait_for(job_queue, job_id, statuses, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = job_queue.get(job_id)
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"任务没有进入 {statuses}: {job_queue.get(job_id)}")
+
+
+@pytest.fixture
+def blocking_queue(tmp_path):
+    started = threading.Event()
+
+    def handler(payload):
+        # 模拟流式接收模型响应：每个分片之间检查取消
+        started.set()
+        token = cancellation.current()
+        for _ in range(500):
+            token.check('test')
+            time.sleep(0.01)
+        return {'done': True}
+
+    job_queue = JobQueue(str(tmp_path / 'jobs.db'), {'slow': handler}, workers=1, poll_interval=0.05)
+    job_queue.started = started
+    return job_queue
+
+
+def test_cancel_queued_job(blocking_queue):
+    job = blocking_queue.submit('slow', {})
+    cancelled = blocking_queue.cancel(job['job_id'])
+    assert cancelled['status'] == 'cancelled'
+
+
+def test_cancel_running_job_stops_handler(blocking_queue, monkeypatch):
+    monkeypatch.setattr(cancellation, 'PROBE_INTERVAL', 0.01)
+    blocking_queue.start()
+    job = blocking_queue.submit('slow', {})
+    assert blocking_queue.started.wait(2)
+    blocking_queue.cancel(job['job_id'])
+    finished = wait_for(blocking_queue, job['job_id'], ('cancelled', 'succeeded'))
+    assert finished['status'] == 'cancelled'
+    assert finished['error'] == 'cancelled'
+
+
+def test_jobs_report_whether_they_are_watched(blocking_queue):
+    watched = blocking_queue.submit('slow', {}, watch=True)
+    unwatched = blocking_queue.submit('slow', {})
+    assert blocking_queue.get(watched['job_id'])['watched'] is True
+    assert blocking_queue.get(unwatched['job_id'])['watched'] is False
+
+
+def test_cancelled_while_queued_for_quota():
+    scheduler = ModelScheduler(RateLimiter(rpm=1000, tpm=0))
+    token = cancellation.CancelToken()
+    token.cancel('cancelled')
+    with cancellation.scope(token), pytest.raises(cancellation.Cancelled):
+        scheduler.acquire(1, timeout=5)
+    assert scheduler.depth('interactive') == 0
+
+
+class RecordingScheduler:
+    def __init__(self):
+        self.settled = []
+
+    def acquire(self, tokens, lane_name=None):
+        return 0.0
+
+    def settle(self, estimated, actual):
+        self.settled.append((estimated, actual))
+
+
+class FailingModel:
+    def generate_content(self, prompt, **kwargs):
+        raise RuntimeError('upstream error')
+
+
+def test_failed_call_refunds_estimated_tokens(monkeypatch):
+    scheduler = RecordingScheduler()
+    monkeypatch.setattr(gemini_client, 'get_scheduler', lambda: scheduler)
+    model = GeminiModel('key', 'test-model', backend='local')
+    model._models[('test-model', None)] = (FailingModel(), float('inf'))
+    with pytest.raises(RuntimeError):
+        model._call('test-model', '问诊记录', None, 'soap')
+    assert len(scheduler.settled) == 1
+    assert scheduler.settled[0][1] == 0
+
+
+def test_submit_and_poll_job_over_http(tmp_path, monkeypatch):
+    import app as web_app
+    handler = web_app.job_handler(lambda payload: {'success': True, 'data': payload['transcript']})
+    job_queue = JobQueue(str(tmp_path / 'web_jobs.db'), {'generate-soap': handler}, workers=1, poll_interval=0.05)
+    monkeypatch.setattr(web_app, 'job_queue', job_queue)
+    client = web_app.app.test_client()
+
+    submitted = client.post('/api/jobs', json={'type': 'generate-soap', 'payload': {'transcript': '咳嗽三天'},
+                                               'watch': True})
+    assert submitted.status_code == 202
+    polled = client.get(f"/api/jobs/{submitted.get_json()['job_id']}?wait=5")
+    assert polled.status_code == 200
+    job = polled.get_json()
+    assert job['status'] == 'succeeded'
+    assert job['result'] == {'success': True, 'data': '咳嗽三天'}
+
+
+def test_running_job_keeps_its_lease(tmp_path):
+    runs = []
+
+    def handler(payload):
+        runs.append(threading.current_thread().name)
+        time.sleep(1.0)
+        return {'done': True}
+
+    # 两个 JobQueue 共享数据库，相当于两个进程；租约远短于任务耗时
+    db_path = str(tmp_path / 'jobs.db')
+    first = JobQueue(db_path, {'slow': handler}, workers=1, lease_seconds=0.3, poll_interval=0.05)
+    second = JobQueue(db_path, {'slow': handler}, workers=1, lease_seconds=0.3, poll_interval=0.05)
+    first.start()
+    job = first.submit('slow', {})
+    wait_for(first, job['job_id'], ('running',))
+    second.start()
+    finished = wait_for(first, job['job_id'], ('succeeded', 'failed'))
+    assert finished['status'] == 'succeeded'
+    assert finished['attempts'] == 1
+    assert len(runs) == 1
+
+
+def test_expired_owner_cannot_finish(tmp_path):
+    job_queue = JobQueue(str(tmp_path / 'jobs.db'), {'slow': lambda payload: {}}, workers=1)
+    job = job_queue.submit('slow', {})
+    _, stale_owner = job_queue._claim()
+    with job_queue._connection() as conn:
+        conn.execute('UPDATE jobs SET lease_until = 0 WHERE id = ?', (job['job_id'],))
+    _, owner = job_queue._claim()
+
+    assert not job_queue._finish(job['job_id'], stale_owner, 'succeeded', result={'from': 'stale'})
+    assert job_queue.get(job['job_id'])['status'] == 'running'
+    assert job_queue._finish(job['job_id'], owner, 'succeeded', result={'from': 'owner'})
+    assert job_queue.get(job['job_id'])['result'] == {'from': 'owner'}
@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+from live_transcription import LiveTranscriptionSession
+
+
+class FakeWebSocket:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    def receive(self):
+        return self.messages.pop(0) if self.messages else json.dumps({'type': 'stop'})
+
+    def send(self, message):
+        self.sent.append(json.loads(message))
+
+
+@pytest.mark.parametrize('sample_rate', ['abc', 0, -16000, 16000.5, 192000, None])
+def test_invalid_sample_rate_is_rejected(sample_rate):
+    ws = FakeWebSocket([json.dumps({'type': 'start', 'format': 'pcm16', 'sample_rate': sample_rate})])
+    session = LiveTranscriptionSession(ws, speech_to_text=None, executor=object())
+    session.run()
+    assert [message['type'] for message in ws.sent] == ['error', 'done']
+    assert session.segmenter is None
+
+
+def test_valid_sample_rate_starts_session():
+    ws = FakeWebSocket([json.dumps({'type': 'start', 'format': 'pcm16', 'sample_rate': '44100'})])
+    session = LiveTranscriptionSession(ws, speech_to_text=None, executor=object())
+    session.run()
+    assert session.sample_rate == 44100
+    assert [message['type'] for message in ws.sent] == ['ready', 'done']
@@ -0,0 +1,39 @@
+import pytest
+
+import prompts
+
+
+@pytest.fixture(autouse=True)
+def reset_counter():
+    yield
+    prompts.use_token_counter(None)
+
+
+def test_token_count_runs_outside_the_lock():
+    held = []
+
+    def counter(text):
+        held.append(prompts._verdict_lock.locked())
+        return 10 ** 6
+
+    prompts.use_token_counter(counter)
+    assert prompts.shared_prefix_enabled()
+    assert prompts.shared_prefix_enabled()
+    assert held == [False]
+
+
+def test_estimate_is_kept_until_retry(monkeypatch):
+    results = [None]
+    monkeypatch.setattr(prompts, 'PROMPT_SHARED_RETRY_SECONDS', 3600)
+    prompts.use_token_counter(lambda text: results.pop(0))
+    # 第二次调用仍在有效期内，不再实测（否则 pop 会失败）
+    assert prompts.shared_prefix_enabled() == prompts.shared_prefix_enabled()
+
+
+def test_estimate_is_retried_after_ttl(monkeypatch):
+    results = [None, 10 ** 6]
+    monkeypatch.setattr(prompts, 'PROMPT_SHARED_RETRY_SECONDS', 0)
+    prompts.use_token_counter(lambda text: results.pop(0))
+    prompts.shared_prefix_enabled()
+    assert prompts.shared_prefix_enabled()
+    assert results == []
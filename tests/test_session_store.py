@@ -0,0 +1,47 @@
+import pytest
+
+from session_store import SessionStore, StaleUpdate
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    db_path = str(tmp_path / 'sessions.db') if request.param == 'sqlite' else None
+    return SessionStore(10 ** 6, 3600, db_path)
+
+
+def with_results(store):
+    session = store.create(patient_info={'name': '张三'}, transcript='咳嗽三天')
+    return store.update(session['id'], soap={'plan': '阿莫西林'}, examinations=[{'name': '血常规'}],
+                        medications=[{'name': '阿莫西林', 'dose': '0.5g'}], drug_check={'results': {}})
+
+
+@pytest.mark.parametrize('field, value', [('transcript', '咳嗽五天'), ('patient_info', {'name': '李四'})])
+def test_input_change_clears_soap_and_later_results(store, field, value):
+    session = with_results(store)
+    updated = store.update(session['id'], **{field: value})
+    assert updated['soap'] is None
+    assert updated['examinations'] is None
+    assert updated['medications'] is None
+    assert updated['drug_check'] is None
+
+
+def test_unchanged_input_keeps_results(store):
+    session = with_results(store)
+    updated = store.update(session['id'], transcript='咳嗽三天')
+    assert updated['soap'] == {'plan': '阿莫西林'}
+
+
+def test_stale_result_is_dropped(store):
+    read = store.create(transcript='咳嗽三天')
+    store.update(read['id'], transcript='咳嗽三天，发热')
+    with pytest.raises(StaleUpdate):
+        store.update(read['id'], read=read, soap={'plan': '旧转录的计划'})
+    assert store.get(read['id'])['soap'] is None
+
+
+def test_unrelated_concurrent_result_does_not_conflict(store):
+    read = with_results(store)
+    store.update(read['id'], read=read, examinations=[{'name': '胸片'}])
+    updated = store.update(read['id'], read=read, drug_check={'results': {'severity': '无'}})
+    assert updated['examinations'] == [{'name': '胸片'}]
+    assert updated['drug_check'] == {'results': {'severity': '无'}}
@@ -0,0 +1,13 @@
+import mimetypes
+
+import pytest
+
+import app as web_app
+
+
+@pytest.mark.parametrize('filename', ['js/app.js', 'css/style.css'])
+def test_fingerprinted_asset_has_single_charset(filename):
+    assets = web_app.app.extensions['static_assets']
+    response = web_app.app.test_client().get(f"/static/{assets.assets[filename].fingerprinted}")
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == f"{mimetypes.guess_type(filename)[0]}; charset=utf-8"
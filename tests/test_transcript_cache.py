@@ -0,0 +1,64 @@
+import json
+
+from soap_generator import SOAPGenerator
+from transcript_cache import TranscriptCache
+
+TRANSCRIPT = "医生：哪里不舒服？患者：咳嗽三天，有黄痰，体温38.5度。医生：开阿莫西林，一天三次。"
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    def __init__(self):
+        self.prompts = []
+
+    def generate_content(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return FakeResponse(json.dumps({
+            'chief_complaint': '咳嗽', 'subjective': f'第{len(self.prompts)}次', 'objective': '',
+            'assessment': '急性支气管炎', 'plan': '阿莫西林', 'preliminary_diagnosis': ['急性支气管炎'],
+        }, ensure_ascii=False))
+
+
+def make_generator(cache):
+    generator = SOAPGenerator('key', use_similar_cache=False)
+    generator.similar_cache = cache
+    generator.model = FakeModel()
+    return generator
+
+
+def test_identical_transcript_is_never_reused():
+    generator = make_generator(TranscriptCache(capacity=10))
+    first = generator.generate_soap(TRANSCRIPT, {'name': '张三', 'age': 40, 'allergies': '无'})
+    second = generator.generate_soap(TRANSCRIPT, {'name': '李四', 'age': 40, 'allergies': '青霉素'})
+
+    assert len(generator.model.prompts) == 2
+    assert second['subjective'] == '第2次'
+    assert first is not second
+    # 第一份病历属于其他患者，不能出现在第二次调用的提示词里
+    assert '第1次' not in generator.model.prompts[1]
+
+
+def test_lookup_returns_copy():
+    cache = TranscriptCache(capacity=10)
+    fingerprint = cache.fingerprint(TRANSCRIPT)
+    cache.add(fingerprint, TRANSCRIPT, {'plan': '阿莫西林'})
+
+    match = cache.lookup(fingerprint)
+    match.result['plan'] = '已修改'
+
+    assert cache.lookup(fingerprint).result['plan'] == '阿莫西林'
+
+
+def test_dissimilar_transcript_misses():
+    cache = TranscriptCache(capacity=10)
+    cache.add(cache.fingerprint(TRANSCRIPT), TRANSCRIPT, {'plan': '阿莫西林'})
+
+    assert cache.lookup(cache.fingerprint("医生：膝盖怎么了？患者：上楼梯时疼痛两个月。")) is None
+
+
+def test_disabled_by_default():
+    assert SOAPGenerator('key').similar_cache is None
@@ -0,0 +1,152 @@
+"""
+相似问诊缓存：复诊、模板化口述的问诊记录往往只有姓名、日期、语气词不同
+
+问诊记录归一化后取字符 n-gram 的 MinHash 签名，用 LSH 分桶做近似最近邻查找；
+找到足够相似的历史病历时，作为参考示例交给模型。历史病历属于另一位患者，
+即使问诊记录几乎一致也不直接复用（姓名、过敏史、用药等不在相似度计算之内）。
+"""
+import copy
+import random
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+from config import SOAP_SIMILAR_CACHE_SIZE, SOAP_SIMILAR_THRESHOLD
+from metrics import metrics
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 2
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240611)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+FILLER_PATTERN = re.compile(r'嗯+|啊+|呃+|哦+|唉+|那个|这个|就是说|就是|然后|对吧|是吧|好的|um+|uh+')
+DATE_PATTERN = re.compile(r'\d{2,4}\s*[-/年.]\s*\d{1,2}\s*[-/月.]\s*\d{1,2}\s*[日号]?|\d{1,2}\s*月\s*\d{1,2}\s*[日号]')
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+
+
+def normalize_transcript(text: str, patient_info: Optional[Dict] = None) -> str:
+    """去掉姓名、日期、语气词和标点，数字统一替换为占位符"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    name = str((patient_info or {}).get('name') or '').strip().lower()
+    if name:
+        text = text.replace(name, '')
+    text = re.sub(r'^(?:医生|患者|病人|家属|doctor|patient)\s*[:：]', '', text, flags=re.MULTILINE)
+    text = DATE_PATTERN.sub('@', text)
+    text = NUMBER_PATTERN.sub('#', text)
+    text = FILLER_PATTERN.sub('', text)
+    return re.sub(r'[\s\W_]+', '', text)
+
+
+def minhash(text: str) -> List[int]:
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(a: List[int], b: List[int]) -> float:
+    """两个签名相同位置相等的比例，即 Jaccard 相似度的估计"""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class Fingerprint(NamedTuple):
+    signature: List[int]
+
+
+class SimilarMatch(NamedTuple):
+    similarity: float
+    result: Dict
+    transcript: str
+
+
+class TranscriptCache:
+    """MinHash + LSH 近似最近邻索引，按 LRU 淘汰，条目数不超过 capacity"""
+
+    def __init__(self, capacity: int = SOAP_SIMILAR_CACHE_SIZE,
+                 threshold: float = SOAP_SIMILAR_THRESHOLD):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._entries: 'OrderedDict[int, Dict]' = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        metrics.gauge('soap_similar_cache_entries', lambda: len(self._entries))
+
+    @staticmethod
+    def _band_keys(signature: List[int]):
+        for band in range(BANDS):
+            yield (band,) + tuple(signature[band * ROWS:(band + 1) * ROWS])
+
+    @staticmethod
+    def fingerprint(transcript: str, patient_info: Optional[Dict] = None) -> Fingerprint:
+        return Fingerprint(minhash(normalize_transcript(transcript, patient_info)))
+
+    def lookup(self, fingerprint: Fingerprint) -> Optional[SimilarMatch]:
+        signature = fingerprint.signature
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates.update(self._buckets.get(key, ()))
+            best_id, best = None, 0.0
+            for entry_id in candidates:
+                score = similarity(signature, self._entries[entry_id]['fingerprint'].signature)
+                if score > best:
+                    best_id, best = entry_id, score
+            if best_id is None or best < self.threshold:
+                metrics.inc('soap_similar_cache_total', result='miss')
+                return None
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            result = copy.deepcopy(entry['result'])
+            transcript = entry['transcript']
+
+        metrics.inc('soap_similar_cache_total', result='hit')
+        metrics.observe('soap_similar_cache_similarity', best)
+        return SimilarMatch(best, result, transcript)
+
+    def add(self, fingerprint: Fingerprint, transcript: str, result: Dict):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                'fingerprint': fingerprint,
+                'transcript': transcript,
+                'result': copy.deepcopy(result),
+            }
+            for key in self._band_keys(fingerprint.signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.capacity:
+                self._evict()
+
+    def _evict(self):
+        entry_id, entry = self._entries.popitem(last=False)
+        for key in self._band_keys(entry['fingerprint'].signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+        metrics.inc('soap_similar_cache_evictions_total')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_transcript_cache() -> TranscriptCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TranscriptCache()
+    return _cache
@@ -1,7 +1,8 @@
 import pyaudio
-import wave
 import os
 import queue
+from audio_codec import encode_pcm
+from config import RECORDING_FORMAT
 
 class VoiceRecorder:
     def __init__(self, sample_rate=16000, chunk_size=1024, channels=1):
@@ -40,7 +41,8 @@ class VoiceRecorder:
             self.stream.stop_stream()
             self.stream.close()
     
-    def save_recording(self, filepath: str):
+    def save_recording(self, filepath: str, fmt: str = RECORDING_FORMAT):
+        """保存录音并压缩，返回实际写入的路径（扩展名随格式变化）"""
         frames = []
         while not self.audio_queue.empty():
             frames.append(self.audio_queue.get())
@@ -50,14 +52,13 @@ class VoiceRecorder:
             
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         
-        wf = wave.open(filepath, 'wb')
-        wf.setnchannels(self.channels)
-        wf.setsampwidth(self.audio.get_sample_size(self.audio_format))
-        wf.setframerate(self.sample_rate)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-        
-        return True
+        return encode_pcm(
+            b''.join(frames), filepath,
+            sample_rate=self.sample_rate,
+            sample_width=self.audio.get_sample_size(self.audio_format),
+            channels=self.channels,
+            fmt=fmt
+        )
     
     def cleanup(self):
         self.stop_recording()